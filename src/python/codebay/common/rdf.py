@@ -196,7 +196,7 @@ And the other sequences that were set.
 """
 __docformat__ = 'epytext en'
 
-import os, datetime, re, traceback
+import os, datetime, re, traceback, tempfile
 from sets import Set as set
 from twisted.python.util import mergeFunctionMetadata
 
@@ -385,68 +385,41 @@ class BaseModel:
     @selftransact()
     def loadFile(self, filename, name = 'rdfxml'):
         p = self._get_parser(name)
-        self.store.add_statements(p.parseFile(filename))
+        self.store.add_statements_bulk(p.parseFile(filename))
 
     @selftransact()
     def loadString(self, value, name = 'rdfxml'):
         p = self._get_parser(name)
-        self.store.add_statements(p.parseString(value))
+        self.store.add_statements_bulk(p.parseString(value))
 
     @selftransact()
     def toFile(self, filename, name = 'rdfxml', namespaces = {}):
         serializer = self._get_serializer(name)
-        serializer.serializeFile(self.store.all_statements(), filename)
+        serializer.serializeFile(self.store.iter_all_statements(), filename)
 
     @selftransact()
     def toString(self, name = 'rdfxml', namespaces = {}):
         serializer = self._get_serializer(name)
-        return serializer.serializeString(self.store.all_statements())
+        return serializer.serializeString(self.store.iter_all_statements())
 
     @selftransact()
     def prune(self, root):
         """Prunes an RDF model in place.
 
-        Traverses statements from each subject to object starting from
-        the given root and listing seen objects as it goes. Then
-        iterates through all statements and removes them if their
-        subjects are not on the list.
+        Removes all statements whose subject is not reachable from the
+        given root by traversing statements from subject to object.
+        The traversal is done by the store, inside the database when
+        possible.
         """
-        handled = set()
-        queue = [root.node]
-        handled.add(root.node)
-        while len(queue):
-            curnode = queue.pop(0)
-            template = tinyrdf.Statement(curnode, None, None)
-            for stmt in self.store.find_statements(template):
-                if stmt.object not in handled:
-                    handled.add(stmt.object)
-                    queue.append(stmt.object)
-        todelete = []
-        for stmt in self.store.all_statements():
-            if stmt.subject not in handled:
-                todelete.append(stmt)
-        for stmt in todelete:
-            self.store.remove_statement(stmt)
+        self.store.prune_unreachable(root.node)
 
     @selftransact()
     def pruneTo(self, root, newmodel):
         """Prune starting from a root node into a new model."""
 
-        # XXX: duplication with prune
-
         @modeltransact(newmodel)
         def _f():
-            handled = set()
-            queue = [root.node]
-            handled.add(root.node)
-            while len(queue):
-                curnode = queue.pop(0)
-                template = tinyrdf.Statement(curnode, None, None)
-                for stmt in self.store.find_statements(template):
-                    if stmt.object not in handled:
-                        handled.add(stmt.object)
-                        queue.append(stmt.object)
-                    newmodel.store.add_statement(stmt)
+            newmodel.store.add_statements_bulk(self.store.find_reachable_statements(root.node))
         _f()
         return newmodel
 
@@ -468,29 +441,86 @@ class BaseModel:
 
         return newmodel
 
+    def exportPruned(self, root, fileobj, name = 'rdfxml', emptied = [], tempdir = None):
+        """Serialize the part of the model reachable from root into fileobj.
+
+        Reachable statements are first copied, inside one transaction, into
+        an unnamed temporary file in tempdir.  They are serialized from that
+        snapshot after the transaction has ended, so the model is locked only
+        for the read, and memory use does not grow with the model size.
+
+        The emptied argument is a list of (node, predicate, type URI)
+        tuples.  The object of each such arc is not traversed, and is
+        exported as an empty node of the given rdf:type; a missing object is
+        created, as if setS() with a L{Type} had been called before pruning.
+
+        Call outside a transaction; otherwise the lock is held by the caller
+        for the whole export.
+        """
+        tmp = tempfile.TemporaryFile(dir=tempdir)
+        try:
+            # the snapshot transaction is the point, so don't warn about it
+            @modeltransact(self, silent=True)
+            def _snapshot():
+                leaf_arcs = {}
+                for node, predicate, ctype in emptied:
+                    leaf_arcs[(node.node, predicate)] = ctype
+                leaf_subjects = set([subject for subject, predicate in leaf_arcs.keys()])
+
+                def _statements():
+                    seen_subjects = set()
+                    seen_arcs = set()
+                    for st in self.store.iter_reachable_statements(root.node, leaf_arcs):
+                        if st.subject in leaf_subjects:
+                            seen_subjects.add(st.subject)
+                        key = (st.subject, st.predicate)
+                        if leaf_arcs.has_key(key):
+                            if key in seen_arcs:
+                                continue
+                            seen_arcs.add(key)
+                            yield st
+                            yield tinyrdf.Statement(st.object, RDF_NS.type, leaf_arcs[key])
+                        else:
+                            yield st
+                    for key, ctype in leaf_arcs.items():
+                        if (key not in seen_arcs) and (key[0] in seen_subjects):
+                            obj = makeUuidUri()
+                            yield tinyrdf.Statement(key[0], key[1], obj)
+                            yield tinyrdf.Statement(obj, RDF_NS.type, ctype)
+
+                tinyrdf.PickleSerializer().serialize(_statements(), tmp)
+            _snapshot()
+
+            tmp.seek(0)
+            self._get_serializer(name).serialize(tinyrdf.PickleParser().parse(tmp), fileobj)
+        finally:
+            tmp.close()
+
     @selftransact()
     def getPruneStatistics(self, root):
-        """Execute a pseudo-prune and produce useful RDF database statistics."""
-        
-        # XXX: duplication with prune and pruneTo
-        handled = set()
-        queue = [root.node]
-        handled.add(root.node)
-        while len(queue):
-            curnode = queue.pop(0)
-            template = tinyrdf.Statement(curnode, None, None)
-            for stmt in self.store.find_statements(template):
-                if stmt.object not in handled:
-                    handled.add(stmt.object)
-                    queue.append(stmt.object)
+        """Execute a pseudo-prune and produce useful RDF database statistics.
+
+        Returns a (total statement count, reachable statement count) tuple.
+        """
+        return self.store.count_reachable_statements(root.node)
 
-        count, reachable = 0, 0
-        for stmt in self.store.all_statements():
-            count += 1
-            if stmt.subject in handled:
-                reachable += 1
+    @selftransact()
+    def getReachableNodes(self, root):
+        """Returns the set of (tinyrdf) nodes reachable from root, including root."""
+        return self.store.reachable_nodes(root.node)
+
+    def getChangesSince(self, generation):
+        """Returns a (generation, changed subjects) tuple.
 
-        return count, reachable
+        The changed subjects are (tinyrdf) subject nodes written by commits
+        after the given generation, in this or other processes.  The list is
+        None if the changes are unknown (generation is None or too old).
+        Generation is None if the store does not track changes.
+
+        This is intentionally not transacted: it only takes a shared lock,
+        and is cheap enough to be polled frequently.
+        """
+        return self.store.find_changed_subjects(generation)
 
     @selftransact()
     def getNodeByUri(self, uri, dataclass = None):
@@ -523,6 +553,18 @@ class BaseModel:
             raise RdfException('Unknown find type %s.' % repr(direction))
         return res
 
+    def _iterNodes(self, val1, val2, direction = None):
+        if direction is None or direction is toObject:
+            template = tinyrdf.Statement(val1, val2, None)
+            for stmt in self.store.iter_statements(template):
+                yield stmt.object
+        elif direction is toSubject:
+            template = tinyrdf.Statement(None, val2, val1)
+            for stmt in self.store.iter_statements(template):
+                yield stmt.subject
+        else:
+            raise RdfException('Unknown find type %s.' % repr(direction))
+
     def _findNodePairs(self, node):
         res = []
         stm_temp = tinyrdf.Statement(node, None, None)
@@ -608,16 +650,21 @@ class Database(BaseModel):
     # XXX: This API call does not protect against race conditions; e.g. two callers
     # may both first delete the database and then try to create it.  Further, there
     # is no protection against someone using open() at the same time as create().
-    def create(klass, filename):
+    def create(klass, filename, encoded=False):
         """Create a new database.
 
-        This means overwriting any already existing database.
+        This means overwriting any already existing database.  If encoded
+        is True, the database uses the dictionary encoded schema (see
+        tinyrdf.ApswEncodedStore); open() detects the schema automatically.
         """
         klass.delete(filename)
         m = klass()
         # NB: this parameterization is crucial for correctly working transactions, beware
         #m.store = tinyrdf.SqlalchemyStore.create('sqlite:///%s' % filename, connect_args={'timeout': 300.0, 'isolation_level': None})
-        m.store = tinyrdf.ApswStore.create(filename)
+        if encoded:
+            m.store = tinyrdf.ApswEncodedSubjectCachedStore.create(filename)
+        else:
+            m.store = tinyrdf.ApswSubjectCachedStore.create(filename)
 ###     m.store = tinyrdf.SqlalchemySubjectCachedStore.create('sqlite:///%s' % filename, connect_args={'timeout': 300.0, 'isolation_level': None})
         return m
     create = classmethod(create)
@@ -632,11 +679,18 @@ class Database(BaseModel):
         m = klass()
         # NB: this parameterization is crucial for correctly working transactions, beware
         #m.store = tinyrdf.SqlalchemyStore.open('sqlite:///%s' % filename, connect_args={'timeout': 300.0, 'isolation_level': None})
-        m.store = tinyrdf.ApswStore.open(filename)
+        m.store = tinyrdf.ApswSubjectCachedStore.open(filename)
 ###     m.store = tinyrdf.SqlalchemySubjectCachedStore.open('sqlite:///%s' % filename, connect_args={'timeout': 300.0, 'isolation_level': None})
         return m
     open = classmethod(open)
 
+    def convert(klass, filename):
+        """Convert an existing database to the dictionary encoded schema in place."""
+        m = klass()
+        m.store = tinyrdf.ApswEncodedSubjectCachedStore.convert(filename)
+        return m
+    convert = classmethod(convert)
+
     def delete(klass, filename):
         """Delete a database if it exists."""
         try:
@@ -726,15 +780,21 @@ class Node:
 
     @selfmodeltransact()
     def iterNodes(self, predicate, dataclass = None, direction = None):
-        """Use getNodes unless you know what you are doing."""
+        """Use getNodes unless you know what you are doing.
+
+        Nodes are streamed from the store, so the model must not be
+        modified while iterating.
+        """
         if dataclass is None:
             dataclass = Resource
-        for node in self.model._findNodes(self.node, predicate, direction):
+        for node in self.model._iterNodes(self.node, predicate, direction):
             yield dataclass.parse(self.model, node)
 
     @selfmodeltransact()
     def getNodes(self, predicate, dataclass = None, direction = None):
-        return list(self.iterNodes(predicate, dataclass, direction))
+        if dataclass is None:
+            dataclass = Resource
+        return [dataclass.parse(self.model, node) for node in self.model._findNodes(self.node, predicate, direction)]
 
     @selfmodeltransact()
     def getNodePairs(self):
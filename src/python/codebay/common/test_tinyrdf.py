@@ -61,6 +61,100 @@ class _TestStore(object):
         self.failUnlessEqual(list(self.store.find_statements(tinyrdf.Statement(None, None, None))), [])
         self.clearStore()
 
+    def test_iter(self):
+        self.clearStore()
+        subject1 = tinyrdf.Blank()
+        stmts = [tinyrdf.Statement(subject1,
+                                   tinyrdf.Uri('http://www.example.com/#aaa'),
+                                   tinyrdf.Literal(str(i))) for i in xrange(1200)]
+        self.store.add_statements_bulk(stmts)
+        res = []
+        for stmt in self.store.iter_statements(tinyrdf.Statement(subject1, None, None)):
+            # other queries while iterating must not disturb the iterator
+            self.failUnless(self.store.contains_statement(stmt))
+            res.append(stmt)
+        res.sort()
+        stmts.sort()
+        self.failUnlessEqual(res, stmts)
+        self.failUnlessEqual(len(list(self.store.iter_all_statements())), 1200)
+        self.failUnlessEqual(list(self.store.iter_statements(tinyrdf.Statement(None, None, tinyrdf.Literal('x')))), [])
+        self.clearStore()
+
+    def test_bulk(self):
+        self.clearStore()
+        subjects = [tinyrdf.Uri('http://www.example.com/#s%d' % i) for i in xrange(5)]
+        stmts = []
+        for sub in subjects:
+            stmts.append(tinyrdf.Statement(sub, tinyrdf.Uri('http://www.example.com/#aaa'), tinyrdf.Literal('AAA')))
+            stmts.append(tinyrdf.Statement(sub, tinyrdf.Uri('http://www.example.com/#bbb'), sub))
+        self.store.add_statements_bulk(stmts)
+        self.store.add_statements_bulk(stmts[:3])  # duplicates are ignored
+        self.failUnlessEqual(self.store.count_statements(tinyrdf.Statement(None, None, None)), 10)
+
+        res = self.store.find_statements_for_subjects(subjects[:2])
+        res.sort()
+        expected = stmts[:4]
+        expected.sort()
+        self.failUnlessEqual(res, expected)
+        res = self.store.find_statements_for_subjects(subjects[1:3], tinyrdf.Uri('http://www.example.com/#bbb'))
+        res.sort()
+        expected = [stmts[3], stmts[5]]
+        expected.sort()
+        self.failUnlessEqual(res, expected)
+        self.failUnlessEqual(list(self.store.find_statements_for_subjects([])), [])
+
+        self.store.remove_statements_bulk(stmts[2:])
+        res = list(self.store.find_statements(tinyrdf.Statement(None, None, None)))
+        res.sort()
+        expected = stmts[:2]
+        expected.sort()
+        self.failUnlessEqual(res, expected)
+        self.clearStore()
+
+    def test_reachability(self):
+        self.clearStore()
+        ns = tinyrdf.NS('http://www.example.com/#',
+                        root = None, child = None, value = None, loop = None,
+                        a = None, b = None, c = None, d = None, unknown = None)
+        stmts = [tinyrdf.Statement(ns.root, ns.child, ns.a),
+                 tinyrdf.Statement(ns.a, ns.child, ns.b),
+                 tinyrdf.Statement(ns.a, ns.value, tinyrdf.Literal('x')),
+                 tinyrdf.Statement(ns.b, ns.loop, ns.root),
+                 tinyrdf.Statement(ns.c, ns.child, ns.a),
+                 tinyrdf.Statement(ns.d, ns.value, tinyrdf.Literal('y'))]
+        self.store.add_statements_bulk(stmts)
+
+        nodes = self.store.reachable_nodes(ns.root)
+        for node in (ns.root, ns.a, ns.b):
+            self.failUnless(node in nodes)
+        for node in (ns.c, ns.d):
+            self.failIf(node in nodes)
+        self.failUnlessEqual(self.store.count_reachable_statements(ns.root), (6, 4))
+        res = list(self.store.find_reachable_statements(ns.root))
+        res.sort()
+        expected = stmts[:4]
+        expected.sort()
+        self.failUnlessEqual(res, expected)
+        res = list(self.store.iter_reachable_statements(ns.root, chunk_size=1))
+        res.sort()
+        self.failUnlessEqual(res, expected)
+
+        # objects of leaf arcs are not traversed
+        res = list(self.store.iter_reachable_statements(ns.root, leaf_arcs=set([(ns.root, ns.child)])))
+        self.failUnlessEqual(res, stmts[:1])
+
+        removed = self.store.prune_unreachable(ns.root)
+        removed.sort()
+        self.failUnlessEqual(removed, [ns.c, ns.d])
+        res = list(self.store.find_statements(tinyrdf.Statement(None, None, None)))
+        res.sort()
+        self.failUnlessEqual(res, expected)
+
+        # unknown root prunes everything
+        self.store.prune_unreachable(ns.unknown)
+        self.failUnlessEqual(self.store.count_statements(tinyrdf.Statement(None, None, None)), 0)
+        self.clearStore()
+
 class TestMemoryStore(_TestStore, unittest.TestCase):
     def makeStore(self):
         return tinyrdf.MemoryStore.create()
@@ -73,6 +167,317 @@ class TestApswStore(_TestStore, unittest.TestCase):
     def makeStore(self):
         return tinyrdf.ApswStore.create(':memory:')
 
+    def test_query_plans(self):
+        for where, plan, indexed in self.store.check_query_plans():
+            self.failUnless(indexed, 'full table scan for%s: %s' % (where, plan))
+
+    def test_index_migration(self):
+        # simulate a database created before secondary indexes were added
+        fname = self.mktemp()
+        c = tinyrdf.apsw.Connection(fname)
+        c.cursor().execute("""CREATE TABLE statements (
+                                sub TEXT NOT NULL,
+                                pre TEXT NOT NULL,
+                                obj TEXT NOT NULL,
+                                UNIQUE (sub, pre, obj)
+                              );""")
+        c = None
+
+        store = tinyrdf.ApswStore.open(fname)
+        try:
+            self.failUnlessEqual(store._get_missing_indexes(), [])
+            self.failUnlessEqual(store.ensure_indexes(), [])
+        finally:
+            store.close()
+
+    def test_changed_subjects(self):
+        st1 = tinyrdf.Statement(tinyrdf.Uri('http://www.example.com/#s1'),
+                                tinyrdf.Uri('http://www.example.com/#aaa'),
+                                tinyrdf.Literal('AAA'))
+        gen0, changed = self.store.find_changed_subjects(None)
+        self.failUnlessEqual(changed, None)
+        self.failUnlessEqual(self.store.find_changed_subjects(gen0), (gen0, []))
+
+        t = self.store.begin_transaction()
+        self.store.add_statement(st1)
+        t.commit()
+
+        gen1, changed = self.store.find_changed_subjects(gen0)
+        self.failUnlessEqual(gen1, gen0 + 1)
+        self.failUnlessEqual(changed, [st1.subject])
+
+        # also usable inside a transaction
+        t = self.store.begin_transaction()
+        self.failUnlessEqual(self.store.find_changed_subjects(gen1), (gen1, []))
+        t.commit()
+
+class TestApswEncodedStore(TestApswStore):
+    def makeStore(self):
+        return tinyrdf.ApswEncodedStore.create(':memory:')
+
+    def test_node_cache(self):
+        self.clearStore()
+        subject1 = tinyrdf.Uri('http://www.example.com/#s1')
+        st1 = tinyrdf.Statement(subject1,
+                                tinyrdf.Uri('http://www.example.com/#aaa'),
+                                tinyrdf.Literal('AAA', language='en'))
+        self.store.add_statement(st1)
+        res1 = self.store.find_statements(tinyrdf.Statement(subject1, None, None))
+        res2 = self.store.find_statements(tinyrdf.Statement(None, None, st1.object))
+        self.failUnlessEqual(res1, [st1])
+        self.failUnlessEqual(res2, [st1])
+        self.failUnless(res1[0].object is res2[0].object)
+
+        # nodes added in a rolled back transaction must not stay cached
+        t = self.store.begin_transaction()
+        st2 = tinyrdf.Statement(subject1,
+                                tinyrdf.Uri('http://www.example.com/#bbb'),
+                                tinyrdf.Literal('BBB', datatype='http://www.example.com/#type'))
+        self.store.add_statement(st2)
+        self.failUnless(self.store.contains_statement(st2))
+        t.rollback()
+        self.failIf(self.store.contains_statement(st2))
+        self.failIf(st2.object in self.store.node_ids)
+        self.failUnlessEqual(self.store.find_statements(tinyrdf.Statement(None, None, None)), [st1])
+        self.clearStore()
+
+    def test_node_gc(self):
+        fname = self.mktemp()
+        store1 = tinyrdf.ApswEncodedStore.create(fname)
+        store1.node_gc_interval = 10
+        store2 = tinyrdf.ApswEncodedStore.open(fname)
+        subject1 = tinyrdf.Uri('http://www.example.com/#s1')
+        predicate1 = tinyrdf.Uri('http://www.example.com/#counter')
+
+        def _count_nodes():
+            for count, in store1.cursor.execute('SELECT count(*) FROM nodes;'):
+                return count
+
+        # replacing a literal over and over again (like setS of a status
+        # value) must not grow the nodes table without bound
+        for i in xrange(100):
+            t = store1.begin_transaction()
+            store1.remove_statements(tinyrdf.Statement(subject1, predicate1, None))
+            store1.add_statement(tinyrdf.Statement(subject1, predicate1, tinyrdf.Literal(unicode(i))))
+            t.commit()
+            self.failUnless(_count_nodes() <= 2 + store1.node_gc_interval + 1)
+
+        # a second store must not use cached ids of collected nodes
+        st = tinyrdf.Statement(subject1, predicate1, tinyrdf.Literal(u'99'))
+        self.failUnless(store2.contains_statement(st))
+        store1.remove_statements(tinyrdf.Statement(subject1, predicate1, None))
+        store1.add_statement(tinyrdf.Statement(subject1, predicate1, tinyrdf.Literal(u'x')))
+        self.failUnless(store1.gc_nodes() > 0)
+        self.failIf(st.object in store1.node_ids)
+        self.failIf(store2.contains_statement(st))
+        store2.add_statement(st)
+        self.failUnless(store1.contains_statement(st))
+        self.failUnlessEqual(len(store1.find_statements(tinyrdf.Statement(None, None, None))), 2)
+
+    def test_node_gc_epoch_checks(self):
+        # the node gc epoch is checked once per transaction or untransacted
+        # operation, not on every node lookup
+        for cls in [tinyrdf.ApswEncodedStore, tinyrdf.ApswEncodedSubjectCachedStore]:
+            store = cls.create(':memory:')
+            checks = []
+            orig = store._check_node_gc_epoch
+            def _check():
+                checks.append(True)
+                orig()
+            store._check_node_gc_epoch = _check
+
+            subject1 = tinyrdf.Uri('http://www.example.com/#s1')
+            st1 = tinyrdf.Statement(subject1,
+                                    tinyrdf.Uri('http://www.example.com/#aaa'),
+                                    tinyrdf.Literal('AAA'))
+            st2 = tinyrdf.Statement(subject1,
+                                    tinyrdf.Uri('http://www.example.com/#bbb'),
+                                    tinyrdf.Literal('BBB'))
+            store.add_statement(st1)
+            self.failUnlessEqual(len(checks), 1)
+            self.failUnless(store.contains_statement(st1))
+            self.failUnlessEqual(len(checks), 2)
+
+            t = store.begin_transaction()
+            store.add_statement(st2)
+            self.failUnless(store.contains_statement(st1))
+            self.failUnlessEqual(len(store.find_statements(tinyrdf.Statement(subject1, None, None))), 2)
+            store.remove_statements_bulk([st1, st2])
+            t.commit()
+            self.failUnlessEqual(len(checks), 3)
+            store.close()
+
+    def test_convert(self):
+        fname = self.mktemp()
+        st1 = tinyrdf.Statement(tinyrdf.Uri('http://www.example.com/#s1'),
+                                tinyrdf.Uri('http://www.example.com/#aaa'),
+                                tinyrdf.Literal('AAA\tBBB', language='fi'))
+        st2 = tinyrdf.Statement(tinyrdf.Blank(),
+                                tinyrdf.Uri('http://www.example.com/#bbb'),
+                                tinyrdf.Literal('1', datatype='http://www.w3.org/2001/XMLSchema#integer'))
+        st3 = tinyrdf.Statement(st2.subject,
+                                tinyrdf.Uri('http://www.example.com/#ccc'),
+                                st1.subject)
+        store = tinyrdf.ApswStore.create(fname)
+        store.add_statements([st1, st2, st3])
+        store.close()
+
+        store = tinyrdf.ApswEncodedStore.convert(fname)
+        store.close()
+
+        store = tinyrdf.ApswStore.open(fname)
+        try:
+            self.failUnless(isinstance(store, tinyrdf.ApswEncodedStore))
+            res = store.find_statements(tinyrdf.Statement(None, None, None))
+            res.sort()
+            expected = [st1, st2, st3]
+            expected.sort()
+            self.failUnlessEqual(res, expected)
+        finally:
+            store.close()
+
+class TestApswSubjectCachedStore(TestApswStore):
+    def makeStore(self):
+        return tinyrdf.ApswSubjectCachedStore.create(':memory:')
+
+    def _statements(self):
+        subject1 = tinyrdf.Uri('http://www.example.com/#s1')
+        return [tinyrdf.Statement(subject1,
+                                  tinyrdf.Uri('http://www.example.com/#aaa'),
+                                  tinyrdf.Literal('AAA')),
+                tinyrdf.Statement(subject1,
+                                  tinyrdf.Uri('http://www.example.com/#bbb'),
+                                  tinyrdf.Literal('BBB'))]
+
+    def test_cache_hits(self):
+        st1, st2 = self._statements()
+        t = self.store.begin_transaction()
+        self.store.add_statements([st1, st2])
+        t.commit()
+
+        t = self.store.begin_transaction()
+        self.failUnlessEqual(self.store.count_statements(tinyrdf.Statement(st1.subject, None, None)), 2)
+        self.failUnlessEqual(self.store.find_statements(tinyrdf.Statement(st1.subject, st1.predicate, None)), [st1])
+        self.failUnless(self.store.contains_statement(st2))
+        self.store.remove_statement(st2)
+        self.failIf(self.store.contains_statement(st2))
+        t.commit()
+
+        # cache survives the commit
+        t = self.store.begin_transaction()
+        self.failUnlessEqual(self.store.find_statements(tinyrdf.Statement(st1.subject, None, None)), [st1])
+        t.commit()
+        stats = self.store.get_cache_statistics()
+        self.failUnlessEqual(stats['misses'], 1)
+        self.failUnlessEqual(stats['hits'], 4)
+
+    def test_rollback(self):
+        st1, st2 = self._statements()
+        t = self.store.begin_transaction()
+        self.store.add_statement(st1)
+        t.commit()
+
+        t = self.store.begin_transaction()
+        self.store.find_statements(tinyrdf.Statement(st1.subject, None, None))
+        self.store.add_statement(st2)
+        self.failUnlessEqual(self.store.count_statements(tinyrdf.Statement(st1.subject, None, None)), 2)
+        t.rollback()
+
+        t = self.store.begin_transaction()
+        self.failUnlessEqual(self.store.find_statements(tinyrdf.Statement(st1.subject, None, None)), [st1])
+        t.commit()
+
+    def test_other_process(self):
+        fname = self.mktemp()
+        st1, st2 = self._statements()
+        st3 = tinyrdf.Statement(tinyrdf.Uri('http://www.example.com/#s2'), st1.predicate, st1.object)
+        store1 = tinyrdf.ApswSubjectCachedStore.create(fname)
+        store2 = tinyrdf.ApswStore.open(fname)
+        try:
+            t = store1.begin_transaction()
+            store1.add_statements([st1, st3])
+            store1.find_statements(tinyrdf.Statement(st1.subject, None, None))
+            store1.find_statements(tinyrdf.Statement(st3.subject, None, None))
+            t.commit()
+
+            # uncached writer modifies one subject
+            t = store2.begin_transaction()
+            store2.add_statement(st2)
+            t.commit()
+
+            t = store1.begin_transaction()
+            self.failUnlessEqual(store1.count_statements(tinyrdf.Statement(st1.subject, None, None)), 2)
+            self.failUnlessEqual(store1.count_statements(tinyrdf.Statement(st3.subject, None, None)), 1)
+            t.commit()
+            stats = store1.get_cache_statistics()
+            self.failUnlessEqual(stats['invalidations'], 1)
+            self.failUnlessEqual(stats['generation'], store1.get_generation())
+        finally:
+            store2.close()
+            store1.close()
+
+    def test_change_log_failure(self):
+        fname = self.mktemp()
+        st1, st2 = self._statements()
+        store1 = tinyrdf.ApswSubjectCachedStore.create(fname)
+        store2 = tinyrdf.ApswSubjectCachedStore.open(fname)
+        try:
+            t = store1.begin_transaction()
+            store1.add_statement(st1)
+            t.commit()
+
+            t = store2.begin_transaction()
+            self.failUnlessEqual(store2.find_statements(tinyrdf.Statement(st1.subject, None, None)), [st1])
+            t.commit()
+
+            # change log write fails after the generation has been bumped
+            def _failing_log_changes(sub_strs):
+                store1.cursor.execute('UPDATE generation SET value = value + 1;')
+                raise Exception('injected change log failure')
+            store1._log_changes = _failing_log_changes
+
+            t = store1.begin_transaction()
+            store1.add_statement(st2)
+            t.commit()
+            self.failUnless(store1.contains_statement(st2))
+
+            t = store2.begin_transaction()
+            self.failUnlessEqual(store2.count_statements(tinyrdf.Statement(st1.subject, None, None)), 2)
+            t.commit()
+            self.failUnlessEqual(store2.get_cache_statistics()['misses'], 2)
+        finally:
+            store2.close()
+            store1.close()
+
+    def test_iter_in_transaction(self):
+        t = self.store.begin_transaction()
+        self.test_iter()
+        t.commit()
+
+    def test_reachability_in_transaction(self):
+        t = self.store.begin_transaction()
+        self.test_reachability()
+        t.commit()
+
+    def test_bulk_in_transaction(self):
+        t = self.store.begin_transaction()
+        self.test_bulk()
+        t.commit()
+
+    def test_eviction(self):
+        self.store.subject_cache.max_size = 4
+        t = self.store.begin_transaction()
+        for i in xrange(10):
+            self.store.add_statement(tinyrdf.Statement(tinyrdf.Uri('http://www.example.com/#s%d' % i),
+                                                       tinyrdf.Uri('http://www.example.com/#aaa'),
+                                                       tinyrdf.Literal('AAA')))
+        for i in xrange(10):
+            self.failUnlessEqual(self.store.count_statements(tinyrdf.Statement(tinyrdf.Uri('http://www.example.com/#s%d' % i), None, None)), 1)
+        t.commit()
+        stats = self.store.get_cache_statistics()
+        self.failUnless(stats['statements'] <= 4)
+        self.failUnless(stats['evictions'] > 0)
+
 class TestUri(unittest.TestCase):
     def test_basic(self):
         u = tinyrdf.Uri('http://www.example.com/#xxx')
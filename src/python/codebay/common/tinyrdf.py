@@ -3,7 +3,8 @@ Tiny RDF library.
 """
 __docformat__ = 'epytext en'
 
-import atexit, StringIO, re, cPickle, datetime
+import atexit, StringIO, re, cPickle, datetime, itertools
+from collections import deque
 
 import sqlalchemy as sqla
 import apsw
@@ -728,9 +729,118 @@ class Store(object):
     def all_statements(self):
         return self.find_statements(Statement(None, None, None))
 
+    def iter_statements(self, template):
+        """Return an iterator over statements matching template.
+
+        Unlike find_statements(), database stores stream the results from
+        a database cursor instead of building a list first, so memory use
+        does not depend on the result size.  The store must not be
+        modified while the iterator is in use, and the iterator must be
+        consumed within the current transaction.
+        """
+        return iter(self.find_statements(template))
+
+    def iter_all_statements(self):
+        return self.iter_statements(Statement(None, None, None))
+
+    # Bulk operations.  These are semantically equivalent to looping over the
+    # corresponding single statement operations (and default to that), but
+    # database stores implement them with a few queries per call.
+
+    def add_statements_bulk(self, statements):
+        self.add_statements(statements)
+
+    def remove_statements_bulk(self, statements):
+        for statement in statements:
+            self.remove_statement(statement)
+
+    def find_statements_for_subjects(self, subjects, predicate=None):
+        """Find all statements whose subject is one of subjects (and
+        whose predicate is predicate, if given)."""
+        res = []
+        for subject in subjects:
+            res.extend(self.find_statements(Statement(subject, predicate, None)))
+        return res
+
+    # Reachability.  A node is reachable from root if it is root or the
+    # object of a statement whose subject is reachable.  These are used for
+    # pruning; the default implementations traverse in Python, database
+    # stores do the traversal inside the database.
+
+    def reachable_nodes(self, root):
+        """Return the set of nodes reachable from root (including root)."""
+        handled = set([root])
+        queue = deque([root])
+        while len(queue):
+            curnode = queue.popleft()
+            for stmt in self.find_statements(Statement(curnode, None, None)):
+                if stmt.object not in handled:
+                    handled.add(stmt.object)
+                    queue.append(stmt.object)
+        return handled
+
+    def iter_reachable_statements(self, root, leaf_arcs=None, chunk_size=500):
+        """Iterate statements whose subject is reachable from root.
+
+        Unlike find_reachable_statements(), statements are produced while
+        traversing, breadth first and chunk_size subjects at a time, so that
+        only the set of visited nodes is kept in memory.  Objects of
+        statements whose (subject, predicate) is in leaf_arcs are produced
+        but not traversed.  The store must not be modified while iterating.
+        """
+        if leaf_arcs is None:
+            leaf_arcs = set()
+        handled = set([root])
+        queue = deque([root])
+        while len(queue):
+            subjects = []
+            while len(queue) and len(subjects) < chunk_size:
+                subjects.append(queue.popleft())
+            for stmt in self.find_statements_for_subjects(subjects):
+                yield stmt
+                if isinstance(stmt.object, Literal) or ((stmt.subject, stmt.predicate) in leaf_arcs):
+                    continue
+                if stmt.object not in handled:
+                    handled.add(stmt.object)
+                    queue.append(stmt.object)
+
+    def find_reachable_statements(self, root):
+        """Return all statements whose subject is reachable from root."""
+        handled = self.reachable_nodes(root)
+        return [stmt for stmt in self.iter_all_statements() if stmt.subject in handled]
+
+    def count_reachable_statements(self, root):
+        """Return (total statement count, reachable statement count)."""
+        handled = self.reachable_nodes(root)
+        count, reachable = 0, 0
+        for stmt in self.iter_all_statements():
+            count += 1
+            if stmt.subject in handled:
+                reachable += 1
+        return count, reachable
+
+    def prune_unreachable(self, root):
+        """Remove all statements whose subject is not reachable from root.
+
+        Returns a list of subjects whose statements were removed.
+        """
+        handled = self.reachable_nodes(root)
+        todelete = [stmt for stmt in self.iter_all_statements() if stmt.subject not in handled]
+        self.remove_statements_bulk(todelete)
+        return list(set([stmt.subject for stmt in todelete]))
+
     def sync(self):
         pass
 
+    def find_changed_subjects(self, generation):
+        """Return (current generation, subjects changed after generation).
+
+        The subject list is None if the changes are not known, e.g. because
+        generation is None or too old.  Stores which do not track changes
+        return (None, None).  May be called outside a transaction.
+        """
+        return None, None
+
     def begin_transaction(self):
         return Transaction(self)
 
@@ -812,6 +922,24 @@ class MemoryStore(Store):
             if template.matches(statement):
                 yield statement
 
+    def reachable_nodes(self, root):
+        assert self.data is not None, 'Store is not open'
+        # find_statements() is a full scan here, so build an adjacency map once
+        objects = {}
+        for statement in self.data:
+            if objects.has_key(statement.subject):
+                objects[statement.subject].append(statement.object)
+            else:
+                objects[statement.subject] = [statement.object]
+        handled = set([root])
+        queue = deque([root])
+        while len(queue):
+            for obj in objects.get(queue.popleft(), []):
+                if obj not in handled:
+                    handled.add(obj)
+                    queue.append(obj)
+        return handled
+
     def close(self):
         assert self.data is not None, 'Store is not open'
         del self.data
@@ -844,6 +972,10 @@ class SqlalchemyStore(Store):
     accessed_delete = accessed_table.delete()
     deferred_txn = object()
     active_txn = object()
+
+    # Maximum number of subjects per 'IN (...)' query; sqlite default
+    # limit for host parameters is 999.
+    max_query_subjects = 500
     
     def open(cls, dburi, *args, **kw):
         e = sqla.create_engine(dburi, *args, **kw)
@@ -926,6 +1058,61 @@ class SqlalchemyStore(Store):
         e = self.connection.execute(self._build_delete_statement(template))
         e.close()
 
+    def add_statements_bulk(self, statements):
+        self._maybe_begin_transaction()
+        rows = []
+        for statement in statements:
+            assert statement.concrete(), 'Statement must be concrete'
+            rows.append({'sub': self._node_to_str(statement.subject),
+                         'pre': self._node_to_str(statement.predicate),
+                         'obj': self._node_to_str(statement.object)})
+        if len(rows) == 0:
+            return
+        try:
+            e = self.connection.execute(self.statements_insert, rows)
+            e.close()
+        except sqla.exceptions.SQLError, e:
+            # Duplicates abort the batch; redo it row by row, ignoring duplicates
+            if 'unique' in str(e).lower():
+                for row in rows:
+                    try:
+                        e = self.connection.execute(self.statements_insert, **row)
+                        e.close()
+                    except sqla.exceptions.SQLError, e:
+                        if 'unique' not in str(e).lower():
+                            raise
+            else:
+                raise
+
+    def remove_statements_bulk(self, statements):
+        self._maybe_begin_transaction()
+        rows = []
+        for statement in statements:
+            assert statement.concrete(), 'Statement must be concrete'
+            rows.append({'sub': self._node_to_str(statement.subject),
+                         'pre': self._node_to_str(statement.predicate),
+                         'obj': self._node_to_str(statement.object)})
+        if len(rows) == 0:
+            return
+        e = self.connection.execute(self.statements_delete, rows)
+        e.close()
+
+    def find_statements_for_subjects(self, subjects, predicate=None):
+        self._maybe_begin_transaction()
+        sub_strs = [self._node_to_str(subject) for subject in subjects]
+        l = []
+        for i in xrange(0, len(sub_strs), self.max_query_subjects):
+            cond = self.statements_table.c.sub.in_(*sub_strs[i:i+self.max_query_subjects])
+            if predicate is not None:
+                cond = sqla.and_(cond, self.statements_table.c.pre == self._node_to_str(predicate))
+            e = self.connection.execute(self.statements_table.select(cond))
+            for v in e:
+                l.append(Statement(self._str_to_node(v.sub),
+                                   self._str_to_node(v.pre),
+                                   self._str_to_node(v.obj)))
+            e.close()
+        return l
+
     def count_statements(self, template):
         self._maybe_begin_transaction()
         count = 0
@@ -948,6 +1135,19 @@ class SqlalchemyStore(Store):
         e.close()
         return l
 
+    def iter_statements(self, template):
+        self._maybe_begin_transaction()  # not deferred to first next()
+        e = self.connection.execute(self.statements_select,
+                                    **self._build_match(template))
+        return self._iter_result(e)
+
+    def _iter_result(self, e):
+        for v in e:
+            yield Statement(self._str_to_node(v.sub),
+                            self._str_to_node(v.pre),
+                            self._str_to_node(v.obj))
+        e.close()
+
     def close(self, atexit=False):
         # XXX: debug, because this is common
         _log.debug('autoclosing Store (%s) in atexit' % self)
@@ -1070,13 +1270,48 @@ class SqlalchemyStore(Store):
                                     timestamp = datetime.datetime.utcnow())
         e.close()
 
+def _apsw_has_table(curs, name):
+    for v, in curs.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ?;", (name,)):
+        return v > 0
+    return False
+
 class ApswStore(Store):
     deferred_txn = object()
     active_txn = object()
 
+    # Secondary indexes for the statements table.  The UNIQUE (sub, pre, obj)
+    # constraint already provides an implicit SPO index; POS and OSP cover the
+    # templates which omit the subject (e.g. reverse lookups with toSubject).
+    # All indexes contain all three columns, so lookups never need to touch
+    # the table itself.
+    statement_indexes = (('statements_pos', 'pre, obj, sub'),
+                         ('statements_osp', 'obj, sub, pre'))
+
+    # Every committed write transaction increments the generation counter
+    # and records the subjects it touched in the changes table.  This allows
+    # subject caches (see ApswSubjectCachedStore) in other processes to
+    # invalidate exactly what changed.  Only this many generations of
+    # changes are kept; a cache older than that is flushed completely.
+    change_log_generations = 1000
+
+    # Store class to use for a dictionary encoded database, set below
+    encoded_store_class = None
+
+    # Maximum number of host parameters per 'IN (...)' query; sqlite
+    # default limit is 999.
+    max_query_ids = 500
+
     def open(cls, filename):
         c = apsw.Connection(filename)
-        return cls(c)
+        if _apsw_has_table(c.cursor(), 'nodes') and not issubclass(cls, ApswEncodedStore):
+            # dictionary encoded database, see ApswEncodedStore
+            cls = cls.encoded_store_class
+        store = cls(c)
+        store.ensure_indexes()
+        store.ensure_change_log()
+        if isinstance(store, ApswEncodedStore):
+            store.ensure_node_gc()
+        return store
     open = classmethod(open)
 
     def create(cls, filename):
@@ -1088,11 +1323,24 @@ class ApswStore(Store):
                           obj TEXT NOT NULL, 
 	                  UNIQUE (sub, pre, obj)
                         );""")
+        for name, columns in cls.statement_indexes:
+            curs.execute('CREATE INDEX %s ON statements (%s);' % (name, columns))
+        cls._create_change_log(curs)
         curs = None
         return cls(c)
 
     create = classmethod(create)
 
+    def _create_change_log(cls, curs):
+        curs.execute('CREATE TABLE generation (value INTEGER NOT NULL);')
+        curs.execute('INSERT INTO generation (value) VALUES (0);')
+        curs.execute("""CREATE TABLE changes (
+                          generation INTEGER NOT NULL,
+                          sub TEXT NOT NULL
+                        );""")
+        curs.execute('CREATE INDEX changes_generation ON changes (generation);')
+    _create_change_log = classmethod(_create_change_log)
+
     def delete(cls, filename):
         raise NotImplemented()
     delete = classmethod(delete)
@@ -1105,6 +1353,8 @@ class ApswStore(Store):
         self.txn = None
         self.txn_begin_time = None
         self.txn_wait_time = None
+        self.txn_changed = set()
+        self.track_changes = _apsw_has_table(self.cursor, 'generation')
         ## Enable the lines below to allow tracing of actual SQL executed
         #def mytrace(statement, bindings):
         #    "Called just before executing each statement"
@@ -1117,9 +1367,11 @@ class ApswStore(Store):
     def add_statement(self, statement):
         assert statement.concrete(), 'Statement must be concrete'
         self._maybe_begin_transaction()
-        self.cursor.execute('INSERT OR IGNORE INTO statements (sub, pre, obj) VALUES (?, ?, ?);', (self._node_to_str(statement.subject),
+        sub_str = self._node_to_str(statement.subject)
+        self.cursor.execute('INSERT OR IGNORE INTO statements (sub, pre, obj) VALUES (?, ?, ?);', (sub_str,
                                                                                                    self._node_to_str(statement.predicate),
                                                                                                    self._node_to_str(statement.object)))
+        self._note_changed([sub_str])
 
     def contains_statement(self, statement):
         assert statement.concrete(), 'Statement must be concrete'
@@ -1134,13 +1386,20 @@ class ApswStore(Store):
     def remove_statement(self, statement):
         assert statement.concrete(), 'Statement must be concrete'
         self._maybe_begin_transaction()
-        self.cursor.execute('DELETE FROM statements WHERE sub = ? AND pre = ? AND obj = ?', (self._node_to_str(statement.subject),
+        sub_str = self._node_to_str(statement.subject)
+        self.cursor.execute('DELETE FROM statements WHERE sub = ? AND pre = ? AND obj = ?', (sub_str,
                                                                                              self._node_to_str(statement.predicate),
                                                                                              self._node_to_str(statement.object)))
+        self._note_changed([sub_str])
 
     def remove_statements(self, template):
         self._maybe_begin_transaction()
         where, args = self._build_match(template)
+        if self.track_changes:
+            if template.subject is not None:
+                self._note_changed([self._node_to_str(template.subject)])
+            else:
+                self._note_changed([sub for sub, in self.cursor.execute('SELECT DISTINCT sub FROM statements%s' % where, args)])
         self.cursor.execute('DELETE FROM statements%s' % where, args)
 
     def count_statements(self, template):
@@ -1160,6 +1419,347 @@ class ApswStore(Store):
                                self._str_to_node(obj)))
         return l
 
+    def iter_statements(self, template):
+        self._maybe_begin_transaction()  # not deferred to first next()
+        where, args = self._build_match(template)
+        # separate cursor, self.cursor may be used while the iterator is alive
+        curs = self.connection.cursor()
+        return self._iter_rows(curs.execute('SELECT sub, pre, obj FROM statements%s' % where, args))
+
+    def _iter_rows(self, rows):
+        for sub, pre, obj in rows:
+            yield Statement(self._str_to_node(sub),
+                            self._str_to_node(pre),
+                            self._str_to_node(obj))
+
+    def add_statements_bulk(self, statements):
+        self._maybe_begin_transaction()
+        rows = []
+        for statement in statements:
+            assert statement.concrete(), 'Statement must be concrete'
+            rows.append((self._node_to_str(statement.subject),
+                         self._node_to_str(statement.predicate),
+                         self._node_to_str(statement.object)))
+        if len(rows) == 0:
+            return
+        self.cursor.executemany('INSERT OR IGNORE INTO statements (sub, pre, obj) VALUES (?, ?, ?);', rows)
+        self._note_changed(set([row[0] for row in rows]))
+
+    def remove_statements_bulk(self, statements):
+        self._maybe_begin_transaction()
+        rows = []
+        for statement in statements:
+            assert statement.concrete(), 'Statement must be concrete'
+            rows.append((self._node_to_str(statement.subject),
+                         self._node_to_str(statement.predicate),
+                         self._node_to_str(statement.object)))
+        if len(rows) == 0:
+            return
+        self.cursor.executemany('DELETE FROM statements WHERE sub = ? AND pre = ? AND obj = ?;', rows)
+        self._note_changed(set([row[0] for row in rows]))
+
+    def find_statements_for_subjects(self, subjects, predicate=None):
+        self._maybe_begin_transaction()
+        sub_strs = [self._node_to_str(subject) for subject in subjects]
+        pre_args = ()
+        pre_where = ''
+        if predicate is not None:
+            pre_args = (self._node_to_str(predicate),)
+            pre_where = ' AND pre = ?'
+        l = []
+        for i in xrange(0, len(sub_strs), self.max_query_ids):
+            args = sub_strs[i:i+self.max_query_ids]
+            q = 'SELECT sub, pre, obj FROM statements WHERE sub IN (%s)%s;' % (', '.join(['?'] * len(args)), pre_where)
+            for sub, pre, obj in self.cursor.execute(q, tuple(args) + pre_args):
+                l.append(Statement(self._str_to_node(sub),
+                                   self._str_to_node(pre),
+                                   self._str_to_node(obj)))
+        return l
+
+    # Reachability is computed inside sqlite by expanding a frontier in
+    # temporary tables, one breadth-first level per round; the bundled
+    # sqlite does not support recursive queries.  Only the final node set
+    # (tinyrdf_reach) is used by the callers.
+
+    def _build_reachable(self, root):
+        s, p, o = self.statement_columns
+        for name in ('tinyrdf_reach', 'tinyrdf_frontier', 'tinyrdf_next'):
+            self.cursor.execute('CREATE TEMP TABLE %s (node %s PRIMARY KEY);' % (name, self.node_key_type))
+        key = self._node_key(root)
+        if key is None:
+            return  # root not in database, nothing reachable
+        self.cursor.execute('INSERT INTO tinyrdf_reach (node) VALUES (?);', (key,))
+        self.cursor.execute('INSERT INTO tinyrdf_frontier (node) VALUES (?);', (key,))
+        while True:
+            self.cursor.execute('INSERT OR IGNORE INTO tinyrdf_next (node) SELECT %s FROM statements WHERE %s IN (SELECT node FROM tinyrdf_frontier) AND %s NOT IN (SELECT node FROM tinyrdf_reach)%s;' % (o, s, o, self.reachable_object_filter))
+            for count, in self.cursor.execute('SELECT count(*) FROM tinyrdf_next;'):
+                break
+            if count == 0:
+                break
+            self.cursor.execute('INSERT INTO tinyrdf_reach (node) SELECT node FROM tinyrdf_next;')
+            self.cursor.execute('DELETE FROM tinyrdf_frontier;')
+            self.cursor.execute('INSERT INTO tinyrdf_frontier (node) SELECT node FROM tinyrdf_next;')
+            self.cursor.execute('DELETE FROM tinyrdf_next;')
+
+    def _drop_reachable(self):
+        for name in ('tinyrdf_reach', 'tinyrdf_frontier', 'tinyrdf_next'):
+            try:
+                self.cursor.execute('DROP TABLE %s;' % name)
+            except apsw.SQLError:
+                pass
+
+    def reachable_nodes(self, root):
+        self._maybe_begin_transaction()
+        try:
+            self._build_reachable(root)
+            res = set(self._keys_to_nodes([key for key, in self.cursor.execute('SELECT node FROM tinyrdf_reach;')]))
+        finally:
+            self._drop_reachable()
+        res.add(root)
+        return res
+
+    def find_reachable_statements(self, root):
+        self._maybe_begin_transaction()
+        s, p, o = self.statement_columns
+        try:
+            self._build_reachable(root)
+            rows = list(self.cursor.execute('SELECT %s, %s, %s FROM statements WHERE %s IN (SELECT node FROM tinyrdf_reach);' % (s, p, o, s)))
+        finally:
+            self._drop_reachable()
+        return self._rows_to_statements(rows)
+
+    def count_reachable_statements(self, root):
+        self._maybe_begin_transaction()
+        s, p, o = self.statement_columns
+        try:
+            self._build_reachable(root)
+            for count, in self.cursor.execute('SELECT count(*) FROM statements;'):
+                break
+            for reachable, in self.cursor.execute('SELECT count(*) FROM statements WHERE %s IN (SELECT node FROM tinyrdf_reach);' % s):
+                break
+        finally:
+            self._drop_reachable()
+        return count, reachable
+
+    def prune_unreachable(self, root):
+        self._maybe_begin_transaction()
+        s, p, o = self.statement_columns
+        try:
+            self._build_reachable(root)
+            keys = [key for key, in self.cursor.execute('SELECT DISTINCT %s FROM statements WHERE %s NOT IN (SELECT node FROM tinyrdf_reach);' % (s, s))]
+            subjects = self._keys_to_nodes(keys)
+            if len(keys) > 0:
+                self.cursor.execute('DELETE FROM statements WHERE %s NOT IN (SELECT node FROM tinyrdf_reach);' % s)
+        finally:
+            self._drop_reachable()
+        self._note_changed([self._node_to_str(subject) for subject in subjects])
+        return subjects
+
+    # Schema hooks for the helpers above, see ApswEncodedStore
+    statement_columns = ('sub', 'pre', 'obj')
+    node_key_type = 'TEXT'
+    reachable_object_filter = " AND substr(obj, 1, 1) IN ('U', 'B')"  # literals cannot be subjects
+
+    def _node_key(self, node):
+        return self._node_to_str(node)
+
+    def _keys_to_nodes(self, keys):
+        return [self._str_to_node(key) for key in keys]
+
+    def _rows_to_statements(self, rows):
+        return [Statement(self._str_to_node(sub),
+                          self._str_to_node(pre),
+                          self._str_to_node(obj)) for sub, pre, obj in rows]
+
+    def _get_missing_indexes(self):
+        existing = set()
+        for name, in self.cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'statements';"):
+            existing.add(name)
+        return [(name, columns) for name, columns in self.statement_indexes if name not in existing]
+
+    def ensure_indexes(self):
+        """Add missing secondary indexes to an existing database.
+
+        Databases created before the secondary indexes were introduced
+        only have the UNIQUE (sub, pre, obj) index.  The missing indexes
+        are created (and statistics refreshed with ANALYZE) inside an
+        exclusive transaction, so concurrent openers do not race.
+
+        Returns a list of index names which were created.
+        """
+        assert self.txn is None, 'ensure_indexes called with a transaction active'
+
+        if len(self._get_missing_indexes()) == 0:
+            return []
+
+        created = []
+        self.cursor.execute('BEGIN EXCLUSIVE;')
+        try:
+            # re-check under the lock, another process may have beaten us to it
+            for name, columns in self._get_missing_indexes():
+                _log.info('creating missing index %s (%s) for statements table' % (name, columns))
+                self.cursor.execute('CREATE INDEX %s ON statements (%s);' % (name, columns))
+                created.append(name)
+            if len(created) > 0:
+                self.cursor.execute('ANALYZE statements;')
+        except:
+            self.cursor.execute('ROLLBACK;')
+            raise
+        self.cursor.execute('COMMIT;')
+        return created
+
+    def ensure_change_log(self):
+        """Add the generation counter and change log tables if missing."""
+        assert self.txn is None, 'ensure_change_log called with a transaction active'
+
+        if self.track_changes:
+            return False
+
+        self.cursor.execute('BEGIN EXCLUSIVE;')
+        try:
+            if not _apsw_has_table(self.cursor, 'generation'):
+                _log.info('creating change log tables')
+                self._create_change_log(self.cursor)
+        except:
+            self.cursor.execute('ROLLBACK;')
+            raise
+        self.cursor.execute('COMMIT;')
+        self.track_changes = True
+        return True
+
+    def get_generation(self):
+        """Return current change generation of the database (None if not tracked)."""
+        if not self.track_changes:
+            return None
+        self._maybe_begin_transaction()
+        for v, in self.cursor.execute('SELECT value FROM generation;'):
+            return v
+        raise ValueError('Internal error in apsw store.')
+
+    def find_changed_subjects(self, generation):
+        if not self.track_changes:
+            return None, None
+        if self.txn is None:
+            # shared lock only, writers are not blocked for long
+            self.cursor.execute('BEGIN;')
+            try:
+                gen, sub_strs = self._find_changed_sub_strs(generation)
+            finally:
+                self.cursor.execute('COMMIT;')
+        else:
+            self._maybe_begin_transaction()
+            gen, sub_strs = self._find_changed_sub_strs(generation)
+        if sub_strs is None:
+            return gen, None
+        return gen, [self._str_to_node(sub_str) for sub_str in sub_strs]
+
+    def _find_changed_sub_strs(self, generation):
+        for gen, in self.cursor.execute('SELECT value FROM generation;'):
+            break
+        if generation is None or gen < generation:
+            return gen, None
+        if gen == generation:
+            return gen, []
+        oldest = None
+        for oldest, in self.cursor.execute('SELECT min(generation) FROM changes;'):
+            break
+        if oldest is None or oldest > generation + 1:
+            return gen, None
+        return gen, [sub_str for sub_str, in self.cursor.execute('SELECT DISTINCT sub FROM changes WHERE generation > ?;', (generation,))]
+
+    def _note_changed(self, sub_strs):
+        """Record subjects (in _node_to_str form) modified by a write."""
+        if not self.track_changes:
+            return
+        if self.txn is self.active_txn:
+            self.txn_changed.update(sub_strs)
+        else:
+            # XXX: write outside a transaction; logged as a generation of its
+            # own, but not atomically with the write itself
+            try:
+                self._log_changes(sub_strs)
+            except:
+                _log.exception('failed to update change log (store %s)' % self)
+                self._invalidate_change_log()
+
+    def _log_changes(self, sub_strs):
+        sub_strs = list(sub_strs)
+        if len(sub_strs) == 0:
+            return None
+        self.cursor.execute('UPDATE generation SET value = value + 1;')
+        for gen, in self.cursor.execute('SELECT value FROM generation;'):
+            break
+        for sub_str in sub_strs:
+            self.cursor.execute('INSERT INTO changes (generation, sub) VALUES (?, ?);', (gen, sub_str))
+        self.cursor.execute('DELETE FROM changes WHERE generation <= ?;', (gen - self.change_log_generations,))
+        return gen
+
+    def _invalidate_change_log(self):
+        """Make every reader of the change log do a full invalidation.
+
+        Used when logging changes fails partway: a bumped generation with an
+        incomplete subject list would leave other processes with stale
+        caches.  An empty change log does not reach any earlier generation,
+        so find_changed_subjects() returns None for all of them.
+        """
+        self.cursor.execute('UPDATE generation SET value = value + 1;')
+        self.cursor.execute('DELETE FROM changes;')
+
+    def _changes_committed(self, generation):
+        """Called when a transaction which made changes is about to commit.
+
+        Subclasses may override; generation is the new change generation.
+        """
+        pass
+
+    def analyze(self):
+        """Refresh query planner statistics for the statements table."""
+        self._maybe_begin_transaction()
+        self.cursor.execute('ANALYZE statements;')
+
+    def check_query_plans(self, analyze=True):
+        """Check that all template forms are answered using an index.
+
+        Runs EXPLAIN QUERY PLAN for each of the query forms generated by
+        _build_match() (except the unrestricted one, which is a scan by
+        definition) and returns a list of (where, plan, indexed) tuples.
+        A warning is logged for every form resulting in a full table scan.
+        If analyze is True, ANALYZE is run first so that the plans reflect
+        the current data.
+        """
+        if analyze:
+            self.analyze()
+        else:
+            self._maybe_begin_transaction()
+
+        res = []
+        for sub in (False, True):
+            for pre in (False, True):
+                for obj in (False, True):
+                    if not (sub or pre or obj):
+                        continue
+                    where, args = self._build_plan_check_match(sub, pre, obj)
+                    plan = []
+                    indexed = True
+                    for row in self.cursor.execute('EXPLAIN QUERY PLAN SELECT * FROM statements%s' % where, args):
+                        # Older sqlite: 'TABLE statements WITH INDEX foo' vs. 'TABLE statements',
+                        # newer sqlite: 'SEARCH statements USING INDEX foo' vs. 'SCAN statements'
+                        detail = unicode(row[-1])
+                        if detail.upper().startswith('SCAN') or 'INDEX' not in detail.upper():
+                            indexed = False
+                        plan.append(detail)
+                    plan = u'; '.join(plan)
+                    if not indexed:
+                        _log.warning('query plan for%s is a full table scan: %s' % (where, plan))
+                    res.append((where, plan, indexed))
+        return res
+
+    def _build_plan_check_match(self, sub, pre, obj):
+        dummy = Uri(u'urn:tinyrdf:plancheck')
+        return self._build_match(Statement((sub and dummy) or None,
+                                           (pre and dummy) or None,
+                                           (obj and dummy) or None))
+
     def _do_begin_transaction(self):
         super(ApswStore, self)._do_begin_transaction()
         assert self.txn is None, 'txn must be None in _do_begin_transaction, transaction nesting error?'
@@ -1187,6 +1787,25 @@ class ApswStore(Store):
         super(ApswStore, self)._do_commit_transaction()
         assert self.txn is self.active_txn or self.txn is self.deferred_txn, 'Commit transaction called when no transaction active'
         if self.txn is self.active_txn:
+            changed, self.txn_changed = self.txn_changed, set()
+            if len(changed) > 0:
+                try:
+                    self._changes_committed(self._log_changes(changed))
+                except:
+                    # data is more important than caches, so commit anyway,
+                    # but make all caches start over; if even that fails,
+                    # the data cannot be committed consistently
+                    _log.exception('failed to update change log (store %s)' % self)
+                    try:
+                        self._invalidate_change_log()
+                    except:
+                        _log.exception('failed to invalidate change log (store %s), rolling back' % self)
+                        # undo the commit bookkeeping so that subclass
+                        # rollback handling (node and subject caches) runs
+                        self.txn_changed = changed
+                        self.txn_active = True
+                        self._do_rollback_transaction()
+                        raise
             try:
                 _log.debug('committing sqlite transaction (store %s)' % self)
                 self.cursor.execute('COMMIT;')
@@ -1199,6 +1818,7 @@ class ApswStore(Store):
     def _do_rollback_transaction(self):
         super(ApswStore, self)._do_rollback_transaction()
         assert self.txn is self.active_txn or self.txn is self.deferred_txn, 'Rollback transaction called when no transaction active'
+        self.txn_changed = set()
         if self.txn is self.active_txn:
             try:
                 _log.debug('rolling back sqlite transaction (store %s)' % self)
@@ -1251,6 +1871,10 @@ class ApswStore(Store):
         if self.txn is self.deferred_txn:
             self._do_begin_transaction_harder()
 
+    # for wrappers which delegate to the store proper, so that per-operation
+    # checks of subclasses (see ApswEncodedStore) are done only once
+    _begin_deferred_transaction = _maybe_begin_transaction
+
     def _build_match(self, template):
         if template.subject is None:
             if template.predicate is None:
@@ -1284,6 +1908,802 @@ class ApswStore(Store):
                     args = (self._node_to_str(template.subject), self._node_to_str(template.predicate), self._node_to_str(template.object))
         return (stmt, args)
 
+class ApswEncodedStore(ApswStore):
+    """Dictionary encoded apsw store.
+
+    Instead of storing the text form of every node in every statement,
+    each distinct node is interned once into a nodes table and the
+    statements table only contains integer node ids.  This makes the
+    database smaller and comparisons cheaper, and allows an in-process
+    id <-> node cache, so that find_statements() returns shared node
+    objects instead of allocating new ones for every row.
+
+    The node kind uses the same letters as the text encoding of
+    ApswStore (U, B, P, L, D); lang and datatype are empty strings when
+    not applicable so that the unique index on nodes works.
+
+    Nodes which no statement refers to any more (e.g. old values of
+    status literals) are garbage collected by gc_nodes(), which runs
+    after prune_unreachable() and automatically after every
+    node_gc_interval statement removals.  The node with the highest id
+    is never collected, so sqlite never hands out a collected id again
+    and the id -> node cache stays valid.  The node -> id cache does
+    not, so every collection increments a counter in the node_gc table,
+    and a store which sees the counter change (at transaction begin, or
+    on every lookup outside transactions) throws its cache away.  Ids
+    of nodes inserted inside a transaction which is rolled back are
+    dropped from the cache, because sqlite may hand them out again.
+
+    An existing text schema database can be converted in place with
+    convert().  ApswStore.open() detects the schema automatically.
+    """
+
+    statement_indexes = (('statements_pos', 'p, o, s'),
+                         ('statements_osp', 'o, s, p'))
+
+    # When the cache grows beyond this, it is simply thrown away and
+    # refilled on demand.
+    node_cache_size = 50000
+
+    # Collect unreferenced nodes after this many statement removals.
+    node_gc_interval = 10000
+
+    def create(cls, filename):
+        c = apsw.Connection(filename)
+        curs = c.cursor()
+        cls._create_schema(curs)
+        cls._create_change_log(curs)
+        curs = None
+        return cls(c)
+    create = classmethod(create)
+
+    def _create_schema(cls, curs):
+        curs.execute("""CREATE TABLE nodes (
+                          id INTEGER PRIMARY KEY,
+                          kind TEXT NOT NULL,
+                          value TEXT NOT NULL,
+                          lang TEXT NOT NULL,
+                          datatype TEXT NOT NULL
+                        );""")
+        curs.execute('CREATE UNIQUE INDEX nodes_value ON nodes (value, kind, lang, datatype);')
+        curs.execute("""CREATE TABLE statements (
+                          s INTEGER NOT NULL,
+                          p INTEGER NOT NULL,
+                          o INTEGER NOT NULL,
+                          UNIQUE (s, p, o)
+                        );""")
+        for name, columns in cls.statement_indexes:
+            curs.execute('CREATE INDEX %s ON statements (%s);' % (name, columns))
+        cls._create_node_gc(curs)
+    _create_schema = classmethod(_create_schema)
+
+    def _create_node_gc(cls, curs):
+        curs.execute('CREATE TABLE node_gc (value INTEGER NOT NULL);')
+        curs.execute('INSERT INTO node_gc (value) VALUES (0);')
+    _create_node_gc = classmethod(_create_node_gc)
+
+    def convert(cls, filename):
+        """Convert a text schema database (see ApswStore) in place.
+
+        The conversion is done inside a single exclusive transaction, so
+        other processes either see the old or the new schema.  Converting
+        an already converted database is a no-op.  Returns an open store.
+        """
+        c = apsw.Connection(filename)
+        store = cls(c)
+        store._convert_from_text()
+        store.ensure_indexes()
+        store.ensure_node_gc()
+        return store
+    convert = classmethod(convert)
+
+    def __init__(self, c):
+        super(ApswEncodedStore, self).__init__(c)
+        self.node_ids = {}    # node -> id
+        self.id_nodes = {}    # id -> node
+        self.pending_nodes = []
+        self.node_gc_epoch = None
+        self.removals_since_gc = 0
+
+    def ensure_node_gc(self):
+        """Add the node garbage collection counter table if missing."""
+        assert self.txn is None, 'ensure_node_gc called with a transaction active'
+
+        if _apsw_has_table(self.cursor, 'node_gc'):
+            return False
+
+        self.cursor.execute('BEGIN EXCLUSIVE;')
+        try:
+            if not _apsw_has_table(self.cursor, 'node_gc'):
+                _log.info('creating node garbage collection table')
+                self._create_node_gc(self.cursor)
+        except:
+            self.cursor.execute('ROLLBACK;')
+            raise
+        self.cursor.execute('COMMIT;')
+        return True
+
+    def _check_node_gc_epoch(self):
+        for epoch, in self.cursor.execute('SELECT value FROM node_gc;'):
+            break
+        if epoch != self.node_gc_epoch:
+            # another store (or an earlier transaction) collected nodes,
+            # cached node -> id mappings may be gone
+            self._clear_node_cache()
+            self.node_gc_epoch = epoch
+
+    def gc_nodes(self):
+        """Delete nodes which no statement refers to; returns their number."""
+        self._maybe_begin_transaction()
+        self.removals_since_gc = 0
+        where = """ WHERE id < (SELECT max(id) FROM nodes)
+                     AND NOT EXISTS (SELECT 1 FROM statements WHERE s = nodes.id)
+                     AND NOT EXISTS (SELECT 1 FROM statements WHERE p = nodes.id)
+                     AND NOT EXISTS (SELECT 1 FROM statements WHERE o = nodes.id);"""
+        for count, in self.cursor.execute('SELECT count(*) FROM nodes' + where):
+            break
+        if count == 0:
+            return 0
+        self.cursor.execute('DELETE FROM nodes' + where)
+        self.cursor.execute('UPDATE node_gc SET value = value + 1;')
+        self._clear_node_cache()
+        for self.node_gc_epoch, in self.cursor.execute('SELECT value FROM node_gc;'):
+            break
+        _log.debug('collected %d unreferenced nodes (store %s)' % (count, self))
+        return count
+
+    def _note_removals(self, count):
+        self.removals_since_gc += count
+
+    def prune_unreachable(self, root):
+        subjects = super(ApswEncodedStore, self).prune_unreachable(root)
+        self.gc_nodes()
+        return subjects
+
+    def _convert_from_text(self):
+        assert self.txn is None, '_convert_from_text called with a transaction active'
+
+        self.cursor.execute('BEGIN EXCLUSIVE;')
+        try:
+            if not _apsw_has_table(self.cursor, 'nodes'):
+                rows = list(self.cursor.execute('SELECT sub, pre, obj FROM statements;'))
+                _log.info('converting %d statements to dictionary encoded schema' % len(rows))
+                self.cursor.execute('DROP TABLE statements;')
+                self._create_schema(self.cursor)
+                for sub, pre, obj in rows:
+                    self.cursor.execute('INSERT OR IGNORE INTO statements (s, p, o) VALUES (?, ?, ?);',
+                                        (self._node_to_id(self._str_to_node(sub), create=True),
+                                         self._node_to_id(self._str_to_node(pre), create=True),
+                                         self._node_to_id(self._str_to_node(obj), create=True)))
+                self.cursor.execute('ANALYZE;')
+                if self.track_changes:
+                    # everything changed, make other processes flush their caches
+                    self.cursor.execute('UPDATE generation SET value = value + 1;')
+                    self.cursor.execute('DELETE FROM changes;')
+        except:
+            self.cursor.execute('ROLLBACK;')
+            self._clear_node_cache()
+            raise
+        self.cursor.execute('COMMIT;')
+
+    def add_statement(self, statement):
+        assert statement.concrete(), 'Statement must be concrete'
+        self._maybe_begin_transaction()
+        self.cursor.execute('INSERT OR IGNORE INTO statements (s, p, o) VALUES (?, ?, ?);', (self._node_to_id(statement.subject, create=True),
+                                                                                             self._node_to_id(statement.predicate, create=True),
+                                                                                             self._node_to_id(statement.object, create=True)))
+        self._note_changed([self._node_to_str(statement.subject)])
+
+    def contains_statement(self, statement):
+        assert statement.concrete(), 'Statement must be concrete'
+        self._maybe_begin_transaction()
+        where, args = self._build_match(statement)
+        if where is None:
+            return False
+        found = False
+        for v in self.cursor.execute('SELECT s FROM statements%s' % where, args):
+            found = True
+        return found
+
+    def remove_statement(self, statement):
+        assert statement.concrete(), 'Statement must be concrete'
+        self.remove_statements(statement)
+
+    def remove_statements(self, template):
+        self._maybe_begin_transaction()
+        where, args = self._build_match(template)
+        if where is None:
+            return
+        if self.track_changes:
+            if template.subject is not None:
+                self._note_changed([self._node_to_str(template.subject)])
+            else:
+                rows = [(s,) for s, in self.cursor.execute('SELECT DISTINCT s FROM statements%s' % where, args)]
+                nodes = self._ids_to_nodes(rows)
+                self._note_changed([self._node_to_str(nodes[s]) for s, in rows])
+        self.cursor.execute('DELETE FROM statements%s' % where, args)
+        self._note_removals(1)  # at least; counting would cost a query
+
+    def count_statements(self, template):
+        self._maybe_begin_transaction()
+        where, args = self._build_match(template)
+        if where is None:
+            return 0
+        for v, in self.cursor.execute('SELECT count(*) FROM statements%s' % where, args):
+            return v
+        raise ValueError('Internal error in apsw store.')
+
+    def find_statements(self, template):
+        self._maybe_begin_transaction()
+        where, args = self._build_match(template)
+        if where is None:
+            return []
+        rows = list(self.cursor.execute('SELECT s, p, o FROM statements%s' % where, args))
+        nodes = self._ids_to_nodes(rows)
+        return [Statement(nodes[s], nodes[p], nodes[o]) for s, p, o in rows]
+
+    def iter_statements(self, template):
+        self._maybe_begin_transaction()  # not deferred to first next()
+        where, args = self._build_match(template)
+        if where is None:
+            return iter([])
+        curs = self.connection.cursor()
+        return self._iter_rows(curs.execute('SELECT s, p, o FROM statements%s' % where, args))
+
+    def _iter_rows(self, rows):
+        # map ids in batches, so that missing nodes are fetched with few queries
+        while True:
+            batch = list(itertools.islice(rows, self.max_query_ids))
+            if len(batch) == 0:
+                break
+            nodes = self._ids_to_nodes(batch)
+            for s, p, o in batch:
+                yield Statement(nodes[s], nodes[p], nodes[o])
+
+    def add_statements_bulk(self, statements):
+        self._maybe_begin_transaction()
+        rows = []
+        subjects = set()
+        for statement in statements:
+            assert statement.concrete(), 'Statement must be concrete'
+            rows.append((self._node_to_id(statement.subject, create=True),
+                         self._node_to_id(statement.predicate, create=True),
+                         self._node_to_id(statement.object, create=True)))
+            subjects.add(statement.subject)
+        if len(rows) == 0:
+            return
+        self.cursor.executemany('INSERT OR IGNORE INTO statements (s, p, o) VALUES (?, ?, ?);', rows)
+        self._note_changed([self._node_to_str(subject) for subject in subjects])
+
+    def remove_statements_bulk(self, statements):
+        self._maybe_begin_transaction()
+        rows = []
+        subjects = set()
+        for statement in statements:
+            assert statement.concrete(), 'Statement must be concrete'
+            row = (self._node_to_id(statement.subject),
+                   self._node_to_id(statement.predicate),
+                   self._node_to_id(statement.object))
+            if None in row:
+                continue  # unknown node, cannot be in the database
+            rows.append(row)
+            subjects.add(statement.subject)
+        if len(rows) == 0:
+            return
+        self.cursor.executemany('DELETE FROM statements WHERE s = ? AND p = ? AND o = ?;', rows)
+        self._note_changed([self._node_to_str(subject) for subject in subjects])
+        self._note_removals(len(rows))
+
+    def find_statements_for_subjects(self, subjects, predicate=None):
+        self._maybe_begin_transaction()
+        ids = []
+        for subject in subjects:
+            id = self._node_to_id(subject)
+            if id is not None:
+                ids.append(id)
+        pre_args = ()
+        pre_where = ''
+        if predicate is not None:
+            pre_id = self._node_to_id(predicate)
+            if pre_id is None:
+                return []
+            pre_args = (pre_id,)
+            pre_where = ' AND p = ?'
+        rows = []
+        for i in xrange(0, len(ids), self.max_query_ids):
+            args = ids[i:i+self.max_query_ids]
+            q = 'SELECT s, p, o FROM statements WHERE s IN (%s)%s;' % (', '.join(['?'] * len(args)), pre_where)
+            rows.extend(self.cursor.execute(q, tuple(args) + pre_args))
+        nodes = self._ids_to_nodes(rows)
+        return [Statement(nodes[s], nodes[p], nodes[o]) for s, p, o in rows]
+
+    statement_columns = ('s', 'p', 'o')
+    node_key_type = 'INTEGER'
+    reachable_object_filter = ''
+
+    def _node_key(self, node):
+        return self._node_to_id(node)
+
+    def _keys_to_nodes(self, keys):
+        nodes = self._ids_to_nodes([(key,) for key in keys])
+        return [nodes[key] for key in keys]
+
+    def _rows_to_statements(self, rows):
+        nodes = self._ids_to_nodes(rows)
+        return [Statement(nodes[s], nodes[p], nodes[o]) for s, p, o in rows]
+
+    def _maybe_begin_transaction(self):
+        if self.txn is None:
+            # each operation stands on its own, nodes may have been
+            # collected since the previous one
+            self._check_node_gc_epoch()
+        else:
+            super(ApswEncodedStore, self)._maybe_begin_transaction()
+
+    def _do_begin_transaction_harder(self):
+        super(ApswEncodedStore, self)._do_begin_transaction_harder()
+        self._check_node_gc_epoch()
+
+    def _do_commit_transaction(self):
+        if self.txn is self.active_txn and self.removals_since_gc >= self.node_gc_interval:
+            try:
+                self.gc_nodes()
+            except:
+                # nodes are only garbage, the data must still be committed
+                _log.exception('node garbage collection failed (store %s)' % self)
+        super(ApswEncodedStore, self)._do_commit_transaction()
+        self.pending_nodes = []
+
+    def _do_rollback_transaction(self):
+        super(ApswEncodedStore, self)._do_rollback_transaction()
+        for node in self.pending_nodes:
+            self.id_nodes.pop(self.node_ids.pop(node, None), None)
+        self.pending_nodes = []
+
+    def _clear_node_cache(self):
+        self.node_ids = {}
+        self.id_nodes = {}
+        self.pending_nodes = []
+
+    def _cache_node(self, id, node):
+        if len(self.node_ids) >= self.node_cache_size:
+            # pending nodes are also forgotten, which is fine: not cached, nothing to undo
+            self._clear_node_cache()
+        self.node_ids[node] = id
+        self.id_nodes[id] = node
+
+    def _node_to_row(self, node):
+        if isinstance(node, Uri):
+            return u'U', node.uri, u'', u''
+        elif isinstance(node, Blank):
+            return u'B', node.identifier, u'', u''
+        elif isinstance(node, Literal):
+            if node.language is not None:
+                return u'L', node.value, node.language, u''
+            elif node.datatype is not None:
+                return u'D', node.value, u'', node.datatype
+            else:
+                return u'P', node.value, u'', u''
+        else:
+            raise ValueError('Internal error in apsw encoded store.')
+
+    def _row_to_node(self, kind, value, lang, datatype):
+        if kind == u'U':
+            return Uri(value)
+        elif kind == u'B':
+            return Blank(value)
+        elif kind == u'L':
+            return Literal(value=value, language=lang)
+        elif kind == u'D':
+            return Literal(value=value, datatype=datatype)
+        elif kind == u'P':
+            return Literal(value=value)
+        else:
+            raise ValueError('Internal error in apsw encoded store.')
+
+    def _node_to_id(self, node, create=False):
+        """Map node to id; returns None if node is unknown and create is False."""
+        try:
+            return self.node_ids[node]
+        except KeyError:
+            pass
+
+        row = self._node_to_row(node)
+        for id, in self.cursor.execute('SELECT id FROM nodes WHERE value = ? AND kind = ? AND lang = ? AND datatype = ?;', (row[1], row[0], row[2], row[3])):
+            self._cache_node(id, node)
+            return id
+        if not create:
+            return None
+
+        self.cursor.execute('INSERT INTO nodes (kind, value, lang, datatype) VALUES (?, ?, ?, ?);', row)
+        id = self.connection.last_insert_rowid()
+        self._cache_node(id, node)
+        if self.txn is self.active_txn:
+            self.pending_nodes.append(node)
+        return id
+
+    def _ids_to_nodes(self, rows):
+        """Map all ids in statement rows to nodes, returns an id -> node dict."""
+        res = {}
+        missing = set()
+        for row in rows:
+            for id in row:
+                if id in res:
+                    continue
+                node = self.id_nodes.get(id)
+                if node is None:
+                    missing.add(id)
+                else:
+                    res[id] = node
+
+        missing = list(missing)
+        for i in xrange(0, len(missing), self.max_query_ids):
+            ids = missing[i:i+self.max_query_ids]
+            q = 'SELECT id, kind, value, lang, datatype FROM nodes WHERE id IN (%s);' % ', '.join(['?'] * len(ids))
+            for id, kind, value, lang, datatype in self.cursor.execute(q, ids):
+                node = self._row_to_node(kind, value, lang, datatype)
+                self._cache_node(id, node)
+                res[id] = node
+        return res
+
+    def _build_id_match(self, s, p, o):
+        l, args = [], []
+        for col, id in (('s', s), ('p', p), ('o', o)):
+            if id is not None:
+                l.append('%s = ?' % col)
+                args.append(id)
+        if len(l) == 0:
+            return ';', ()
+        return ' WHERE %s;' % ' AND '.join(l), tuple(args)
+
+    def _build_match(self, template):
+        """Like ApswStore._build_match(), but returns (None, None) if the
+        template refers to a node not present in the database (and thus
+        cannot match anything)."""
+        ids = []
+        for node in (template.subject, template.predicate, template.object):
+            if node is None:
+                ids.append(None)
+            else:
+                id = self._node_to_id(node)
+                if id is None:
+                    return None, None
+                ids.append(id)
+        return self._build_id_match(*ids)
+
+    def _build_plan_check_match(self, sub, pre, obj):
+        return self._build_id_match((sub and -1) or None,
+                                    (pre and -1) or None,
+                                    (obj and -1) or None)
+
+class SubjectCache(object):
+    """LRU cache of per-subject statement dictionaries.
+
+    Memory use is bounded by the total number of cached statements
+    (max_size).  When the limit is exceeded, least recently used subjects
+    are evicted until the cache is down to three quarters of the limit;
+    evicting in batches keeps the bookkeeping cheap.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = {}    # key -> [entry, size, last use]
+        self.size = 0
+        self.tick = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        return self.entries.keys()
+
+    def get(self, key):
+        t = self.entries.get(key)
+        if t is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.tick += 1
+        t[2] = self.tick
+        return t[0]
+
+    def peek(self, key):
+        """Like get(), but does not affect statistics or LRU order."""
+        t = self.entries.get(key)
+        if t is None:
+            return None
+        return t[0]
+
+    def put(self, key, entry, size):
+        self.discard(key)
+        self.tick += 1
+        self.entries[key] = [entry, size, self.tick]
+        self.size += size
+        if self.size > self.max_size:
+            self._evict()
+
+    def adjust(self, key, delta):
+        t = self.entries.get(key)
+        if t is not None:
+            t[1] += delta
+            self.size += delta
+
+    def discard(self, key):
+        t = self.entries.pop(key, None)
+        if t is None:
+            return False
+        self.size -= t[1]
+        return True
+
+    def invalidate(self, key):
+        if self.discard(key):
+            self.invalidations += 1
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        self.entries = {}
+        self.size = 0
+
+    def get_statistics(self):
+        return {'subjects': len(self.entries),
+                'statements': self.size,
+                'max_statements': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations}
+
+    def _evict(self):
+        target = (self.max_size * 3) / 4
+        l = [(t[2], k) for k, t in self.entries.iteritems()]
+        l.sort()
+        for last_use, k in l:
+            if self.size <= target:
+                break
+            self.discard(k)
+            self.evictions += 1
+
+class ApswSubjectCacheMixin(object):
+    """Cross-transaction subject cache for apsw stores.
+
+    For a cached subject, all statements with that subject are kept in
+    memory, so find, count and contains for templates with a subject are
+    answered without touching the database.  Writes go through to the
+    database and update cached subjects in place.
+
+    Unlike SqlalchemySubjectCachedStore, the cache survives commits.  It
+    is validated when a transaction begins (while holding the exclusive
+    lock) against the generation counter maintained by ApswStore: if
+    other processes have committed in between, only the subjects they
+    touched (listed in the changes table) are invalidated.  If the change
+    log no longer reaches back far enough, the whole cache is flushed.
+    On rollback, subjects touched by the transaction are invalidated.
+
+    The cache is only used inside transactions; operations outside a
+    transaction go directly to the database.
+    """
+
+    cache_max_statements = 20000
+
+    def __init__(self, c):
+        super(ApswSubjectCacheMixin, self).__init__(c)
+        self.subject_cache = SubjectCache(self.cache_max_statements)
+        self.cache_generation = None
+
+    def get_cache_statistics(self):
+        res = self.subject_cache.get_statistics()
+        res['generation'] = self.cache_generation
+        return res
+
+    def _cache_active(self):
+        return self.track_changes and self.txn is self.active_txn
+
+    def _validate_subject_cache(self):
+        if not self.track_changes:
+            self.subject_cache.clear()
+            self.cache_generation = None
+            return
+
+        gen, sub_strs = self._find_changed_sub_strs(self.cache_generation)
+        if sub_strs is None:
+            if self.cache_generation is not None:
+                _log.debug('change log does not reach generation %s, flushing subject cache' % self.cache_generation)
+            self.subject_cache.clear()
+        else:
+            for sub_str in sub_strs:
+                self.subject_cache.invalidate(self._str_to_node(sub_str))
+        self.cache_generation = gen
+
+    def _changes_committed(self, generation):
+        super(ApswSubjectCacheMixin, self)._changes_committed(generation)
+        # cache was valid at transaction begin and has been written through since
+        if self.cache_generation is not None:
+            self.cache_generation = generation
+
+    def _do_begin_transaction_harder(self):
+        super(ApswSubjectCacheMixin, self)._do_begin_transaction_harder()
+        self._validate_subject_cache()
+
+    def _do_rollback_transaction(self):
+        changed = self.txn_changed
+        super(ApswSubjectCacheMixin, self)._do_rollback_transaction()
+        for sub_str in changed:
+            self.subject_cache.invalidate(self._str_to_node(sub_str))
+
+    def _get_subject_entry(self, subject):
+        entry = self.subject_cache.get(subject)
+        if entry is None:
+            entry = {}
+            count = 0
+            for stmt in super(ApswSubjectCacheMixin, self).find_statements(Statement(subject, None, None)):
+                if entry.has_key(stmt.predicate):
+                    entry[stmt.predicate].append(stmt)
+                else:
+                    entry[stmt.predicate] = [stmt]
+                count += 1
+            self.subject_cache.put(subject, entry, count)
+        return entry
+
+    def _match_entry(self, entry, template):
+        if template.predicate is None:
+            lists = entry.values()
+        else:
+            lists = [entry.get(template.predicate, [])]
+        res = []
+        for l in lists:
+            if template.object is None:
+                res.extend(l)
+            else:
+                for stmt in l:
+                    if stmt.object == template.object:
+                        res.append(stmt)
+        return res
+
+    def _remove_from_entry(self, subject, entry, template):
+        removed = 0
+        for stmt in self._match_entry(entry, template):
+            l = entry[stmt.predicate]
+            l.remove(stmt)
+            if len(l) == 0:
+                del entry[stmt.predicate]
+            removed += 1
+        self.subject_cache.adjust(subject, -removed)
+
+    def add_statement(self, statement):
+        super(ApswSubjectCacheMixin, self).add_statement(statement)
+        if self._cache_active():
+            entry = self.subject_cache.peek(statement.subject)
+            if entry is not None:
+                if not entry.has_key(statement.predicate):
+                    entry[statement.predicate] = [statement]
+                    self.subject_cache.adjust(statement.subject, 1)
+                elif statement not in entry[statement.predicate]:
+                    entry[statement.predicate].append(statement)
+                    self.subject_cache.adjust(statement.subject, 1)
+
+    def contains_statement(self, statement):
+        assert statement.concrete(), 'Statement must be concrete'
+        self._begin_deferred_transaction()
+        if not self._cache_active():
+            return super(ApswSubjectCacheMixin, self).contains_statement(statement)
+        return statement in self._get_subject_entry(statement.subject).get(statement.predicate, [])
+
+    def remove_statement(self, statement):
+        super(ApswSubjectCacheMixin, self).remove_statement(statement)
+        if self._cache_active():
+            entry = self.subject_cache.peek(statement.subject)
+            if entry is not None:
+                self._remove_from_entry(statement.subject, entry, statement)
+
+    def remove_statements(self, template):
+        super(ApswSubjectCacheMixin, self).remove_statements(template)
+        if self._cache_active():
+            if template.subject is not None:
+                subjects = [template.subject]
+            else:
+                subjects = self.subject_cache.keys()
+            for subject in subjects:
+                entry = self.subject_cache.peek(subject)
+                if entry is not None:
+                    self._remove_from_entry(subject, entry, template)
+
+    def count_statements(self, template):
+        self._begin_deferred_transaction()
+        if template.subject is None or not self._cache_active():
+            return super(ApswSubjectCacheMixin, self).count_statements(template)
+        return len(self._match_entry(self._get_subject_entry(template.subject), template))
+
+    def find_statements(self, template):
+        self._begin_deferred_transaction()
+        if template.subject is None or not self._cache_active():
+            return super(ApswSubjectCacheMixin, self).find_statements(template)
+        return self._match_entry(self._get_subject_entry(template.subject), template)
+
+    def iter_statements(self, template):
+        self._begin_deferred_transaction()
+        if template.subject is None or not self._cache_active():
+            return super(ApswSubjectCacheMixin, self).iter_statements(template)
+        return iter(self._match_entry(self._get_subject_entry(template.subject), template))
+
+    def add_statements_bulk(self, statements):
+        statements = list(statements)
+        super(ApswSubjectCacheMixin, self).add_statements_bulk(statements)
+        if self._cache_active():
+            for statement in statements:
+                entry = self.subject_cache.peek(statement.subject)
+                if entry is None:
+                    continue
+                if not entry.has_key(statement.predicate):
+                    entry[statement.predicate] = [statement]
+                    self.subject_cache.adjust(statement.subject, 1)
+                elif statement not in entry[statement.predicate]:
+                    entry[statement.predicate].append(statement)
+                    self.subject_cache.adjust(statement.subject, 1)
+
+    def remove_statements_bulk(self, statements):
+        statements = list(statements)
+        super(ApswSubjectCacheMixin, self).remove_statements_bulk(statements)
+        if self._cache_active():
+            for statement in statements:
+                entry = self.subject_cache.peek(statement.subject)
+                if entry is not None:
+                    self._remove_from_entry(statement.subject, entry, statement)
+
+    def find_statements_for_subjects(self, subjects, predicate=None):
+        self._begin_deferred_transaction()
+        if not self._cache_active():
+            return super(ApswSubjectCacheMixin, self).find_statements_for_subjects(subjects, predicate)
+
+        template = Statement(None, predicate, None)
+        res = []
+        missing = []
+        for subject in subjects:
+            entry = self.subject_cache.get(subject)
+            if entry is None:
+                missing.append(subject)
+            else:
+                res.extend(self._match_entry(entry, template))
+        if len(missing) == 0:
+            return res
+
+        # fetch all missing subjects in one go and populate the cache
+        entries = {}
+        for subject in missing:
+            entries[subject] = {}
+        for stmt in super(ApswSubjectCacheMixin, self).find_statements_for_subjects(missing):
+            entry = entries[stmt.subject]
+            if entry.has_key(stmt.predicate):
+                entry[stmt.predicate].append(stmt)
+            else:
+                entry[stmt.predicate] = [stmt]
+        for subject, entry in entries.iteritems():
+            matched = self._match_entry(entry, Statement(None, None, None))
+            self.subject_cache.put(subject, entry, len(matched))
+            if predicate is None:
+                res.extend(matched)
+            else:
+                res.extend(entry.get(predicate, []))
+        return res
+
+    def prune_unreachable(self, root):
+        subjects = super(ApswSubjectCacheMixin, self).prune_unreachable(root)
+        for subject in subjects:
+            self.subject_cache.invalidate(subject)
+        return subjects
+
+class ApswSubjectCachedStore(ApswSubjectCacheMixin, ApswStore):
+    """ApswStore with a cross-transaction subject cache."""
+
+class ApswEncodedSubjectCachedStore(ApswSubjectCacheMixin, ApswEncodedStore):
+    """ApswEncodedStore with a cross-transaction subject cache."""
+
+ApswStore.encoded_store_class = ApswEncodedStore
+ApswSubjectCachedStore.encoded_store_class = ApswEncodedSubjectCachedStore
+
 #
 #  XXX: EXPERIMENTAL
 #
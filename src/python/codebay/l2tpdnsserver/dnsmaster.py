@@ -7,6 +7,7 @@ from xml.dom import minidom
 from codebay.common import logger
 from codebay.common import runcommand
 from codebay.l2tpdnsserver import monitor
+from codebay.l2tpdnsserver import prober
 
 _log = logger.get('l2tpddnsserver.monitor')
 
@@ -118,30 +119,31 @@ class _DnsConfig:
     # FIXME: this is currently dependent on some existing configuration files
     # in /etc/bind (db.root).  Remove dependency or generate / check for deps.
     def write_configs(self, serial):
-        named_conf = self.named_conf
-        zonefile = string.replace(self.zonefile, '##SERIAL##', str(serial))
+        self.write_named_conf()
+        self.write_zonefile(serial)
 
+    def _write_file(self, fname, data):
         if not _check_marker():
-            _log.warning('dns server marker missing, not writing config files')
+            _log.warning('dns server marker missing, not writing config file %s' % fname)
             return
 
+        # write and rename so that bind never reads a partial file
+        tmpname = fname + '.tmp'
         f = None
         try:
-            f = open('/etc/bind/named.conf', 'wb')
-            f.write(named_conf)
-        finally:
-            if f is not None:
-                f.close()
-                f = None
-    
-        f = None
-        try:
-            f = open('/etc/bind/db.topleveldomain', 'wb')
-            f.write(zonefile)
+            f = open(tmpname, 'wb')
+            f.write(data)
         finally:
             if f is not None:
                 f.close()
                 f = None
+        os.rename(tmpname, fname)
+
+    def write_named_conf(self):
+        self._write_file('/etc/bind/named.conf', self.named_conf)
+
+    def write_zonefile(self, serial):
+        self._write_file('/etc/bind/db.topleveldomain', string.replace(self.zonefile, '##SERIAL##', str(serial)))
     
     def __eq__(self, other):
         if isinstance(other, _DnsConfig):
@@ -159,9 +161,21 @@ class DnsMaster:
         self.domains = None
         self.server_addresses = None
         self.server_monitors = None
+        self.prober = None
         self.current_dns_config = None
         self.bind_health_timer = None
         self.bind_health_interval = 60.0
+        self.monitor_interval = 30.0
+        self.monitor_fail_threshold = 3    # consecutive failed checks before removing a server
+        self.monitor_ok_threshold = 2      # consecutive ok checks before adding a server back
+        self.monitor_probe_timeout = 10.0
+        self.monitor_probe_history = 10    # probe results used for health scores
+        self.last_serial = 0
+        self.restart_count = 0             # bind restarts (stop/killall/start)
+        self.reload_count = 0              # zone reloads with rndc
+        self.publish_count = 0
+        self.last_time_to_publish = None   # seconds from first detection of a status change to zone reload
+        self.max_time_to_publish = None
         self._read_config()
         
     def _read_config(self):
@@ -225,12 +239,77 @@ class DnsMaster:
         if old_cfg == new_cfg:
             _log.debug('bind configuration did not change')
         else:
-            # configuration changed, restart bind
+            self._publish_dns_config(old_cfg, new_cfg, now)
+            self.current_dns_config = new_cfg
+
+            if monitor.change_detected_time is not None:
+                t = time.time() - monitor.change_detected_time
+                self.publish_count += 1
+                self.last_time_to_publish = t
+                if (self.max_time_to_publish is None) or (t > self.max_time_to_publish):
+                    self.max_time_to_publish = t
+            _log.info('dns statistics: %d publishes, last time-to-publish %s s, max %s s, %d zone reloads, %d bind restarts' % \
+                      (self.publish_count, self.last_time_to_publish, self.max_time_to_publish, self.reload_count, self.restart_count))
+
+            if self.prober is not None:
+                sc = []
+                for i in self.server_monitors:
+                    sc.append('%s -> %s' % (i.get_address(), i.get_health_score()))
+                _log.info('server health scores: [%s]' % ', '.join(sc))
+
+    def get_health_score(self, address):
+        """Get health score (0.0 to 1.0) of a monitored server.
+
+        Returns None if the server is not monitored, or if probing is not
+        done with the shared prober (see L{start}).
+        """
+        if self.server_monitors is None:
+            return None
+        for i in self.server_monitors:
+            if i.get_address() == address:
+                return i.get_health_score()
+        return None
+
+    def _publish_dns_config(self, old_cfg, new_cfg, now):
+        """Write changed configuration files and make bind use them.
+
+        Only the zone file is rewritten and reloaded with rndc when named.conf
+        is unchanged.  Bind is restarted only when it has not been configured
+        by us yet, or when rndc fails.
+        """
+        serial = max(int(now), self.last_serial + 1)  # must increase even within a second
+        self.last_serial = serial
+
+        if (old_cfg is None) or (old_cfg.named_conf != new_cfg.named_conf):
             _log.info('bind configuration needs to be changed, reconfiguring and restarting bind')
             self._stop_bind()
-            self._write_dns_config(new_cfg, now)
+            self._write_dns_config(new_cfg, serial)
             self._start_bind()
-            self.current_dns_config = new_cfg
+            return
+
+        _log.info('zone needs to be changed, reloading zone %s' % self.top_level_domain)
+        new_cfg.write_zonefile(str(serial))
+        if not self._reload_zone():
+            _log.warning('zone reload failed, restarting bind')
+            self._stop_bind()
+            self._start_bind()
+
+    def _reload_zone(self):
+        if not _check_marker():
+            _log.warning('no marker, not reloading zone')
+            return True
+
+        try:
+            rv, stdout, stderr = runcommand.run(['/usr/sbin/rndc', 'reload', self.top_level_domain])
+            if rv != 0:
+                _log.warning('rndc reload failed: rv=%s, stdout=%s, stderr=%s' % (rv, stdout, stderr))
+                return False
+        except:
+            _log.exception('rndc reload failed')
+            return False
+
+        self.reload_count += 1
+        return True
             
     def _generate_dns_config(self):
         t = {}
@@ -240,8 +319,8 @@ class DnsMaster:
 
         return _DnsConfig(self.top_level_domain, self.ns1, self.ns2, self.mail, self.domains, t)
     
-    def _write_dns_config(self, cfg, now):
-        cfg.write_configs(str(int(now)))
+    def _write_dns_config(self, cfg, serial):
+        cfg.write_configs(str(serial))
     
     def _start_bind(self):
         if not _check_marker():
@@ -250,6 +329,7 @@ class DnsMaster:
         
         # XXX: error handling
         runcommand.run(['/etc/init.d/bind9', 'start'])
+        self.restart_count += 1
     
     def _stop_bind(self):
         if not _check_marker():
@@ -291,9 +371,26 @@ class DnsMaster:
         self.bind_health_timer = reactor.callLater(self.bind_health_interval, self._bind_health_callback)
 
     def start(self):
+        # one shared icmp prober for all servers; fall back to spawning
+        # ping per check if the socket cannot be created
+        self.prober = prober.Prober(mode='icmp',
+                                    interval=self.monitor_interval,
+                                    timeout=self.monitor_probe_timeout,
+                                    history_length=self.monitor_probe_history)
+        try:
+            self.prober.start(now=True)
+        except prober.ProberError:
+            _log.exception('cannot start prober, using ping instead')
+            self.prober = None
+
         self.server_monitors = []
         for i in self.server_addresses:
-            self.server_monitors.append(monitor.Monitor(server_address=i, callback=self._status_changed, interval=30.0))
+            self.server_monitors.append(monitor.Monitor(server_address=i,
+                                                        callback=self._status_changed,
+                                                        interval=self.monitor_interval,
+                                                        fail_threshold=self.monitor_fail_threshold,
+                                                        ok_threshold=self.monitor_ok_threshold,
+                                                        prober=self.prober))
 
         for i in self.server_monitors:
             i.start(now=True)
@@ -304,6 +401,10 @@ class DnsMaster:
         for i in self.server_monitors:
             i.stop()
 
+        if self.prober is not None:
+            self.prober.stop()
+            self.prober = None
+
         if self.bind_health_timer is not None:
             self.bind_health_timer.cancel()
             self.bind_health_timer = None
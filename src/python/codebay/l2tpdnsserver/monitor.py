@@ -4,8 +4,20 @@ Monitor a single VPNease server periodically.
 Starts an internal task, which monitors a VPNease server periodically.
 When a server has been confirmed to have failed, calls a user callback
 to notify of a status change.
+
+A status change is confirmed (published) only after a number of
+consecutive checks agree on the new status, so that a flapping server
+does not cause a reconfiguration on every check.  The initial status is
+published on the first check.
+
+Checks are done either by spawning ping for every check, or, if a shared
+L{codebay.l2tpdnsserver.prober.Prober} is given, by registering the server
+as a prober target; the prober then decides the check timing and calls
+back with each probe result.
 """
 
+import time
+
 from twisted.internet import reactor, protocol, defer, error
 from twisted.python import failure
 from codebay.common import logger
@@ -27,24 +39,45 @@ class Monitor:
     STATUS_OK = 'STATUS_OK'
     STATUS_NOT_RESPONDING = 'STATUS_NOT_RESPONDING'
 
-    def __init__(self, server_address=None, callback=None, interval=60.0):
+    def __init__(self, server_address=None, callback=None, interval=60.0, fail_threshold=1, ok_threshold=1, prober=None):
         self.status = self.STATUS_UNKNOWN
         self.server_address = server_address
         self.callback = callback
         self.interval = interval
+        self.fail_threshold = fail_threshold    # consecutive failures before publishing STATUS_NOT_RESPONDING
+        self.ok_threshold = ok_threshold        # consecutive successes before publishing STATUS_OK
         self.timer = None
+        self.prober = prober
+        self.status_changes = 0
+        self.change_detected_time = None        # time.time() of first check agreeing with published status
+        self._consecutive = 0
+        self._change_first_seen = None
 
     def start(self, now=False):
         self.stop()
+        if self.prober is not None:
+            self.prober.add_target(self.server_address, callback=self._probe_result)
+            return
         if now:
             self.timer = reactor.callLater(0.0, self._monitor_timer)
         else:
             self.timer = reactor.callLater(self.interval, self._monitor_timer)
         
     def stop(self):
+        if self.prober is not None:
+            self.prober.remove_target(self.server_address)
         if self.timer is not None:
             self.timer.cancel()
             self.timer = None    
+
+    def get_health_score(self):
+        """Health score from prober history (0.0 to 1.0), or None if not available."""
+        if self.prober is None:
+            return None
+        t = self.prober.get_target(self.server_address)
+        if t is None:
+            return None
+        return t.get_health_score()
     
     def get_status(self):
         return self.status
@@ -59,7 +92,6 @@ class Monitor:
         _log.debug('_monitor_timer(%s)' % self.server_address)
         
         self.timer = None
-        old_status = self.status
 
         def _start_check(res):
             d = defer.Deferred()
@@ -87,16 +119,10 @@ class Monitor:
             return d
 
         def _check_ok(res):
-            if res:
-                self.status = self.STATUS_OK
-            else:
-                self.status = self.STATUS_NOT_RESPONDING
-
-            if self.status != old_status:
-                self.callback(self)
+            self._check_result(res)
 
         def _check_failed(reason):
-            _log.warning('_monitor_timer(%s): check failed, reason %s' % reason)
+            _log.warning('_monitor_timer(%s): check failed, reason %s' % (self.server_address, reason))
 
         def _reschedule_check(res):
             self.start()
@@ -107,3 +133,35 @@ class Monitor:
         d.addCallback(_reschedule_check)
         d.callback(None)
         return d
+
+    def _probe_result(self, target, ok):
+        _log.debug('_probe_result(%s): ok=%s, rtt=%s' % (self.server_address, ok, target.last_rtt))
+        self._check_result(ok)
+
+    def _check_result(self, ok):
+        if ok:
+            new_status = self.STATUS_OK
+            threshold = self.ok_threshold
+        else:
+            new_status = self.STATUS_NOT_RESPONDING
+            threshold = self.fail_threshold
+
+        if new_status == self.status:
+            self._consecutive = 0
+            self._change_first_seen = None
+            return
+
+        if self._consecutive == 0:
+            self._change_first_seen = time.time()
+        self._consecutive += 1
+
+        if (self.status != self.STATUS_UNKNOWN) and (self._consecutive < threshold):
+            _log.info('_check_result(%s): status %s seen %d/%d times, not published yet' % (self.server_address, new_status, self._consecutive, threshold))
+            return
+
+        self.status = new_status
+        self.status_changes += 1
+        self.change_detected_time = self._change_first_seen
+        self._consecutive = 0
+        self._change_first_seen = None
+        self.callback(self)
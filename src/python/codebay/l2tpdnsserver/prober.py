@@ -0,0 +1,348 @@
+"""
+Shared asynchronous health prober.
+
+Probes any number of targets periodically over a single socket in the
+Twisted reactor, instead of spawning a ping process per target and check.
+Two probe types are supported:
+
+  * 'icmp': ICMP echo over a raw socket (requires root), or over an
+    unprivileged ICMP datagram socket where the kernel allows it.
+
+  * 'udp': a datagram to a UDP echo service, which must send the same
+    datagram back.  Mostly useful for testing against fake targets, see
+    L{run_fake_target_harness}.
+
+Each target keeps a history of recent probe results (RTT or loss), from
+which a health score is computed.  A result callback is called for every
+probe, so that callers can apply their own hysteresis.
+"""
+
+import os, time, socket, struct, errno, random, collections
+
+from twisted.internet import reactor
+
+from codebay.common import logger
+
+_log = logger.get('l2tpddnsserver.prober')
+
+_ICMP_ECHO_REQUEST = 8
+_ICMP_ECHO_REPLY = 0
+_PROBE_MAGIC = 'l2tpgwprobe'
+
+class ProberError(Exception):
+    """Prober socket cannot be created or used."""
+
+def _icmp_checksum(data):
+    if len(data) % 2 == 1:
+        data += '\x00'
+    s = 0
+    for (w,) in [struct.unpack('!H', data[i:i+2]) for i in xrange(0, len(data), 2)]:
+        s += w
+    s = (s >> 16) + (s & 0xffff)
+    s += (s >> 16)
+    return (~s) & 0xffff
+
+class ProbeTarget:
+    """Probe state and result history of one target."""
+
+    def __init__(self, address, port=None, callback=None, history_length=10):
+        self.address = address
+        self.port = port
+        self.callback = callback       # callback(target, ok), called for every probe result
+        self.history = collections.deque()
+        self.history_length = history_length
+        self.sent = 0
+        self.received = 0
+        self.last_rtt = None
+
+    def _add_result(self, rtt):
+        self.history.append(rtt)
+        while len(self.history) > self.history_length:
+            self.history.popleft()
+        if rtt is not None:
+            self.received += 1
+            self.last_rtt = rtt
+        if self.callback is not None:
+            try:
+                self.callback(self, rtt is not None)
+            except:
+                _log.exception('probe result callback failed for %s' % self.address)
+
+    def get_loss(self):
+        """Fraction of lost probes in history, or None if no history."""
+        if len(self.history) == 0:
+            return None
+        lost = 0
+        for rtt in self.history:
+            if rtt is None:
+                lost += 1
+        return float(lost) / float(len(self.history))
+
+    def get_rtt_average(self):
+        """Average RTT (seconds) of answered probes in history, or None."""
+        rtts = [rtt for rtt in self.history if rtt is not None]
+        if len(rtts) == 0:
+            return None
+        return sum(rtts) / float(len(rtts))
+
+    def get_health_score(self):
+        """Health score from 0.0 (all recent probes lost) to 1.0 (all answered).
+
+        Returns None if the target has not been probed yet.
+        """
+        loss = self.get_loss()
+        if loss is None:
+            return None
+        return 1.0 - loss
+
+class Prober:
+    """Probe a set of targets periodically over one socket.
+
+    All targets are probed every interval seconds; the probes of one round
+    are spread over the first half of the interval.  A probe which is not
+    answered within timeout seconds counts as lost.
+    """
+
+    def __init__(self, mode='icmp', interval=30.0, timeout=10.0, history_length=10, udp_port=7):
+        if mode not in ['icmp', 'udp']:
+            raise ProberError('unknown probe mode: %s' % mode)
+        self.mode = mode
+        self.interval = interval
+        self.timeout = timeout
+        self.history_length = history_length
+        self.udp_port = udp_port
+        self.targets = {}           # (address, port) -> ProbeTarget
+        self._socket = None
+        self._icmp_raw = False
+        self._ident = os.getpid() & 0xffff
+        self._seq = random.randint(0, 0xffff)
+        self._outstanding = {}      # seq -> (target, send time)
+        self._round_timer = None
+        self._send_timers = []
+        self._timeout_timer = None
+
+    # ----------------------------------------------------------------------
+
+    def add_target(self, address, callback=None, port=None):
+        if (self.mode == 'udp') and (port is None):
+            port = self.udp_port
+        key = (address, port)
+        if not self.targets.has_key(key):
+            self.targets[key] = ProbeTarget(address, port=port, callback=callback, history_length=self.history_length)
+        return self.targets[key]
+
+    def remove_target(self, address, port=None):
+        if (self.mode == 'udp') and (port is None):
+            port = self.udp_port
+        key = (address, port)
+        if self.targets.has_key(key):
+            del self.targets[key]
+
+    def get_target(self, address, port=None):
+        if (self.mode == 'udp') and (port is None):
+            port = self.udp_port
+        return self.targets.get((address, port))
+
+    # ----------------------------------------------------------------------
+
+    def _open_socket(self):
+        if self.mode == 'udp':
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            try:
+                s = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.getprotobyname('icmp'))
+                self._icmp_raw = True
+            except socket.error:
+                # unprivileged ICMP sockets, see net.ipv4.ping_group_range
+                try:
+                    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.getprotobyname('icmp'))
+                except socket.error, e:
+                    raise ProberError('cannot create icmp socket: %s' % e)
+                self._icmp_raw = False
+        s.setblocking(0)
+        return s
+
+    def start(self, now=True):
+        """Open the probe socket and start probing; raises ProberError on failure."""
+        self.stop()
+        self._socket = self._open_socket()
+        reactor.addReader(self)
+        if now:
+            self._round_timer = reactor.callLater(0.0, self._probe_round)
+        else:
+            self._round_timer = reactor.callLater(self.interval, self._probe_round)
+        self._timeout_timer = reactor.callLater(1.0, self._check_timeouts)
+
+    def stop(self):
+        for t in [self._round_timer, self._timeout_timer] + self._send_timers:
+            if (t is not None) and t.active():
+                t.cancel()
+        self._round_timer = None
+        self._timeout_timer = None
+        self._send_timers = []
+        if self._socket is not None:
+            reactor.removeReader(self)
+            self._socket.close()
+            self._socket = None
+        self._outstanding = {}
+
+    # ----------------------------------------------------------------------
+
+    def _probe_round(self):
+        self._round_timer = reactor.callLater(self.interval, self._probe_round)
+
+        # spread probes over half of the interval to avoid bursts
+        self._send_timers = [t for t in self._send_timers if t.active()]
+        targets = self.targets.values()
+        if len(targets) == 0:
+            return
+        spacing = (self.interval / 2.0) / float(len(targets))
+        for idx, target in enumerate(targets):
+            self._send_timers.append(reactor.callLater(idx * spacing, self._send_probe, target))
+
+    def _next_seq(self):
+        for i in xrange(0x10000):
+            self._seq = (self._seq + 1) & 0xffff
+            if not self._outstanding.has_key(self._seq):
+                return self._seq
+        raise ProberError('too many outstanding probes')
+
+    def _send_probe(self, target):
+        if (self._socket is None) or (self.get_target(target.address, target.port) is not target):
+            return
+
+        seq = self._next_seq()
+        payload = _PROBE_MAGIC + struct.pack('!HH', self._ident, seq)
+        if self.mode == 'udp':
+            packet = payload
+            dest = (target.address, target.port)
+        else:
+            header = struct.pack('!BBHHH', _ICMP_ECHO_REQUEST, 0, 0, self._ident, seq)
+            csum = _icmp_checksum(header + payload)
+            packet = struct.pack('!BBHHH', _ICMP_ECHO_REQUEST, 0, csum, self._ident, seq) + payload
+            dest = (target.address, 0)
+
+        try:
+            self._socket.sendto(packet, dest)
+        except socket.error, e:
+            _log.debug('probe to %s failed: %s' % (target.address, e))
+            target.sent += 1
+            target._add_result(None)
+            return
+
+        target.sent += 1
+        self._outstanding[seq] = (target, time.time())
+
+    def _check_timeouts(self):
+        self._timeout_timer = reactor.callLater(1.0, self._check_timeouts)
+        limit = time.time() - self.timeout
+        for seq, (target, sent) in self._outstanding.items():
+            if sent < limit:
+                del self._outstanding[seq]
+                target._add_result(None)
+
+    # ----------------------------------------------------------------------
+    # IReadDescriptor for the reactor
+
+    def fileno(self):
+        if self._socket is None:
+            return -1
+        return self._socket.fileno()
+
+    def logPrefix(self):
+        return 'Prober'
+
+    def connectionLost(self, reason):
+        _log.warning('prober socket lost: %s' % reason)
+
+    def doRead(self):
+        while self._socket is not None:
+            try:
+                data, addr = self._socket.recvfrom(2048)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                _log.warning('prober receive failed: %s' % e)
+                return
+            self._handle_packet(data, addr)
+
+    def _handle_packet(self, data, addr):
+        now = time.time()
+
+        if self.mode == 'udp':
+            payload = data
+        else:
+            if self._icmp_raw:
+                if len(data) < 20:
+                    return
+                ihl = (ord(data[0]) & 0x0f) * 4
+                data = data[ihl:]
+            if len(data) < 8:
+                return
+            icmp_type, icmp_code, csum, ident, seq = struct.unpack('!BBHHH', data[:8])
+            if icmp_type != _ICMP_ECHO_REPLY:
+                return
+            payload = data[8:]
+
+        # the kernel rewrites the identifier of unprivileged icmp sockets,
+        # so match on the payload instead
+        if (len(payload) < len(_PROBE_MAGIC) + 4) or (not payload.startswith(_PROBE_MAGIC)):
+            return
+        ident, seq = struct.unpack('!HH', payload[len(_PROBE_MAGIC):len(_PROBE_MAGIC) + 4])
+        if (ident != self._ident) or (not self._outstanding.has_key(seq)):
+            return
+        target, sent = self._outstanding[seq]
+        if target.address != addr[0]:
+            return
+        del self._outstanding[seq]
+        target._add_result(now - sent)
+
+# --------------------------------------------------------------------------
+
+def run_fake_target_harness(target_count=300, loss=0.2, delay=0.01, interval=2.0, rounds=5):
+    """Probe fake UDP echo targets on local addresses and report the results.
+
+    Each fake target listens on its own 127.0.x.y address and echoes probes
+    back after delay seconds, dropping a loss fraction of them at random.
+    The prober probes all targets over one socket for the given number of
+    rounds; the average health score should approach 1.0 - loss.  Runs and
+    stops the reactor.
+    """
+    from twisted.internet import protocol
+
+    class _FakeTarget(protocol.DatagramProtocol):
+        def datagramReceived(self, data, addr):
+            if random.random() < loss:
+                return
+            reactor.callLater(delay, self.transport.write, data, addr)
+
+    port = 10007
+    prober = Prober(mode='udp', interval=interval, timeout=interval / 2.0, history_length=rounds, udp_port=port)
+    listeners = []
+    for i in xrange(target_count):
+        address = '127.0.%d.%d' % ((i + 1) / 250, (i + 1) % 250 + 1)
+        listeners.append(reactor.listenUDP(port, _FakeTarget(), interface=address))
+        prober.add_target(address)
+
+    def _finish():
+        prober.stop()
+        for l in listeners:
+            l.stopListening()
+
+        scores = [t.get_health_score() for t in prober.targets.values() if t.get_health_score() is not None]
+        rtts = [t.get_rtt_average() for t in prober.targets.values() if t.get_rtt_average() is not None]
+        sent = sum([t.sent for t in prober.targets.values()])
+        received = sum([t.received for t in prober.targets.values()])
+        print '%d targets, %d probes sent, %d answered (configured loss %.2f)' % (target_count, sent, received, loss)
+        if len(scores) > 0:
+            print 'health score: avg %.3f, min %.3f, max %.3f' % (sum(scores) / len(scores), min(scores), max(scores))
+        if len(rtts) > 0:
+            print 'rtt: avg %.2f ms' % (sum(rtts) / len(rtts) * 1000.0)
+        reactor.stop()
+
+    prober.start()
+    reactor.callLater(interval * rounds + interval / 2.0 + 0.5, _finish)
+    reactor.run()
+
+if __name__ == '__main__':
+    run_fake_target_harness()
@@ -1,15 +1,29 @@
-"""Apt helper code for getting product versions and changelog information from package repository."""
+"""Apt helper code for getting product versions and changelog information from package repository.
+
+Apt information is served from memory and never blocks the reactor.  When
+the information for a sources.list is missing or older than the cache
+interval, a refresh is started in the background (aptitude and dpkg run as
+child processes) and the stale information, if any, is served until the
+refresh completes.  Refresh requests for the same sources.list are
+coalesced, and refreshes are run one at a time because apt package lists
+are shared between sources.lists.
+"""
+__docformat__ = 'epytext en'
 
 import os
 import re
+import gzip
+import shutil
+import tempfile
 import datetime
+
+from twisted.internet import defer, utils
+from twisted.python import failure
+
 from codebay.common import logger
-from codebay.l2tpserver import helpers
-from codebay.l2tpserver import runcommand
+from codebay.l2tpserver import constants
 from codebay.l2tpserver import versioninfo
 
-run_command = runcommand.run_command
-
 _log = logger.get('l2tpmanagementserver.aptsupport')
 
 _global_aptcache = None
@@ -19,7 +33,7 @@ class AptCacheInfo:
         self.cachetime = cachetime
         self.version = version
         self.changelog = changelog
-        
+
 class AptCache:
     """Get version and changelog information for requested apt sources.list.
 
@@ -27,68 +41,177 @@ class AptCache:
     results for a reasonable period of time to minimize apt traffic.
     """
     def __init__(self, interval=2*60):
-        self.tmpsource = '/tmp/tmp_apt_sources_list'  # FIXME
         self.package_name_re = re.compile(r'vpnease_.*\.deb')
-        self.aptitude_options = ['-o', 'Dir::Etc::SourceList=%s' % self.tmpsource]
         self.interval = interval
-        self.cache = {}     # sources.list contents -> AptCacheInfo
+        self.cache = {}      # sources.list contents -> AptCacheInfo
+        self.attempts = {}   # sources.list contents -> datetime of last refresh attempt
+        self._waiting = {}   # sources.list contents -> list of Deferreds waiting for refresh
+        self._queue = []     # sources.lists waiting for refresh
+        self._running = None # sources.list being refreshed
+
+    def _is_fresh(self, timestamp, now):
+        diff = now - timestamp
+        return (diff >= datetime.timedelta(0, 0, 0)) and (diff <= datetime.timedelta(0, self.interval, 0))
 
     def get_apt_info(self, apt_sources_list):
         """Get apt information for an apt sources.list.
 
-        Retrieves relevant information (with caching), and returns a tuple
-        consisting of: latest version number, changelog.
+        Returns a tuple consisting of: latest version number, changelog.
+        Never blocks: if the cached information is stale, it is returned
+        anyway and a background refresh is started.  If there is no cached
+        information yet, returns (None, None).
+        """
+        now = datetime.datetime.utcnow()
+
+        cinfo = None
+        if self.cache.has_key(apt_sources_list):
+            cinfo = self.cache[apt_sources_list]
+
+        if (cinfo is None) or (not self._is_fresh(cinfo.cachetime, now)):
+            # don't retry failed refreshes more often than successful ones
+            if (not self.attempts.has_key(apt_sources_list)) or (not self._is_fresh(self.attempts[apt_sources_list], now)):
+                d = self.refresh(apt_sources_list)
+                d.addErrback(lambda x: None)  # logged by refresh
+
+        if cinfo is None:
+            _log.info('no apt info available yet')
+            return None, None
+
+        _log.debug('serving cached apt info for version %s' % cinfo.version)
+        return cinfo.version, cinfo.changelog
+
+    def refresh(self, apt_sources_list):
+        """Refresh apt information for an apt sources.list in the background.
+
+        Returns a Deferred firing with a (version, changelog) tuple when
+        the refresh is complete.  If a refresh for the same sources.list is
+        already pending, the new request joins it.
+        """
+        d = defer.Deferred()
+        if self._waiting.has_key(apt_sources_list):
+            self._waiting[apt_sources_list].append(d)
+            return d
+
+        self._waiting[apt_sources_list] = [d]
+        self._queue.append(apt_sources_list)
+        self._run_next()
+        return d
+
+    def _run_next(self):
+        if (self._running is not None) or (len(self._queue) == 0):
+            return
+
+        apt_sources_list = self._queue.pop(0)
+        self._running = apt_sources_list
+        self.attempts[apt_sources_list] = datetime.datetime.utcnow()
+
+        _log.info('fetching apt info, apt source:')
+        _log.info(apt_sources_list)
+
+        def _success(res):
+            version, changelog = res
+            self.cache[apt_sources_list] = AptCacheInfo(datetime.datetime.utcnow(), version, changelog)
+            _log.info('fetched fresh apt info for version %s' % version)
+            return res
+
+        def _failed(reason):
+            _log.error('failed to get package version info: %s' % reason)
+            return reason
+
+        def _done(res):
+            self._running = None
+            waiting = self._waiting[apt_sources_list]
+            del self._waiting[apt_sources_list]
+            for w in waiting:
+                if isinstance(res, failure.Failure):
+                    w.errback(res)
+                else:
+                    w.callback(res)
+            self._run_next()
+
+        d = defer.maybeDeferred(self._fetch, apt_sources_list)  # _fetch may raise synchronously
+        d.addCallbacks(_success, _failed)
+        d.addBoth(_done)
+
+    def _fetch(self, apt_sources_list):
+        """Fetch version and changelog using apt in child processes; returns a Deferred.
 
         FIXME: has some trouble now with downgrade, maybe need to nuke
-        /var/lib/apt/lists/vpnease* or something.  Also, could we download
-        lists to some temporary file instead?
+        /var/lib/apt/lists/vpnease* or something.
         """
-        try:
-            now = datetime.datetime.utcnow()
-
-            # serve from cache?
-            if self.cache.has_key(apt_sources_list):
-                cinfo = self.cache[apt_sources_list]
-                diff = now - cinfo.cachetime
-                if (diff >= datetime.timedelta(0, 0, 0)) and (diff <= datetime.timedelta(0, self.interval, 0)):
-                    _log.info('serving cached apt info for version %s' % cinfo.version)
-                    return cinfo.version, cinfo.changelog
-            else:
-                pass
-
-            # no, fetch using apt and cache
-            _log.info('fetching apt info, apt source:')
-            _log.info(apt_sources_list)
-            helpers.write_file(self.tmpsource, apt_sources_list, perms=0644)
-            run_command(['aptitude'] + self.aptitude_options + ['update'], retval=runcommand.FAIL)
-            run_command(['aptitude'] + self.aptitude_options + ['download', 'vpnease'], cwd='/tmp', retval=runcommand.FAIL)
-            version = None
-            for i in os.listdir('/tmp'):
+        tmpdir = tempfile.mkdtemp(prefix='aptsupport-')
+        sources = os.path.join(tmpdir, 'sources.list')
+        extractdir = os.path.join(tmpdir, 'extract')
+        aptitude_options = ['-o', 'Dir::Etc::SourceList=%s' % sources]
+        state = {}
+
+        def _run(args):
+            _log.debug('running %s' % args)
+            d = utils.getProcessOutputAndValue(args[0], args[1:], env=os.environ, path=tmpdir)
+
+            def _check(res):
+                out, err, rv = res
+                if rv != 0:
+                    raise Exception('command %s failed: rv=%s, stderr=%s' % (args, rv, err))
+                return out
+            d.addCallback(_check)
+            return d
+
+        def _update(res):
+            f = open(sources, 'wb')
+            f.write(apt_sources_list)
+            f.close()
+            return _run([constants.CMD_APTITUDE] + aptitude_options + ['update'])
+
+        def _download(res):
+            return _run([constants.CMD_APTITUDE] + aptitude_options + ['download', 'vpnease'])
+
+        def _info(res):
+            for i in os.listdir(tmpdir):
                 if self.package_name_re.match(i):
-                    version = versioninfo.get_package_version_info(os.path.join('/tmp', i))
-                    changelog = versioninfo.get_package_changelog(os.path.join('/tmp', i))
-                    run_command(['/bin/rm', '-f', os.path.join('/tmp', i)], retval=runcommand.FAIL)
-            if version is None:
+                    state['deb'] = os.path.join(tmpdir, i)
+            if not state.has_key('deb'):
                 raise Exception('vpnease package file not found')
-            if changelog is None:
-                raise Exception('vpnease package changelog not found')
-            
-            # create a new cache object
-            cinfo = AptCacheInfo(now, version, changelog)
-            self.cache[apt_sources_list] = cinfo
-            
-            # return fresh data
-            _log.info('serving fresh apt info for version %s' % cinfo.version)
-            return cinfo.version, cinfo.changelog
-        except:
-            _log.exception('failed to get package version info')
-            raise
-
-        raise Exception('should not be here')
+            return _run([constants.CMD_DPKG, '--info', state['deb']])
+
+        def _extract(out):
+            for i in out.split('\n'):
+                m = versioninfo.version_re.match(i)
+                if m is not None:
+                    state['version'] = m.groups()[0]
+                    break
+            if not state.has_key('version'):
+                raise Exception('vpnease package version not found')
+            return _run([constants.CMD_DPKG, '-x', state['deb'], extractdir])
+
+        def _changelog(res):
+            # XXX: changelog is in constants as absolute path, using here as relative to extracted package directory
+            f = gzip.open(os.path.join(extractdir, constants.PRODUCT_CHANGELOG[1:]), 'rb')
+            try:
+                changelog = f.read()
+            finally:
+                f.close()
+            return state['version'], changelog
+
+        def _cleanup(res):
+            try:
+                shutil.rmtree(tmpdir)
+            except:
+                _log.exception('failed to remove temporary directory %s' % tmpdir)
+            return res
+
+        d = defer.Deferred()
+        d.addCallback(_update)
+        d.addCallback(_download)
+        d.addCallback(_info)
+        d.addCallback(_extract)
+        d.addCallback(_changelog)
+        d.addBoth(_cleanup)
+        d.callback(None)
+        return d
 
 def get_aptcache():
     global _global_aptcache
     if _global_aptcache is None:
         _global_aptcache = AptCache()
     return _global_aptcache
-
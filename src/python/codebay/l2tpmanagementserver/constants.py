@@ -41,8 +41,17 @@
     Software build info string sent by server in Identify exchange.
 @var SERVER_IDENTIFY_SERVER_INFO:
     Server info string sent by server in Identify exchange.
+@var LICENSE_RELOAD_INTERVAL:
+    Minimum interval (in seconds) between checks for changed license CSV file
+    and demo license files.
 @var MASTER_CHECK_INTERVAL:
     Interval for status summary logging.
+@var REIDENTIFY_WINDOW:
+    Time (in seconds) over which reidentify requests to all connections are spread.
+@var REIDENTIFY_MAX_PER_SECOND:
+    Maximum number of reidentify requests sent per second.
+@var REIDENTIFY_MAX_OUTSTANDING:
+    Maximum number of unanswered reidentify requests.
 @var KEEPALIVE_INTERVAL:
     Server keepalive interval.
 @var KEEPALIVE_TIMEOUT:
@@ -96,6 +105,8 @@ LICENSE_RECHECK_QUICK = datetime.timedelta(0, 1*60*60, 0)          # FIXME: hour
 LICENSE_VALIDITY_START_LEEWAY = datetime.timedelta(7, 0, 0)        # FIXME: 1 week backwards leeway
 LICENSE_VALIDITY_END_LEEWAY = datetime.timedelta(1, 0, 0)          # FIXME: 1 day forwards leeway
 
+LICENSE_RELOAD_INTERVAL = 5*60
+
 DEMO_LICENSE_DIRECTORY = '/root/demolicenses'
 DEMO_LICENSE_TIME = datetime.timedelta(30, 15*60, 0)  # extra 15min for prettier server status page (start count from 30d 0h)
 DEMO_LICENSE_USER_COUNT = 10
@@ -109,6 +120,10 @@ SERVER_IDENTIFY_SERVER_INFO = u'%s:%s' % (SERVER_ADDRESS, SERVER_PORT)
 
 MASTER_CHECK_INTERVAL = 5*60
 
+REIDENTIFY_WINDOW = 2*60
+REIDENTIFY_MAX_PER_SECOND = 10
+REIDENTIFY_MAX_OUTSTANDING = 50
+
 KEEPALIVE_INTERVAL = 5*60
 KEEPALIVE_TIMEOUT = 30
 
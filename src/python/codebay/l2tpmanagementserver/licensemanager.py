@@ -1,11 +1,15 @@
 """License management.
 
-Customer licenses are simply managed as a list of CustomerLicense instances
-read from a CSV file.  Demo licenses are stored in simple key-value encoded files.
+Customer licenses are read from a CSV file into CustomerLicense instances.
+Demo licenses are stored in simple key-value encoded files, one per license.
+
+Both are kept in memory in a L{LicenseRegistry}, indexed by license key (and
+demo licenses also by installation UUID), so that a license lookup does not
+depend on the number of licenses.  The registry is reloaded incrementally.
 """
 __docformat__ = 'epytext en'
 
-import os, re, datetime, textwrap, md5
+import os, re, time, datetime, textwrap, md5, StringIO
 from codebay.common import datatypes
 from codebay.common import logger
 from codebay.common import licensekey
@@ -50,64 +54,9 @@ class LicenseManager:
     def __init__(self, master):
         self.master = master  # XXX: unused
 
-    def _parse_demo_license(self, license_key):
-        re_keyval = re.compile(r'^(.*?)=(.*?)$')
-
-        grant_time = None
-        remote_address = None
-        remote_port = None
-        installation_uuid = None
-        
-        f = None
-        try:
-            try:
-                fname = str(os.path.join(msconstants.DEMO_LICENSE_DIRECTORY, license_key))
-                f = open(fname, 'rb')
-                for line in f.readlines():
-                    line = line.strip()
-                    m = re_keyval.match(line)
-                    if m is not None:
-                        g = m.groups()
-                        if len(g) == 2:
-                            key, value = g[0], g[1]
-                            if key == 'grant-time':
-                                grant_time = datatypes.parse_datetime_from_iso8601_subset(value)
-                            elif key == 'remote-address':
-                                remote_address = datatypes.IPv4Address.fromString(value)
-                            elif key == 'remote-port':
-                                remote_port = int(value)
-                            elif key == 'installation-uuid':
-                                installation_uuid = str(value)
-                            else:
-                                _log.warning('skipping demo license key-value pair: %s=%s' % (key,value))
-            except IOError:
-                # eat error
-                pass
-            except:
-                _log.exception('failed in parsing demo license file for license key %s' % license_key)
-                raise
-        finally:
-            if f is not None:
-                f.close()
-
-        if (grant_time is not None) and (remote_address is not None) and (remote_port is not None) and (installation_uuid is not None):
-            return DemoLicense(license_key, grant_time, remote_address, remote_port, installation_uuid, None)
-        else:
-            return None
-
-    def _parse_demo_licenses(self):
-        res = {}
-        for license_key in os.listdir(msconstants.DEMO_LICENSE_DIRECTORY):
-            try:
-                tmp = self._parse_demo_license(license_key)
-                res[license_key] = tmp
-            except:
-                _log.exception('failed in parsing demo license %s' % license_key)
-        return res
-    
     # FIXME: uses file, nuke later
     def get_demo_licenses(self):
-        return self._parse_demo_licenses().values()
+        return get_license_registry().get_demo_licenses()
         
     # FIXME: nuke file part later
     def get_demo_license(self, license_key):
@@ -133,7 +82,7 @@ class LicenseManager:
                 _log.exception('failed when looking for license key %s' % license_key)
             return None                
         else:
-            return self._parse_demo_license(license_key)
+            return get_license_registry().get_demo_license(license_key)
 
     # FIXME: nuke file part later
     def get_customer_license_information(self, license_key):
@@ -157,13 +106,7 @@ class LicenseManager:
                 _log.exception('failed when looking for license key %s' % license_key)
             return None                
         else:
-            for lic in get_customer_licenses():
-                try:
-                    if lic.license_key == license_key:
-                        return lic
-                except:
-                    _log.exception('failed to process license %s, skipping' % lic)
-            return None
+            return get_license_registry().get_customer_license(license_key)
     
     def _compute_temporary_validity_period(self, customer_validity_start, customer_validity_end):
         # Compute validity time and recheck time
@@ -363,9 +306,10 @@ class LicenseManager:
     def create_new_demo_license(self, remote_address, remote_port, installation_uuid):
         key = str(licensekey.create_random_license())
         grant_time = datetime.datetime.utcnow()
+        registry = get_license_registry()
         f = None
         try:
-            f = open(str(os.path.join(msconstants.DEMO_LICENSE_DIRECTORY, key)), 'wb')
+            f = open(str(os.path.join(registry.demo_directory, key)), 'wb')
             f.write(textwrap.dedent("""\
             grant-time=%s
             remote-address=%s
@@ -379,16 +323,15 @@ class LicenseManager:
         finally:
             if f is not None:
                 f.close()
+        registry.reload_demo_license(key)
         return key
 
     # FIXME: file based now
     def check_existing_demo_license(self, remote_address, remote_port, installation_uuid):
-        demo_licenses = self._parse_demo_licenses()   # XXX: slow operation
-        for license_key in demo_licenses.keys():
-            lic = demo_licenses[license_key]
-            if lic.installation_uuid == installation_uuid:
-                return license_key
-        return None
+        lic = get_license_registry().find_demo_license_by_installation_uuid(installation_uuid)
+        if lic is None:
+            return None
+        return lic.license_key
 
     def detect_test_license_request_abuse(self):
         # Abuse detection.
@@ -414,12 +357,11 @@ class LicenseManager:
 
 # XXX: IP restrictions?
 
-_customer_licenses = None
-_customer_license_last_read = None
+_global_registry = None
 _re_date = re.compile(r'^(\d\d\d\d)-(\d\d)-(\d\d)$')
 
-def _parse_csv(f):            
-    import csv
+def _parse_csv_row(row):
+    """Parse one license CSV row; returns a CustomerLicense or None if the row is skipped."""
 
     # XXX: UTC?
     def _parse_date(x):   # 2008-05-01
@@ -431,78 +373,101 @@ def _parse_csv(f):
     # dummy date used for disabled licenses
     inv_date = datetime.datetime(1980, 1, 1)
 
+    if len(row) < 7:
+        return None
+
+    decrow = []
+    for i in xrange(len(row)):
+        decrow.append(row[i].decode('utf-8').strip())
+
+    lkey = decrow[0]
+    if len(lkey) != (5*5 + 4):
+        return None
+
+    try:
+        (val, broken) = licensekey.decode_license(lkey)
+        if val is None:
+            raise Exception('invalid license key')
+    except:
+        _log.warning('skipping invalid license key: %s, row: %s' % (lkey, repr(decrow)))
+        return None
+
+    # process row
+    lkey = decrow[0].upper()
+    lstr = decrow[1]
+    lstatus = decrow[2].upper()
+
+    if lstr == '':
+        pass
+    if lstatus == '':
+        raise Exception('invalid license status')
+    if not (lstatus in ['FLOATING', 'ACTIVE', 'DISABLED']):
+        raise Exception('invalid license status: %s' % lstatus)
+
+    if lstatus == 'FLOATING':
+        lvalidfrom = None
+        lvalidto = None
+        lusers = 100
+        ls2s = 100
+        lstr = 'Floating license'
+    elif lstatus == 'DISABLED':
+        lvalidfrom = inv_date
+        lvalidto = inv_date
+        lusers = 0
+        ls2s = 0
+        lstr = 'Disabled'
+    elif lstatus == 'ACTIVE':
+        lvalidfrom = _parse_date(decrow[3])
+        lvalidto = _parse_date(decrow[4])
+        lusers = int(decrow[5])
+        ls2s = int(decrow[6])
+    else:
+        raise Exception('invalid status for license, did not expect to get here')
+
+    return CustomerLicense(lkey, lvalidfrom, lvalidto, lstr, lusers, ls2s)
+
+def _parse_csv(f, previous=None):
+    """Parse license CSV file.
+
+    If previous is given, it is a dict of CSV row (tuple) -> CustomerLicense
+    from an earlier parse; unchanged rows are not parsed again.  Returns a
+    list of CustomerLicense instances and a dict of rows for the next parse.
+    """
+    import csv
+
+    if previous is None:
+        previous = {}
+
     res = []
+    rows = {}
     
     reader = csv.reader(f)
     for row in reader:
         try:
-            if len(row) < 7:
-                continue
-
-            decrow = []
-            for i in xrange(len(row)):
-                decrow.append(row[i].decode('utf-8').strip())
-
-            lkey = decrow[0]
-            if len(lkey) != (5*5 + 4):
-                continue
-        
-            try:
-                (val, broken) = licensekey.decode_license(lkey)
-                if val is None:
-                    raise Exception('invalid license key')
-            except:
-                _log.warning('skipping invalid license key: %s, row: %s' % (lkey, repr(decrow)))
-                continue
-
-            # process row
-            lkey = decrow[0].upper()
-            lstr = decrow[1]
-            lstatus = decrow[2].upper()
-
-            if lstr == '':
-                pass
-            if lstatus == '':
-                raise Exception('invalid license status')
-            if not (lstatus in ['FLOATING', 'ACTIVE', 'DISABLED']):
-                raise Exception('invalid license status: %s' % lstatus)
-
-            if lstatus == 'FLOATING':
-                lvalidfrom = None
-                lvalidto = None
-                lusers = 100
-                ls2s = 100
-                lstr = 'Floating license'
-            elif lstatus == 'DISABLED':
-                lvalidfrom = inv_date
-                lvalidto = inv_date
-                lusers = 0
-                ls2s = 0
-                lstr = 'Disabled'
-            elif lstatus == 'ACTIVE':
-                lvalidfrom = _parse_date(decrow[3])
-                lvalidto = _parse_date(decrow[4])
-                lusers = int(decrow[5])
-                ls2s = int(decrow[6])
+            rowkey = tuple(row)
+            if previous.has_key(rowkey):
+                lic = previous[rowkey]
             else:
-                raise Exception('invalid status for license, did not expect to get here')
-
-            res.append(CustomerLicense(lkey, lvalidfrom, lvalidto, lstr, lusers, ls2s))
+                lic = _parse_csv_row(row)
+            if lic is not None:
+                res.append(lic)
+                rows[rowkey] = lic
         except:
             _log.exception('failed to process license csv row: %s' % repr(row))
 
-    return res
+    return res, rows
 
 def _get_csv_licenses(fname):
     f = None
     try:
         f = open(fname, 'rb')
-        return _parse_csv(f)
+        res, rows = _parse_csv(f)
+        return res
     finally:
         if f is not None:
             f.close()
             f = None
-    
+
 # XXX: unclean interfaces now, master uses this to detect changes
 def get_customer_license_csv_md5():
     f = None
@@ -514,43 +479,157 @@ def get_customer_license_csv_md5():
             f.close()
             f = None
 
-# XXX: unclean API
-def force_customer_license_reread():
-    global _customer_licenses
-    _customer_licenses = None
-    
-def get_customer_licenses():
-    """Get customer licenses, re-reading from disk if necessary."""
-    
-    global _customer_licenses
-    global _customer_license_last_read
+def _parse_demo_license(directory, license_key):
+    re_keyval = re.compile(r'^(.*?)=(.*?)$')
 
-    now = datetime.datetime.utcnow()
-    reread = False
-    reread_limit = 5*60  # 5 min
+    grant_time = None
+    remote_address = None
+    remote_port = None
+    installation_uuid = None
     
-    if _customer_licenses is None:
-        reread = True
-    elif _customer_license_last_read is None:
-        reread = True
+    f = None
+    try:
+        try:
+            fname = str(os.path.join(directory, license_key))
+            f = open(fname, 'rb')
+            for line in f.readlines():
+                line = line.strip()
+                m = re_keyval.match(line)
+                if m is not None:
+                    g = m.groups()
+                    if len(g) == 2:
+                        key, value = g[0], g[1]
+                        if key == 'grant-time':
+                            grant_time = datatypes.parse_datetime_from_iso8601_subset(value)
+                        elif key == 'remote-address':
+                            remote_address = datatypes.IPv4Address.fromString(value)
+                        elif key == 'remote-port':
+                            remote_port = int(value)
+                        elif key == 'installation-uuid':
+                            installation_uuid = str(value)
+                        else:
+                            _log.warning('skipping demo license key-value pair: %s=%s' % (key,value))
+        except IOError:
+            # eat error
+            pass
+        except:
+            _log.exception('failed in parsing demo license file for license key %s' % license_key)
+            raise
+    finally:
+        if f is not None:
+            f.close()
+
+    if (grant_time is not None) and (remote_address is not None) and (remote_port is not None) and (installation_uuid is not None):
+        return DemoLicense(license_key, grant_time, remote_address, remote_port, installation_uuid, None)
     else:
-        diff = now - _customer_license_last_read
-        if (diff < datetime.timedelta(0, 0, 0)) or (diff > datetime.timedelta(0, reread_limit, 0)):
-            reread = True
+        return None
+
+# --------------------------------------------------------------------------
+
+class LicenseRegistry:
+    """In-memory license tables indexed by license key and installation UUID.
+
+    Customer licenses are read from the license CSV file and demo licenses
+    from the demo license directory.  Reloads are incremental: an unchanged
+    CSV file is not parsed at all, unchanged CSV rows reuse their earlier
+    CustomerLicense instance (skipping license key decoding), and only new
+    or modified demo license files are parsed.  A reload builds new tables
+    and swaps them in with a single assignment, so lookups always see either
+    the old or the new tables; if a reload fails, the old tables are kept.
+
+    Sources are checked for changes at most every
+    msconstants.LICENSE_RELOAD_INTERVAL seconds (see L{check_reload}).
+    Lookup and reload timings are available from L{get_statistics}.
+    """
+
+    def __init__(self, csv_file=msconstants.LICENSE_CSV_FILE, demo_directory=msconstants.DEMO_LICENSE_DIRECTORY):
+        self.csv_file = csv_file
+        self.demo_directory = demo_directory
+
+        # (customers by key, demos by key, demos by installation uuid); replaced, never modified
+        self._tables = ({}, {}, {})
+        self._csv_md5 = None
+        self._csv_rows = {}       # csv row tuple -> CustomerLicense
+        self._changed_keys = {}   # license key -> True, for keys changed in reloads
+        self._demo_stats = {}     # license key -> (mtime, size) of parsed demo license file
+        self._last_check = None
+
+        self._lookup_count = 0
+        self._lookup_time = 0.0
+        self._lookup_time_max = 0.0
+        self._reload_count = 0
+        self._last_reload_time = None
+        self._last_reload_changes = None
+
+    # ----------------------------------------------------------------------
+
+    def _swap(self, customers=None, demos=None):
+        old_customers, old_demos, old_demos_by_uuid = self._tables
+        if customers is None:
+            customers = old_customers
+        if demos is None:
+            demos = old_demos
+            demos_by_uuid = old_demos_by_uuid
         else:
-            reread = False
-        
-    if reread:
-        _customer_license_last_read = now
-        
-        t = _get_csv_licenses(msconstants.LICENSE_CSV_FILE)
-        
-        # sanity
-        chk = {}
+            demos_by_uuid = {}
+            for lic in demos.values():
+                # keep the oldest demo license of an installation
+                if demos_by_uuid.has_key(lic.installation_uuid):
+                    if demos_by_uuid[lic.installation_uuid].grant_time <= lic.grant_time:
+                        continue
+                demos_by_uuid[lic.installation_uuid] = lic
+        self._tables = (customers, demos, demos_by_uuid)
+
+    def _reload_done(self, starttime, what, added, removed, changed):
+        self._reload_count += 1
+        self._last_reload_time = time.time() - starttime
+        self._last_reload_changes = (added, removed, changed)
+        _log.info('reloaded %s in %.3f seconds: %d added, %d removed, %d changed' % (what, self._last_reload_time, added, removed, changed))
+
+    def reload_customer_licenses(self, force=False):
+        """Reload customer licenses from the license CSV file if it has changed.
+
+        Keys of added, removed, and changed licenses are remembered until
+        L{pop_changed_license_keys} is called.
+        """
+
+        starttime = time.time()
+
+        f = open(self.csv_file, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        csv_md5 = md5.md5(data).digest().encode('hex')
+        if (csv_md5 == self._csv_md5) and (not force):
+            _log.debug('license csv unchanged, not reloading')
+            return
+
+        t, rows = _parse_csv(StringIO.StringIO(data), previous=self._csv_rows)
+
+        new = {}
         for i in t:
-            if chk.has_key(i.license_key):
+            if new.has_key(i.license_key):
                 raise Exception('duplicate license key: %s' % i.license_key)
-            chk[i.license_key] = True
+            new[i.license_key] = i
+
+        old = self._tables[0]
+        added, removed, changed = 0, 0, 0
+        changed_keys = []
+        for k in new.keys():
+            if not old.has_key(k):
+                added += 1
+                changed_keys.append(k)
+            elif old[k] is not new[k]:
+                changed += 1
+                changed_keys.append(k)
+        for k in old.keys():
+            if not new.has_key(k):
+                removed += 1
+                changed_keys.append(k)
+        for k in changed_keys:
+            self._changed_keys[k] = True
 
         # write to /tmp for debugging
         f = None
@@ -562,11 +641,157 @@ def get_customer_licenses():
             if f is not None:
                 f.close()
                 f = None
-        
-        _customer_licenses = t
+
+        self._swap(customers=new)
+        self._csv_md5 = csv_md5
+        self._csv_rows = rows
+        self._reload_done(starttime, 'customer licenses', added, removed, changed)
+
+    def pop_changed_license_keys(self):
+        """Return and forget keys of customer licenses changed by reloads."""
+        res = self._changed_keys.keys()
+        self._changed_keys = {}
+        return res
+
+    def reload_demo_licenses(self):
+        """Reload demo licenses, parsing only new and modified demo license files."""
+
+        starttime = time.time()
+        old = self._tables[1]
+        new = {}
+        stats = {}
+        added, removed, changed = 0, 0, 0
+
+        for license_key in os.listdir(self.demo_directory):
+            try:
+                st = os.stat(os.path.join(self.demo_directory, license_key))
+                stat_key = (st.st_mtime, st.st_size)
+                if self._demo_stats.get(license_key) == stat_key:
+                    if old.has_key(license_key):
+                        new[license_key] = old[license_key]
+                    stats[license_key] = stat_key
+                    continue
+
+                lic = _parse_demo_license(self.demo_directory, license_key)
+                stats[license_key] = stat_key
+                if lic is None:
+                    continue
+                new[license_key] = lic
+                if old.has_key(license_key):
+                    changed += 1
+                else:
+                    added += 1
+            except:
+                _log.exception('failed in parsing demo license %s' % license_key)
+
+        for k in old.keys():
+            if not new.has_key(k):
+                removed += 1
+
+        self._swap(demos=new)
+        self._demo_stats = stats
+        self._reload_done(starttime, 'demo licenses', added, removed, changed)
+
+    def reload_demo_license(self, license_key):
+        """Reload a single demo license, e.g. after creating it."""
+
+        new = dict(self._tables[1])
+        path = os.path.join(self.demo_directory, license_key)
+        lic = None
+        if os.path.exists(path):
+            st = os.stat(path)
+            lic = _parse_demo_license(self.demo_directory, license_key)
+            self._demo_stats[license_key] = (st.st_mtime, st.st_size)
+        if lic is None:
+            if new.has_key(license_key):
+                del new[license_key]
+        else:
+            new[license_key] = lic
+        self._swap(demos=new)
+
+    def check_reload(self):
+        """Reload changed sources if they have not been checked recently."""
+
+        now = datetime.datetime.utcnow()
+        if self._last_check is not None:
+            diff = now - self._last_check
+            if (diff >= datetime.timedelta(0, 0, 0)) and (diff <= datetime.timedelta(0, msconstants.LICENSE_RELOAD_INTERVAL, 0)):
+                return
+        self._last_check = now
+
+        try:
+            self.reload_customer_licenses()
+        except:
+            _log.exception('failed to reload customer licenses, using old ones')
+        try:
+            self.reload_demo_licenses()
+        except:
+            _log.exception('failed to reload demo licenses, using old ones')
+
+    # ----------------------------------------------------------------------
+
+    def _lookup(self, table, key):
+        starttime = time.time()
+        self.check_reload()
+        res = self._tables[table].get(key)
+        t = time.time() - starttime
+        self._lookup_count += 1
+        self._lookup_time += t
+        if t > self._lookup_time_max:
+            self._lookup_time_max = t
+        return res
+
+    def get_customer_license(self, license_key):
+        """Get CustomerLicense for a license key, or None."""
+        return self._lookup(0, license_key)
+
+    def get_demo_license(self, license_key):
+        """Get DemoLicense for a license key, or None."""
+        return self._lookup(1, license_key)
+
+    def find_demo_license_by_installation_uuid(self, installation_uuid):
+        """Get the oldest DemoLicense granted to an installation, or None."""
+        return self._lookup(2, installation_uuid)
+
+    def get_customer_licenses(self):
+        return self._tables[0].values()
+
+    def get_demo_licenses(self):
+        return self._tables[1].values()
+
+    def get_statistics(self):
+        """Get registry sizes and lookup and reload timings (in seconds) as a dict."""
+
+        lookup_time_avg = None
+        if self._lookup_count > 0:
+            lookup_time_avg = self._lookup_time / float(self._lookup_count)
+        return { 'customer_licenses': len(self._tables[0]),
+                 'demo_licenses': len(self._tables[1]),
+                 'lookups': self._lookup_count,
+                 'lookup_time_avg': lookup_time_avg,
+                 'lookup_time_max': self._lookup_time_max,
+                 'reloads': self._reload_count,
+                 'last_reload_time': self._last_reload_time,
+                 'last_reload_changes': self._last_reload_changes }
+
+# XXX: unclean API
+def force_customer_license_reread():
+    """Reread customer licenses; returns a list of license keys changed since last call."""
+    registry = get_license_registry()
+    registry.reload_customer_licenses(force=True)
+    return registry.pop_changed_license_keys()
     
-    return _customer_licenses
+def get_customer_licenses():
+    """Get customer licenses, re-reading from disk if necessary."""
+    registry = get_license_registry()
+    registry.check_reload()
+    return registry.get_customer_licenses()
 
 def get_demo_licenses():
-    lm = LicenseManager(None)
-    return lm.get_demo_licenses()
+    return get_license_registry().get_demo_licenses()
+
+def get_license_registry():
+    global _global_registry
+    if _global_registry is None:
+        _global_registry = LicenseRegistry()
+    return _global_registry
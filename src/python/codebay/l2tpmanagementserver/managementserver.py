@@ -29,7 +29,7 @@ unstable_version=<e.g. "1.1">
 """
 __docformat__ = 'epytext en'
 
-import datetime
+import os, time, datetime, random, collections
 
 from twisted.internet import protocol, reactor, defer
 from twisted.application import service
@@ -134,6 +134,177 @@ def require_successful_identify():
 
 # --------------------------------------------------------------------------
 
+class IdentifyContext:
+    """Per-master state used for handling Identify requests.
+
+    Keeps everything an Identify needs that does not depend on the request:
+    shared license and update managers, repository keys (re-read only when
+    the file changes), and the connection indexes needed to handle an
+    Identify in constant time, i.e. the set of connections and a dict of
+    cookie UUID -> connection.  Changelogs are served from the apt cache,
+    which is refreshed in the background (see L{aptsupport.AptCache}).
+    """
+
+    def __init__(self, master, aptcache, repository_keys_file=msconstants.REPOSITORY_KEYS_FILE):
+        self.master = master
+        self.aptcache = aptcache
+        self.repository_keys_file = repository_keys_file
+        self.licensemanager = licensemanager.LicenseManager(master)
+        self.updatemanager = UpdateManager(master, aptcache)
+        self.connections = set()
+        self.cookies = {}   # cookie uuid -> connection
+        self._repokeys = None
+        self._repokeys_stat = None
+
+    def get_repository_keys(self):
+        st = os.stat(self.repository_keys_file)
+        stat_key = (st.st_mtime, st.st_size)
+        if (self._repokeys is None) or (stat_key != self._repokeys_stat):
+            f = open(self.repository_keys_file, 'rb')
+            try:
+                self._repokeys = f.read()
+            finally:
+                f.close()
+            self._repokeys_stat = stat_key
+        return self._repokeys
+
+    def get_aptsource(self, peer_host):
+        # Determine proper aptsource - stable or unstable currently
+        if peer_host in self.master.beta_servers:
+            _log.info('beta server detected, using unstable source')
+            return self.master.unstable_aptsource
+        return self.master.stable_aptsource
+
+    def connection_made(self, conn):
+        self.connections.add(conn)
+
+    def connection_lost(self, conn):
+        self.connections.discard(conn)
+        self.set_cookie(conn, None)
+
+    def cookie_in_use(self, cookie_uuid, exclude=None):
+        """Check whether another connection (than exclude) uses a cookie UUID."""
+        if (cookie_uuid is None) or (cookie_uuid == ''):
+            return False
+        conn = self.cookies.get(cookie_uuid)
+        return (conn is not None) and (conn is not exclude)
+
+    def set_cookie(self, conn, cookie_uuid):
+        """Update the cookie UUID of a connection in the cookie index."""
+        old = getattr(conn, 'client_cookie_uuid', None)
+        if (old is not None) and (self.cookies.get(old) is conn):
+            del self.cookies[old]
+        if (cookie_uuid is not None) and (cookie_uuid != ''):
+            self.cookies[cookie_uuid] = conn
+
+def compute_identify_response(context, kw, identify_version, peer_host, peer_port, conn=None):
+    """Handle Identify, Identify2, Identify3, Identify4.
+
+    Computes the Identify response without touching the connection; conn is
+    only used to tell its own cookie apart from cookies of other connections.
+    Peer host and port are those seen by the server.  Returns a tuple of the
+    response dict and a dict of connection attributes to set for a successful
+    Identify.
+
+    This is not free of side effects otherwise: the license lookup may
+    reload the license registry from disk (see
+    L{licensemanager.LicenseRegistry.check_reload}), which also rewrites its
+    debug dump of active licenses.
+    """
+    arg_licenseKey = kw['licenseKey']
+    arg_bootUuid = kw['bootUuid']
+    arg_installationUuid = kw['installationUuid']
+    arg_cookieUuid = None
+    arg_address = kw['address']
+    arg_softwareVersion = kw['softwareVersion']
+    arg_automaticUpdates = kw['automaticUpdates']
+
+    # cookieUuid only present in Identify2
+    request_had_cookie = False
+    if kw.has_key('cookieUuid'):
+        request_had_cookie = True
+        arg_cookieUuid = kw['cookieUuid']
+
+    res = {}
+
+    # Fill in fixed server info
+    res['softwareBuildInfo'] = msconstants.SERVER_IDENTIFY_SOFTWARE_BUILD_INFO
+    res['serverInfo'] = msconstants.SERVER_IDENTIFY_SERVER_INFO
+
+    # Check license; either anonymous (no license) or non-anonymous
+    context.licensemanager.license_lookup(res, arg_licenseKey)
+
+    aptsource = context.get_aptsource(peer_host)
+
+    # Update check
+    context.updatemanager.update_check(res, arg_softwareVersion, arg_automaticUpdates, aptsource)
+
+    # Always send up-to-date sources.list; client must only use if update_needed = True
+    res['aptSourcesList'] = aptsource
+
+    # Always send repo keys; repokeys are currently version independent
+    res['repositoryKeys'] = context.get_repository_keys()
+
+    # Always send current changelog
+    current_version, current_changelog = context.aptcache.get_apt_info(aptsource)
+    if current_changelog is not None:
+        res['changeLog'] = current_changelog
+    else:
+        _log.error('changelog information not available, sending back empty string')
+        res['changeLog'] = ''
+
+    # Basic information for connection state
+    state = {'identify_successful': True,
+             'license_key': arg_licenseKey,
+             'license_status': res['licenseStatus'],
+             'is_demo_license': res['isDemoLicense'],
+             'client_software_version': arg_softwareVersion,
+             'client_installation_uuid': arg_installationUuid,
+             'client_boot_uuid': arg_bootUuid,
+             'client_cookie_uuid': None}
+
+    # Fill in cookie for Identify2
+    if request_had_cookie:
+        # FIXME - what to do we actually want to do with the cookie?
+        #
+        # This is the current heuristic for cookies which doesn't actually do
+        # anything useful except that it tries to keep the cookies unique.
+        # The connection's own (earlier) cookie does not count as a collision.
+
+        if arg_cookieUuid == '':
+            res_cookie = randutil.random_uuid()
+        else:
+            if context.cookie_in_use(arg_cookieUuid, exclude=conn):
+                res_cookie = randutil.random_uuid()
+                _log.warning('cookie %s already in use, generated new cookie %s for client' % (arg_cookieUuid, res_cookie))
+            else:
+                res_cookie = arg_cookieUuid
+        res['cookieUuid'] = unicode(res_cookie)
+
+        # Update cookie in state
+        state['client_cookie_uuid'] = res_cookie
+
+    # Address processing for Identify3
+    if identify_version >= 3:
+        behind_nat = False
+        if (arg_address != unicode(peer_host)):
+            behind_nat = True
+
+        res['clientAddressSeenByServer'] = unicode(peer_host)
+        res['clientPortSeenByServer'] = int(peer_port)
+        res['behindNat'] = behind_nat
+
+    # Currently no v4 specific stuff
+    if identify_version >= 4:
+        pass
+
+    # Fill in current time (last to minimize time diff)
+    res['currentUtcTime'] = datetime.datetime.utcnow()
+
+    return res, state
+
+# --------------------------------------------------------------------------
+
 class ManagementServerProtocol(amphelpers.LoggingAMP):
     """Implementations of management server commands.
 
@@ -144,9 +315,8 @@ class ManagementServerProtocol(amphelpers.LoggingAMP):
     """
     def __init__(self, master):
         self.master = master
-        self.aptcache = aptsupport.get_aptcache()
-        self.licensemanager = licensemanager.LicenseManager(self.master)
-        self.updatemanager = UpdateManager(self.master, self.aptcache)
+        self.identify_context = master.identify_context
+        self.licensemanager = self.identify_context.licensemanager
         self.version_successful = False
         self.version_number = 0
         self.identify_successful = False
@@ -229,117 +399,13 @@ class ManagementServerProtocol(amphelpers.LoggingAMP):
 
     def _handle_identify(self, kw, identify_version):
         """Handle Identify, Identify2, Identify3, Identify4"""
-        arg_primary = kw['isPrimary']
-        arg_licenseKey = kw['licenseKey']
-        arg_bootUuid = kw['bootUuid']
-        arg_installationUuid = kw['installationUuid']
-        arg_cookieUuid = None
-        arg_address = kw['address']
-        arg_port = kw['port']
-        arg_softwareVersion = kw['softwareVersion']
-        arg_softwareBuildInfo = kw['softwareBuildInfo']
-        arg_hardwareType = kw['hardwareType']
-        arg_hardwareInfo = kw['hardwareInfo']
-        arg_automaticUpdates = kw['automaticUpdates']
-        arg_isLiveCd = kw['isLiveCd']
-
-        # cookieUuid only present in Identify2
-        request_had_cookie = False
-        if kw.has_key('cookieUuid'):
-            request_had_cookie = True
-            arg_cookieUuid = kw['cookieUuid']
-        
-        res = {}
-
-        # Fill in fixed server info
-        res['softwareBuildInfo'] = msconstants.SERVER_IDENTIFY_SOFTWARE_BUILD_INFO
-        res['serverInfo'] = msconstants.SERVER_IDENTIFY_SERVER_INFO
-
-        # Check license; either anonymous (no license) or non-anonymous
-        self.licensemanager.license_lookup(res, arg_licenseKey)
-
-        # Determine proper aptsource - stable or unstable currently
-        aptsource = None
-        repokeys = None
-        if str(self.transport.getPeer().host) in self.master.beta_servers:
-            _log.info('beta server detected, using unstable source')
-            aptsource = self.master.unstable_aptsource
-        else:
-            aptsource = self.master.stable_aptsource
-
-        # Repokeys are currently version independent
-        f = open(msconstants.REPOSITORY_KEYS_FILE, 'rb')
-        repokeys = f.read()
-        f.close()
-
-        # Update check
-        self.updatemanager.update_check(res, arg_softwareVersion, arg_automaticUpdates, aptsource)
-
-        # Always send up-to-date sources.list; client must only use if update_needed = True
-        res['aptSourcesList'] = aptsource
-
-        # Always send repo keys
-        res['repositoryKeys'] = repokeys
-
-        # Always send current changelog
-        current_version, current_changelog = self.aptcache.get_apt_info(aptsource)
-        if current_changelog is not None:
-            res['changeLog'] = current_changelog
-        else:
-            _log.error('changelog information not available, sending back empty string')
-            res['changeLog'] = ''
+        peer = self.transport.getPeer()
+        res, state = compute_identify_response(self.identify_context, kw, identify_version, str(peer.host), peer.port, conn=self)
 
         # Store basic information to own state
-        self.identify_successful = True
-        self.license_key = arg_licenseKey
-        self.license_status = res['licenseStatus']
-        self.is_demo_license = res['isDemoLicense']
-        self.client_software_version = arg_softwareVersion
-        self.client_installation_uuid = arg_installationUuid
-        self.client_boot_uuid = arg_bootUuid
-        self.client_cookie_uuid = None
-
-        # Note: self.client_cookie_uuid is set to None initially to ensure that the
-        # concurrent cookie check below does not mistakenly match this connection
-
-        # Fill in cookie for Identify2
-        if request_had_cookie:
-            # FIXME - what to do we actually want to do with the cookie?
-            #
-            # This is the current heuristic for cookies which doesn't actually do
-            # anything useful except that it tries to keep the cookies unique.
-
-            if arg_cookieUuid == '':
-                res_cookie = randutil.random_uuid()
-            else:
-                if self.master.cookie_used_by_a_management_connection(arg_cookieUuid):
-                    res_cookie = randutil.random_uuid()
-                    _log.warning('cookie %s already in use, generated new cookie %s for client' % (arg_cookieUuid, res_cookie))
-                else:
-                    res_cookie = arg_cookieUuid
-            res['cookieUuid'] = unicode(res_cookie)
-
-            # Update cookie in state
-            self.client_cookie_uuid = res_cookie
-
-        # Address processing for Identify3
-        if identify_version >= 3:
-            local_addr = self.transport.getHost()
-            remote_addr = self.transport.getPeer()
-            behind_nat = False
-            if (arg_address != unicode(remote_addr.host)):
-                behind_nat = True
-            
-            res['clientAddressSeenByServer'] = unicode(remote_addr.host)
-            res['clientPortSeenByServer'] = int(remote_addr.port)
-            res['behindNat'] = behind_nat
-
-        # Currently no v4 specific stuff
-        if identify_version >= 4:
-            pass
-        
-        # Fill in current time (last to minimize time diff)
-        res['currentUtcTime'] = datetime.datetime.utcnow()
+        self.identify_context.set_cookie(self, state['client_cookie_uuid'])
+        for k in state.keys():
+            setattr(self, k, state[k])
 
         return res
 
@@ -419,6 +485,138 @@ class ManagementServerProtocolFactory(protocol.Factory):
 
 # --------------------------------------------------------------------------
 
+class ReidentifyScheduler:
+    """Spread reidentify requests to management connections over time.
+
+    Reidentify requests cause every client to send an Identify at once, so
+    they are not sent in one go.  Connections are queued and sent from a
+    one second timer so that the queue is drained in roughly
+    msconstants.REIDENTIFY_WINDOW seconds, but never more than
+    msconstants.REIDENTIFY_MAX_PER_SECOND requests per second and never
+    more than msconstants.REIDENTIFY_MAX_OUTSTANDING unanswered requests at
+    a time.  Priority connections (e.g. those whose license changed) are
+    sent first; the rest are sent in random order.
+    """
+
+    def __init__(self, master):
+        self.master = master
+        self._priority = collections.deque()   # connections, sent first
+        self._normal = collections.deque()     # connections, sent in random order
+        self._queued = {}                      # connection -> 'priority' or 'normal'
+        self._outstanding = 0
+        self._window_end = None
+        self._call = None
+        self.sent = 0
+        self.failed = 0
+        self.total = 0
+
+    def schedule(self, connections, priority=None):
+        """Queue reidentify for connections; priority is a list of connections to send first."""
+        if priority is None:
+            priority = []
+
+        # progress counters cover one round of reidentifies
+        if self.pending() == 0:
+            self.sent, self.failed, self.total = 0, 0, 0
+
+        # a connection moved from normal to priority is left in the normal
+        # queue and skipped there, see _timer_callback()
+        for c in priority:
+            state = self._queued.get(c)
+            if state == 'priority':
+                continue
+            if state is None:
+                self.total += 1
+            self._queued[c] = 'priority'
+            self._priority.append(c)
+
+        normal = []
+        for c in connections:
+            if self._queued.has_key(c):
+                continue
+            self._queued[c] = 'normal'
+            normal.append(c)
+        random.shuffle(normal)
+        self._normal.extend(normal)
+        self.total += len(normal)
+
+        now = datetime.datetime.utcnow()
+        self._window_end = now + datetime.timedelta(0, msconstants.REIDENTIFY_WINDOW, 0)
+        _log.info('scheduled reidentify: %d priority, %d other connections pending' % (len(priority), self.pending() - len(priority)))
+        if self._call is None:
+            self._call = reactor.callLater(0, self._timer_callback)
+
+    def stop(self):
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+    def connection_lost(self, c):
+        if self._queued.has_key(c):
+            del self._queued[c]
+            self.total -= 1
+
+    def pending(self):
+        return len(self._queued)
+
+    def get_progress_string(self):
+        if self.total == 0:
+            return 'none'
+        return '%d/%d sent, %d failed, %d pending, %d outstanding' % (self.sent, self.total, self.failed, self.pending(), self._outstanding)
+
+    def _send_count(self):
+        remaining = 1
+        if self._window_end is not None:
+            diff = self._window_end - datetime.datetime.utcnow()
+            remaining = max(1, diff.days*24*60*60 + diff.seconds)
+        count = (self.pending() + remaining - 1) / remaining
+        count = max(1, min(count, msconstants.REIDENTIFY_MAX_PER_SECOND))
+        return min(count, msconstants.REIDENTIFY_MAX_OUTSTANDING - self._outstanding)
+
+    def _timer_callback(self):
+        self._call = None
+
+        count = self._send_count()
+        while (count > 0) and (self.pending() > 0):
+            if len(self._priority) > 0:
+                c = self._priority.popleft()
+                state = 'priority'
+            else:
+                c = self._normal.popleft()
+                state = 'normal'
+            if self._queued.get(c) != state:
+                continue
+            del self._queued[c]
+            self._send(c)
+            count -= 1
+
+        if self.pending() > 0:
+            self._call = reactor.callLater(1.0, self._timer_callback)
+        else:
+            _log.info('reidentify requests sent: %s' % self.get_progress_string())
+
+    def _send(self, c):
+        def _done(res):
+            self._outstanding -= 1
+            return res
+
+        def _failed(reason):
+            self.failed += 1
+            _log.warning('reidentify failed for conn %s: %s' % (c, reason))
+
+        self.sent += 1
+        try:
+            d = c.request_reidentify()
+        except:
+            self.failed += 1
+            _log.exception('cannot reidentify client, conn %s' % c)
+            return
+        self._outstanding += 1
+        d.addBoth(_done)
+        d.addErrback(_failed)
+
+# --------------------------------------------------------------------------
+
 class ManagementServerMaster:
     def __init__(self, config_parser):
         # config parsing
@@ -433,15 +631,19 @@ class ManagementServerMaster:
             self.beta_servers.append(i)
         
         # rest of the initialization
-        self.connections = []
         self.stable_aptsource = self._aptsource(parser.get('misc', 'stable_version'))
         self.unstable_aptsource = self._aptsource(parser.get('misc', 'unstable_version'))
         self._aptcache = aptsupport.get_aptcache()
-        self._current_version, _ = self._aptcache.get_apt_info(self.stable_aptsource)
+        self._current_version = None  # set when first apt refresh completes, see start()
+        self.identify_context = IdentifyContext(self, self._aptcache)
+        self.connections = self.identify_context.connections
         self._master_check_call = None
         self._master_check_interval = msconstants.MASTER_CHECK_INTERVAL
         self._master_check_full_count = 0
         self._license_csv_md5 = licensemanager.get_customer_license_csv_md5()
+        licensemanager.get_license_registry().check_reload()
+        licensemanager.get_license_registry().pop_changed_license_keys()  # initial load
+        self._reidentify_scheduler = ReidentifyScheduler(self)
         
     # FIXME: constant names are dumb
     def _aptsource(self, ver):
@@ -456,19 +658,23 @@ class ManagementServerMaster:
         pass
 
     def start(self):
+        # prime apt information in the background; identify serves whatever is cached
+        d = self._aptcache.refresh(self.stable_aptsource)
+        d.addCallback(lambda x: self._check_product_version_and_reidentify())
+        d.addErrback(lambda x: _log.warning('initial apt refresh failed: %s' % x))
+        d = self._aptcache.refresh(self.unstable_aptsource)
+        d.addErrback(lambda x: _log.warning('initial apt refresh failed: %s' % x))
+
         self._master_check_call = reactor.callLater(self._master_check_interval, self._master_timer_callback)
 
     def stop(self):
         if self._master_check_call is not None:
             self._master_check_call.cancel()
             self._master_check_call = None
+        self._reidentify_scheduler.stop()
 
     def cookie_used_by_a_management_connection(self, cookie_uuid):
-        for c in self.connections:
-            if hasattr(c, 'client_cookie_uuid') and (c.client_cookie_uuid is not None) and (c.client_cookie_uuid != ''):
-                if c.client_cookie_uuid == cookie_uuid:
-                    return True
-        return False
+        return self.identify_context.cookie_in_use(cookie_uuid)
     
     def _master_timer_callback(self):
         self._master_check_call = None
@@ -480,6 +686,9 @@ class ManagementServerMaster:
     def _check_product_version_and_reidentify(self):
         # FIXME: always from stable aptsource.. should be client dependent
         current_version, current_changelog = self._aptcache.get_apt_info(self.stable_aptsource)
+        if current_version is None:
+            _log.info('stable version not known yet, not checking for product version change')
+            return
         if current_version != self._current_version:
             _log.info('stable version has changed (%s -> %s), reidentifying clients' % (self._current_version, current_version))
             self._force_reidentify()
@@ -493,15 +702,24 @@ class ManagementServerMaster:
         if old_md5 != new_md5:
             _log.info('license csv changed, reread and reidentify')
             self._license_csv_md5 = new_md5
-            licensemanager.force_customer_license_reread()
-            self._force_reidentify()
-
-    def _force_reidentify(self):
-        for c in self.connections:
-            try:
-                d = c.request_reidentify()
-            except:
-                _log.exception('cannot reidentify client, conn %s' % c)
+            changed_keys = licensemanager.force_customer_license_reread()
+            _log.info('%d license keys changed' % len(changed_keys))
+            self._force_reidentify(changed_license_keys=changed_keys)
+
+    def _force_reidentify(self, changed_license_keys=None):
+        """Schedule reidentify of all connections.
+
+        Connections using one of changed_license_keys are reidentified first.
+        """
+        priority = []
+        if changed_license_keys is not None:
+            keys = {}
+            for k in changed_license_keys:
+                keys[k] = True
+            for c in self.connections:
+                if (c.license_key is not None) and keys.has_key(c.license_key):
+                    priority.append(c)
+        self._reidentify_scheduler.schedule(self.connections, priority=priority)
 
     def _log_connection_status(self):
         self._master_check_full_count += 1
@@ -543,7 +761,7 @@ class ManagementServerMaster:
             tmp.append(s)
 
         summary = ', '.join(tmp)
-        _log.info('MASTERSTATUS: %d connections, %d demo, %d valid, software version %s [%s]' % (num_all, num_demo, num_valid, self._current_version, summary))
+        _log.info('MASTERSTATUS: %d connections, %d demo, %d valid, software version %s, reidentify %s [%s]' % (num_all, num_demo, num_valid, self._current_version, self._reidentify_scheduler.get_progress_string(), summary))
 
         if full_status:
             lines = []
@@ -557,6 +775,8 @@ class ManagementServerMaster:
             for l in lines:
                 _log.info(l)
 
+            _log.info('license registry statistics: %s' % licensemanager.get_license_registry().get_statistics())
+
             try:
                 f = open(msconstants.CONNECTION_INFO_FILE, 'wb')
                 for l in lines:
@@ -568,11 +788,12 @@ class ManagementServerMaster:
                 
     def connection_made(self, protocol, transport):
         _log.info('master: connection made: %s, %s' % (protocol, transport))
-        self.connections.append(protocol)
+        self.identify_context.connection_made(protocol)
         
     def connection_lost(self, protocol, reason):
         _log.info('master: connection lost: %s, %s' % (protocol, reason))
-        self.connections.remove(protocol)
+        self.identify_context.connection_lost(protocol)
+        self._reidentify_scheduler.connection_lost(protocol)
 
     def connectionLost(self, reason):
         self.master.connection_lost(self, reason)
@@ -603,3 +824,122 @@ class ManagementServerService(service.Service):
             _log.exc('Master service stop failed.')
             raise
 
+
+# --------------------------------------------------------------------------
+
+class _BenchmarkMaster:
+    """Stand-in for ManagementServerMaster in benchmark_identify()."""
+    def __init__(self):
+        self.immediate_update = False
+        self.beta_servers = []
+        self.stable_aptsource = msconstants.STABLE_APT_SOURCES_LIST
+        self.unstable_aptsource = msconstants.UNSTABLE_APT_SOURCES_LIST
+
+class _BenchmarkConnection:
+    """Stand-in for a management AMP connection in benchmark_identify()."""
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.client_cookie_uuid = None
+
+def benchmark_identify(count=5000, connections=1000, licenses=10000):
+    """Replay synthetic Identify4 requests through compute_identify_response().
+
+    A license CSV file with the given number of customer licenses and a
+    repository keys file are written to a temporary directory, apt
+    information is preloaded into a private apt cache, and count Identify
+    requests are handled for the given number of stand-in connections,
+    each reusing the cookie it was given earlier.
+
+    Each request and its response make an AMP box round-trip: they are
+    encoded with the Identify4 argument and response types, serialized to
+    wire format and parsed back, so the timings include the AMP encoding
+    cost.  The reactor, transport and Version exchange of a real
+    ManagementServerProtocol connection are left out, so the benchmark needs
+    no network and measures the Identify handling alone.
+    """
+    import tempfile, shutil
+    from codebay.common import licensekey
+    from codebay.common import twisted_amp as amp
+
+    cmd = managementprotocol.Identify4
+
+    tmpdir = tempfile.mkdtemp()
+    old_registry = licensemanager._global_registry
+    try:
+        csv_file = os.path.join(tmpdir, 'licenses.csv')
+        demo_directory = os.path.join(tmpdir, 'demo')
+        keys_file = os.path.join(tmpdir, 'repository-keys.txt')
+        os.mkdir(demo_directory)
+
+        license_keys = []
+        f = open(csv_file, 'wb')
+        for i in xrange(licenses):
+            k = str(licensekey.create_random_license())
+            license_keys.append(k)
+            f.write('%s,Customer %d,ACTIVE,2008-01-01,2030-01-01,100,10\n' % (k, i))
+        f.close()
+        f = open(keys_file, 'wb')
+        f.write('-----BEGIN PGP PUBLIC KEY BLOCK-----\n' + 'x'*2000 + '\n-----END PGP PUBLIC KEY BLOCK-----\n')
+        f.close()
+
+        licensemanager._global_registry = licensemanager.LicenseRegistry(csv_file, demo_directory)
+        licensemanager._global_registry.check_reload()
+
+        master = _BenchmarkMaster()
+        aptcache = aptsupport.AptCache(interval=24*60*60)
+        now = datetime.datetime.utcnow()
+        for src in [master.stable_aptsource, master.unstable_aptsource]:
+            aptcache.cache[src] = aptsupport.AptCacheInfo(now, '1.1.100', 'vpnease (1.1.100) dapper; urgency=low\n')
+        context = IdentifyContext(master, aptcache, repository_keys_file=keys_file)
+
+        conns = []
+        for i in xrange(connections):
+            c = _BenchmarkConnection('10.%d.%d.%d' % ((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff), 1024 + i)
+            conns.append(c)
+            context.connection_made(c)
+
+        times = []
+        for i in xrange(count):
+            c = conns[i % len(conns)]
+            cookie = c.client_cookie_uuid
+            if cookie is None:
+                cookie = ''
+            kw = {'isPrimary': True,
+                  'licenseKey': unicode(license_keys[i % len(license_keys)]),
+                  'bootUuid': u'boot-%d' % i,
+                  'installationUuid': u'installation-%d' % (i % len(conns)),
+                  'cookieUuid': unicode(cookie),
+                  'address': unicode(c.host),
+                  'port': c.port,
+                  'softwareVersion': u'1.1.100',
+                  'softwareBuildInfo': u'',
+                  'hardwareType': u'',
+                  'hardwareInfo': u'',
+                  'automaticUpdates': True,
+                  'isLiveCd': False}
+
+            start = time.time()
+            box = amp._objectsToStrings(kw, cmd.arguments, amp.AmpBox(), None)
+            box = amp.parseString(box.serialize())[0]
+            kw = amp._stringsToObjects(box, cmd.arguments, None)
+            res, state = compute_identify_response(context, kw, 4, c.host, c.port, conn=c)
+            box = cmd.makeResponse(res, None)
+            res = amp._stringsToObjects(amp.parseString(box.serialize())[0], cmd.response, None)
+            context.set_cookie(c, state['client_cookie_uuid'])
+            for k in state.keys():
+                setattr(c, k, state[k])
+            times.append(time.time() - start)
+
+        total = 0.0
+        for t in times:
+            total += t
+        print '%d identifies, %d connections, %d licenses: total %.3f s, avg %.3f ms, max %.3f ms' % \
+              (count, connections, licenses, total, total / len(times) * 1000.0, max(times) * 1000.0)
+        return total
+    finally:
+        licensemanager._global_registry = old_registry
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    benchmark_identify()
@@ -1 +1 @@
-__all__ = ['config', 'constants', 'dhcpscript', 'helpers', 'ipcheck', 'license', 'pppscripts', 'runcommand', 'startstop', 'configresolve', 'testclient', 'netidentify', 'interfacehelper', 'graphs', 'gnomeconfig', 'gdmconfig', 'firefoxconfig', 'rdfdumper', 'installer', 'versioninfo', 'aptsource', 'syslogdaemon', 'init']
+__all__ = ['config', 'constants', 'dhcpscript', 'helpers', 'ipcheck', 'license', 'pppscripts', 'runcommand', 'startstop', 'configresolve', 'testclient', 'netidentify', 'interfacehelper', 'graphs', 'rrd', 'gnomeconfig', 'gdmconfig', 'firefoxconfig', 'rdfdumper', 'installer', 'versioninfo', 'aptsource', 'syslogdaemon', 'fwmanager', 'pppscriptserver', 'init']
@@ -1 +1 @@
-__all__ = ['daemon', 'dhclient', 'ezipupdate', 'firewall', 'interface', 'ippool', 'monit', 'openl2tp', 'pluto', 'portmap', 'pppd', 'freeradius']
+__all__ = ['daemon', 'dhclient', 'ezipupdate', 'firewall', 'interface', 'ippool', 'monit', 'openl2tp', 'pluto', 'portmap', 'pppd', 'freeradius', 'fwmanager', 'pppscriptserver']
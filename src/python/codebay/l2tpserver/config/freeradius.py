@@ -1,7 +1,7 @@
 """FreeRADIUS daemon configuration wrapper."""
 __docformat__ = 'epytext en'
 
-import re, textwrap
+import os, re, textwrap, signal
 
 from codebay.common import rdf
 from codebay.common import datatypes
@@ -15,6 +15,17 @@ from codebay.l2tpserver import db
 ns = rdfconfig.ns
 run_command = runcommand.run_command
 
+_oct_escapes = ['\\%03o' % i for i in xrange(256)]
+
+def _oct_escape(s):
+    r = []
+    for i in s:
+        c = ord(i)
+        if c < 256:
+            r.append(_oct_escapes[c])
+        else:
+            r.append('\\%03o' % c)
+    return ''.join(r)
 
 class FreeradiusConfig(daemon.DaemonConfig):
     name = 'freeradius'
@@ -27,19 +38,14 @@ class FreeradiusConfig(daemon.DaemonConfig):
 
     def _create_users_file(self, cfg, resinfo, using_proxy):
         users_cfg = cfg.getS(ns.usersConfig)
-        users_config = ''
+        entries = []
         for u in users_cfg.getS(ns.users, rdf.Bag(rdf.Type(ns.User))):
-            user = ''
             username = u.getS(ns.username, rdf.String)
 
             password = None
             if u.hasS(ns.password):
                 password = u.getS(ns.password, rdf.String)
 
-            password_md5 = None
-            if u.hasS(ns.passwordMd5):
-                password_nt = u.getS(ns.passwordMd5, rdf.String)
-
             password_nt = None
             if u.hasS(ns.passwordNtHash):
                 password_nt = u.getS(ns.passwordNtHash, rdf.String)
@@ -64,12 +70,6 @@ class FreeradiusConfig(daemon.DaemonConfig):
                     self._log.warning('invalid site-to-site role for user %s, skipping' % username)
                     continue
 
-            def _oct_escape(s):
-                r = ''
-                for i in s:
-                    r += '\\%03o' % ord(i)
-                return r
-
             # XXX: only plaintext passwords possible with freeradius users -file
             # XXX: with rlm_passwd files it is the same problem
             if password is not None:
@@ -86,16 +86,16 @@ class FreeradiusConfig(daemon.DaemonConfig):
                 fixip = u.getS(ns.fixedIp, rdf.IPv4Address).toString()
                 user += '\n    Framed-IP-Address = %s' % fixip
 
-            users_config += "%s\n" % user
+            entries.append('%s\n' % user)
 
         if using_proxy:
-            users_config += textwrap.dedent("""\
+            entries.append(textwrap.dedent("""\
 
             # Direct all other users to default realm for proxying
             DEFAULT Proxy-To-Realm := default.realm.invalid
-            """)
+            """))
 
-        return {'file': constants.FREERADIUS_USERS, 'cont': users_config}
+        return {'file': constants.FREERADIUS_USERS, 'cont': ''.join(entries)}
 
 
     def _get_radius_parameters(self, cfg):
@@ -434,6 +434,77 @@ class FreeradiusConfig(daemon.DaemonConfig):
         run_command([constants.CMD_RM, '-rf', '/etc/freeradius/certs'])
         daemon.DaemonConfig.write_config(self)
 
+    def _read_file(self, fname):
+        f = None
+        try:
+            try:
+                f = open(fname, 'rb')
+                return f.read()
+            except IOError:
+                return None
+        finally:
+            if f is not None:
+                f.close()
+
+    def _get_running_pid(self):
+        try:
+            pid = int(self._read_file(self.pidfile).strip())
+            os.kill(pid, 0)
+            return pid
+        except:
+            return None
+
+    def reload_users(self):
+        """Apply a users file change to the running server without a restart.
+
+        Call after create_config().  If the users file is the only
+        configuration file which differs from the files on disk, the new
+        users file is renamed into place and the server is sent SIGHUP to
+        reread it.  Unlike a restart, the server keeps its socket open
+        meanwhile, so authentication requests are delayed, not rejected.
+
+        @return: True if the change was applied (or there was nothing to
+            apply), False if the server needs a full restart.
+        """
+
+        users = None
+        for i in self.configs:
+            if i['file'] == constants.FREERADIUS_USERS:
+                users = i
+            elif self._read_file(i['file']) != i['cont']:
+                self._log.info('%s changed, freeradius restart needed' % i['file'])
+                return False
+
+        old = self._read_file(constants.FREERADIUS_USERS)
+        if users is None or old is None:
+            return False
+        if old == users['cont']:
+            self._log.info('freeradius users unchanged')
+            return True
+
+        pid = self._get_running_pid()
+        if pid is None:
+            self._log.info('freeradius not running, restart needed')
+            return False
+
+        # rename so that the server never reads a partially written file
+        tmpname = constants.FREERADIUS_USERS + '.tmp'
+        f = open(tmpname, 'wb')
+        try:
+            f.write(users['cont'])
+        finally:
+            f.close()
+        os.chmod(tmpname, 0644)
+        os.rename(tmpname, constants.FREERADIUS_USERS)
+
+        os.kill(pid, signal.SIGHUP)
+
+        old_entries = set(old.split('\n\n'))
+        new_entries = set(users['cont'].split('\n\n'))
+        self._log.info('freeradius users reloaded: %d entries added, %d removed' % \
+                       (len(new_entries - old_entries), len(old_entries - new_entries)))
+        return True
+
     def pre_stop(self):
         run_command([constants.CMD_MKDIR, '-p', constants.FREERADIUS_RUNPATH], retval=runcommand.FAIL)
         run_command([constants.CMD_CHOWN, 'freerad:freerad', constants.FREERADIUS_RUNPATH], retval=runcommand.FAIL)
@@ -0,0 +1,36 @@
+"""Firewall manager daemon configuration wrapper.
+
+The firewall manager (see L{codebay.l2tpserver.fwmanager}) is our own
+daemon and has no configuration files.  It must be started before and
+stopped after openl2tp and pppd, because PPP scripts send their device
+firewall requests to it.
+"""
+__docformat__ = 'epytext en'
+
+import os, time
+
+from codebay.l2tpserver import constants
+from codebay.l2tpserver.config import daemon
+
+class FwmanagerConfig(daemon.DaemonConfig):
+    name = 'fwmanager'
+    command = constants.CMD_L2TPGW_FWMANAGER
+    pidfile = constants.FWMANAGER_PIDFILE
+    cleanup_files = [constants.FWMANAGER_SOCKET]
+
+    def create_config(self, cfg, resinfo):
+        pass
+
+    def write_config(self):
+        pass
+
+    def start(self):
+        self.d.start_daemon(command=self.command, pidfile=self.pidfile, background=True, make_pidfile=True)
+
+    def post_start(self, *args):
+        # PPP scripts configure firewall directly until the socket exists
+        for i in xrange(50):
+            if os.path.exists(constants.FWMANAGER_SOCKET):
+                return
+            time.sleep(0.1)
+        self._log.warning('firewall manager socket not created, ppp scripts will configure firewall directly')
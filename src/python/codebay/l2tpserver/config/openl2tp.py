@@ -31,8 +31,7 @@ run_command = runcommand.run_command
 # SYSTEM      512           Internal system functions
 # PPP         1024          PPP operations
 
-_re_openl2tp_created_tunnel = re.compile(r'^.*?Created\stunnel\s+(\d+)\s*$')
-_re_openl2tp_created_session = re.compile(r'^.*?Created\ssession\s+(\d+)/(\d+)\s*$')
+_re_openl2tp_created_session_on_tunnel = re.compile(r'^.*?Created\ssession\s+(\d+)\s+on\s+tunnel\s+(\S+)\s*$')
 
 _re_openl2tp_tunnel_details_header = re.compile(r'^Tunnel\s+(\d+),\s+from\s+(.*?)\s+to\s+([0-9\.]+).*?$')
 _re_openl2tp_tunnel_details_udpports = re.compile(r'^\s+UDP\s+ports:\s+local\s+(\d+?),\s+peer\s+(\d+?)\s*$')
@@ -437,6 +436,21 @@ class Openl2tpConfig(daemon.DaemonConfig):
         daemon.DaemonConfig.hard_stop(self)
         self.d.hard_stop_daemon(command=constants.CMD_OPENL2TPCONFIG)
 
+    def _run_openl2tpconfig(self, config):
+        """Run an openl2tpconfig command script under the openl2tp config lock.
+
+        Failing commands do not stop the script; openl2tpconfig reports them
+        on stderr and continues with the next command.
+        """
+
+        lock = helpers.acquire_openl2tpconfig_lock()
+        if lock is None:
+            raise Exception('failed to acquire openl2tp config lock')
+        try:
+            return run_command([constants.CMD_OPENL2TPCONFIG], stdin=str(config))
+        finally:
+            helpers.release_openl2tpconfig_lock(lock)
+
     @db.untransact()
     def determine_tunnel_remote_address_and_port(self, tunnelid):
         """Determine remote IPv4 address and port of a specific tunnel."""
@@ -446,13 +460,9 @@ class Openl2tpConfig(daemon.DaemonConfig):
         quit
         """) % tunnelid
 
-        lock = helpers.acquire_openl2tpconfig_lock()
-        if lock is None:
-            raise Exception('failed to acquire openl2tp config lock')
-        try:
-            [rv, stdout, stderr] = run_command([constants.CMD_OPENL2TPCONFIG], stdin=str(config), retval=runcommand.FAIL)
-        finally:
-            helpers.release_openl2tpconfig_lock(lock)
+        [rv, stdout, stderr] = self._run_openl2tpconfig(config)
+        if rv != 0:
+            raise Exception('openl2tpconfig failed: %s, %s, %s' % (rv, stdout, stderr))
 
         got_tunnelid, srcaddr, srcport, dstaddr, dstport = None, None, None, None, None
         for l in stdout.split('\n'):
@@ -470,32 +480,8 @@ class Openl2tpConfig(daemon.DaemonConfig):
 
         return dstaddr, int(dstport)
 
-    # XXX: refactor configuration so that untranscat may be used here
-    # XXX: untransact may help if l2tpconfig blocks
-    def start_client_connection(self, identifier, myip, gwip, username, password):
-        l2tp_cfg = helpers.get_db_root().getS(ns.l2tpDeviceConfig, rdf.Type(ns.L2tpDeviceConfig))
-        ppp_cfg = l2tp_cfg.getS(ns.pppConfig, rdf.Type(ns.PppConfig))
-        
-        debug = helpers.get_debug(l2tp_cfg)
-
-        def _run_config(config, failmsg, successmsg):
-            rv, out, err = 1, '', ''
-
-            lock = helpers.acquire_openl2tpconfig_lock()
-            if lock is None:
-                raise Exception('failed to acquire openl2tp config lock')
-            try:
-                [rv, out, err] = run_command([constants.CMD_OPENL2TPCONFIG], stdin=str(config))
-            except:
-                pass
-            helpers.release_openl2tpconfig_lock(lock)
-            if rv != 0:
-                self._log.error('%s: %s, %s, %s' % (str(failmsg), str(rv), str(out), str(err)))
-                raise Exception(str(failmsg))
-            else:
-                self._log.debug('%s: %s, %s, %s' % (str(successmsg), str(rv), str(out), str(err)))
-
-            return rv, out, err
+    def _create_client_connection_config(self, ppp_cfg, debug, identifier, myip, gwip, username, password):
+        """Create openl2tpconfig commands for one site-to-site client connection."""
 
         our_port = 1702   # NB: yes, 1702; we differentiate client and site-to-site connections based on local port
         peer_port = 1701
@@ -507,10 +493,6 @@ class Openl2tpConfig(daemon.DaemonConfig):
         tunnel_name = 'tunnel-%s' % identifier
         session_name = 'session-%s' % identifier
 
-        # we allow openl2tp to select these and "snoop" them from stdout
-        tunnel_id = None
-        session_id = None
-
         # ppp profile
         trace_flags = '0'
         if debug:
@@ -596,19 +578,13 @@ class Openl2tpConfig(daemon.DaemonConfig):
                    ['tunnel_profile_name', tunnel_profile_name] ]:
             config += 'peer profile modify profile_name=%s %s=%s\n' % (peer_profile_name, i[0], i[1])
 
-        config += '\nquit\n'
-
-        # create profiles
-        self._log.debug('openl2tp config:\n%s' % config)
-        rv, stdout, stderr = _run_config(config, 'failed to create client-mode profiles', 'create client-mode profiles ok')
-
         # create tunnel - this triggers openl2tp
         #
         # NOTE: 'interface_name' would make life easier, but is not currently
         # supported by Openl2tp.
         #
         # XXX: 'persist', 'interface_name'
-        config = 'tunnel create tunnel_name=%s' % tunnel_name  # NB: all on one line here
+        config += 'tunnel create tunnel_name=%s' % tunnel_name  # NB: all on one line here
         for i in [ ['src_ipaddr', myip.toString()],
                    ['our_udp_port', str(our_port)],   # XXX: dup from above
                    ['peer_udp_port', str(peer_port)], # XXX: dup from above
@@ -617,93 +593,124 @@ class Openl2tpConfig(daemon.DaemonConfig):
                    ['profile_name', tunnel_profile_name],
                    ['session_profile_name', session_profile_name],
                    ['tunnel_name', tunnel_name],
-###                ['tunnel_id', tunnel_id], # XXX: for some reason can't be used, fetched below!
+###                ['tunnel_id', tunnel_id], # XXX: for some reason can't be used
                    ['use_udp_checksums', 'yes'] ]: # XXX: probably doesn't do anything now
             config += ' %s=%s' % (i[0], i[1])
+        config += '\n'
 
-        config += '\nquit\n'
-
-        # activate tunnel
-        self._log.debug('openl2tp config for tunnel:\n%s' % config)
-        rv, stdout, stderr = _run_config(config, 'failed to create client-mode tunnel', 'create client-mode tunnel ok')
-        
-        for l in stderr.split('\n'):
-            m = _re_openl2tp_created_tunnel.match(l)
-            if m is not None:
-                if tunnel_id is not None:
-                    self._log.warning('second tunnel id (%s), old one was %s; ignoring' % (m.group(1), tunnel_id))
-                else:
-                    tunnel_id = m.group(1)
-
-        self._log.debug('figured out tunnel id %s' % tunnel_id)
-        if tunnel_id is None:
-            raise Exception('could not figure tunnel id of new site-to-site tunnel (username %s) [rv: %s, out: %s, err: %s]' % (username, rv, stdout, stderr))
-
-        config = 'session create session_name=%s' % session_name
+        # create session; the tunnel is identified by name so that the
+        # session can be created in the same script as the tunnel, and the
+        # result line identifies the tunnel
+        config += 'session create session_name=%s' % session_name
         for i in [ ['tunnel_name', tunnel_name],
-                   ['tunnel_id', tunnel_id],
 ###                ['session_id', session_id], # XXX: for some reason can't be used, fetched below!
                    ['profile_name', session_profile_name],
                    ['ppp_profile_name', ppp_profile_name],
                    ['user_name', username],
                    ['user_password', password] ]:
             config += ' %s=%s' % (i[0], i[1])
+        config += '\n'
 
-        config += '\nquit\n'
+        return config
 
-        # activate session
-        self._log.debug('openl2tp config for session:\n%s' % config)
-        rv, stdout, stderr = _run_config(config, 'failed to create client-mode session', 'create client-mode session ok')
+    # XXX: refactor configuration so that untranscat may be used here
+    # XXX: untransact may help if l2tpconfig blocks
+    def start_client_connections(self, connections):
+        """Start site-to-site client connections using one openl2tpconfig run.
+
+        The connections parameter is a list of (identifier, myip, gwip,
+        username, password) tuples.  Returns a list of identifiers whose
+        connection could not be started.
+        """
+
+        if len(connections) == 0:
+            return []
+
+        l2tp_cfg = helpers.get_db_root().getS(ns.l2tpDeviceConfig, rdf.Type(ns.L2tpDeviceConfig))
+        ppp_cfg = l2tp_cfg.getS(ns.pppConfig, rdf.Type(ns.PppConfig))
+        
+        debug = helpers.get_debug(l2tp_cfg)
+
+        config = ''
+        for identifier, myip, gwip, username, password in connections:
+            config += self._create_client_connection_config(ppp_cfg, debug, identifier, myip, gwip, username, password)
+        config += '\nquit\n'
 
-        for l in stderr.split('\n'):
-            m = _re_openl2tp_created_session.match(l)
+        self._log.debug('openl2tp config:\n%s' % config)
+        rv, out, err = 1, '', ''
+        try:
+            [rv, out, err] = self._run_openl2tpconfig(config)
+        except:
+            self._log.exception('openl2tpconfig failed')
+        if rv != 0:
+            self._log.error('failed to create client-mode connections: %s, %s, %s' % (str(rv), str(out), str(err)))
+            return [c[0] for c in connections]
+        self._log.debug('create client-mode connections ok: %s, %s, %s' % (str(rv), str(out), str(err)))
+
+        # tunnel name -> session id
+        sessions = {}
+        for l in err.split('\n'):
+            m = _re_openl2tp_created_session_on_tunnel.match(l)
             if m is not None:
-                if session_id is not None:
-                    self._log.warning('second session id (%s), old one was %s; ignoring' % (m.group(2), session_id))
-                else:
-                    tun = m.group(1)
-                    if tun != tunnel_id:
-                        self._log.warning('tunnel id differs from earlier (earlier %s, found %s), ignoring' % (tunnel_id, tun))
-                    else:
-                        session_id = m.group(2)
-                        
-        self._log.debug('figured out session id %s' % session_id)
-        if session_id is None:
-            raise Exception('could not figure session id of new site-to-site tunnel (username %s) [rv: %s, out: %s, err: %s]' % (username, rv, stdout, stderr))
-
-        self._log.info('created new tunnel and session (%s/%s) for site-to-site client (username %s)' % (tunnel_id, session_id, username))
+                sessions[m.group(2)] = m.group(1)
+
+        failed = []
+        for identifier, myip, gwip, username, password in connections:
+            tunnel_name = 'tunnel-%s' % identifier
+            if sessions.has_key(tunnel_name):
+                self._log.info('created new tunnel and session (%s/%s) for site-to-site client (username %s)' % (tunnel_name, sessions[tunnel_name], username))
+            else:
+                self._log.error('could not create tunnel and session of new site-to-site tunnel (username %s)' % username)
+                failed.append(identifier)
+
+        if len(failed) > 0:
+            self._log.error('openl2tpconfig output for failed connections: [out: %s, err: %s]' % (out, err))
+
+        return failed
+
+    def start_client_connection(self, identifier, myip, gwip, username, password):
+        if len(self.start_client_connections([(identifier, myip, gwip, username, password)])) > 0:
+            raise Exception('could not create new site-to-site tunnel (username %s)' % username)
 
     @db.untransact()
-    def stop_client_connection(self, identifier):
-        """Cleanup Openl2tp state."""
+    def stop_client_connections(self, identifiers):
+        """Cleanup Openl2tp state of site-to-site client connections.
 
-        ppp_profile_name = 'ppp-prof-%s' % identifier
-        tunnel_profile_name = 'tunnel-prof-%s' % identifier
-        session_profile_name = 'session-prof-%s' % identifier
-        peer_profile_name = 'peer-prof-%s' % identifier
-        tunnel_name = 'tunnel-%s' % identifier
-        session_name = 'session-%s' % identifier
+        Uses one openl2tpconfig run for all connections.
+        """
+
+        if len(identifiers) == 0:
+            return
 
         # delete existing profiles just to be sure
+        config = ''
+        for identifier in identifiers:
+            ppp_profile_name = 'ppp-prof-%s' % identifier
+            tunnel_profile_name = 'tunnel-prof-%s' % identifier
+            session_profile_name = 'session-prof-%s' % identifier
+            peer_profile_name = 'peer-prof-%s' % identifier
+            tunnel_name = 'tunnel-%s' % identifier
+            session_name = 'session-%s' % identifier
 
-        lock = helpers.acquire_openl2tpconfig_lock()
-        if lock is None:
-            raise Exception('failed to acquire openl2tp config lock')
-        try:
             for i in [ 'session delete tunnel_name=%s session_name=%s' % (tunnel_name, session_name),
                        'tunnel delete tunnel_name=%s' % tunnel_name,
                        'ppp profile delete profile_name=%s' % ppp_profile_name,
                        'tunnel profile delete profile_name=%s' % tunnel_profile_name,
                        'session profile delete profile_name=%s' % session_profile_name,
                        'peer profile delete profile_name=%s' % peer_profile_name ]:
-                cmd = '%s\nquit\n' % i
-                [rv, out, err] = run_command([constants.CMD_OPENL2TPCONFIG], stdin=str(cmd)) # ignore errors
-                if rv != 0:
-                    self._log.debug('client connection cleanup command failed:\n command: %s, rv: %s, out: %s, err: %s' % (cmd, rv, out, err))
-                else:
-                    self._log.debug('client connection cleanup command succeeded:\n command: %s, rv: %s, out: %s, err: %s' % (cmd, rv, out, err))
-        finally:
-            helpers.release_openl2tpconfig_lock(lock)
+                config += '%s\n' % i
+        config += 'quit\n'
+
+        [rv, out, err] = self._run_openl2tpconfig(config) # ignore errors
+        if rv != 0:
+            self._log.debug('client connection cleanup commands failed:\n commands: %s, rv: %s, out: %s, err: %s' % (config, rv, out, err))
+        else:
+            self._log.debug('client connection cleanup commands succeeded:\n commands: %s, rv: %s, out: %s, err: %s' % (config, rv, out, err))
 
         # XXX: nuke pppd devices with our l2tp interface name...
         # XXX: at start of connection, nuke own ppp and ppp device ... look at ps awxuf .. look for ppp device? (pppop2tp_ifname)
+
+    def stop_client_connection(self, identifier):
+        """Cleanup Openl2tp state."""
+
+        self.stop_client_connections([identifier])
@@ -43,25 +43,29 @@ class PppdConfig(daemon.DaemonConfig):
         return '# intentionally empty\n'
     
     def _create_ppp_scripts(self, cfg):
-        """Create PPP scripts (ip-pre-up, ip-up, ip-down) as strings."""
+        """Create PPP scripts (ip-pre-up, ip-up, ip-down) as strings.
+
+        The scripts are shims which ask the PPP script server to run the
+        hook, and run it in-process only if the server is not running.
+        """
 
         ppp_script_fmt = textwrap.dedent("""\
         #!/usr/bin/python
 
-        from codebay.l2tpserver import pppscripts
+        import sys
+        from codebay.l2tpserver import pppscriptserver
 
+        args = (%(name)r, %(funcname)r, %(pubif)r, %(privif)r, %(proxyif)r)
         try:
-            s = pppscripts.PppScripts(name=%(name)r,
-                                      public_interface=%(pubif)r,
-                                      private_interface=%(privif)r,
-                                      proxyarp_interface=%(proxyif)r)
-            s.%(funcname)s()
+            rc = pppscriptserver.run_hook(*args)
         except:
             from codebay.common import logger
-            import sys
             _log = logger.get('l2tpserver.pppscripts.%(name)s')
-            _log.exception('failed')
+            _log.exception('ppp script server failed')
             sys.exit(1)
+        if rc is None:
+            rc = pppscriptserver.run_hook_in_process(*args)
+        sys.exit(rc)
         """)
 
         (pub_iface, pub_iface_name), (priv_iface, priv_iface_name) = helpers.get_ifaces(cfg)
@@ -0,0 +1,36 @@
+"""PPP script server daemon configuration wrapper.
+
+The PPP script server (see L{codebay.l2tpserver.pppscriptserver}) is our
+own daemon and has no configuration files.  It must be started before and
+stopped after openl2tp and pppd, because PPP scripts send their hook
+requests to it.
+"""
+__docformat__ = 'epytext en'
+
+import os, time
+
+from codebay.l2tpserver import constants
+from codebay.l2tpserver.config import daemon
+
+class PppscriptserverConfig(daemon.DaemonConfig):
+    name = 'pppscriptserver'
+    command = constants.CMD_L2TPGW_PPPSCRIPTSERVER
+    pidfile = constants.PPPSCRIPTSERVER_PIDFILE
+    cleanup_files = [constants.PPPSCRIPTSERVER_SOCKET]
+
+    def create_config(self, cfg, resinfo):
+        pass
+
+    def write_config(self):
+        pass
+
+    def start(self):
+        self.d.start_daemon(command=self.command, pidfile=self.pidfile, background=True, make_pidfile=True)
+
+    def post_start(self, *args):
+        # PPP scripts run hooks in-process until the socket exists
+        for i in xrange(50):
+            if os.path.exists(constants.PPPSCRIPTSERVER_SOCKET):
+                return
+            time.sleep(0.1)
+        self._log.warning('ppp script server socket not created, ppp scripts will run hooks in-process')
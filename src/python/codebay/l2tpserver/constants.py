@@ -7,6 +7,13 @@
     giving up.
 @var SIGALRM_TIMEOUT_MAIN:
     Timeout in main loop in ready state (no action yet).
+@var MONITOR_PROBE_MAX_PARALLEL:
+    Maximum number of ping/arping health check processes the runner main
+    loop runs at the same time.
+@var MONITOR_PROBE_DEADLINE:
+    Overall deadline (seconds) for all health check probes of one main loop
+    round; probes still running at the deadline are killed and count as
+    failed.  Must exceed the ping and arping wait times.
 @var LICENSE_PPP_IGNORE_IDLE_INTERVAL:
     When to consider a PPP device to be "dead" and ignored for license
     control.  If this interval passes without user traffic in *both*
@@ -306,6 +313,10 @@
     Command path.
 @var CMD_L2TPGW_UPDATE_PRODUCT:
     Command path.
+@var CMD_L2TPGW_FWMANAGER:
+    Command path.
+@var CMD_L2TPGW_PPPSCRIPTSERVER:
+    Command path.
 
 @var CMD_APT_GET:
     Command path.
@@ -702,6 +713,57 @@
 @var OPENL2TP_CONFIG_LOCK_TIMEOUT:
     Timeout to wait for openl2tp config lock.
 
+@var FWMANAGER_PIDFILE:
+    Firewall manager daemon pidfile.
+@var FWMANAGER_SOCKET:
+    Unix socket for PPP device firewall requests to firewall manager.
+@var FWMANAGER_BATCH_DELAY:
+    How long (in seconds) firewall manager collects requests into one
+    iptables-restore batch.
+@var FWMANAGER_REQUEST_TIMEOUT:
+    Timeout (in seconds) for a PPP script waiting for firewall manager.
+
+@var PPPSCRIPTSERVER_PIDFILE:
+    PPP script server daemon pidfile.
+@var PPPSCRIPTSERVER_SOCKET:
+    Unix socket for PPP hook requests to PPP script server.
+@var PPPSCRIPTSERVER_MAX_WORKERS:
+    Maximum number of PPP hooks the PPP script server runs concurrently;
+    further requests wait in the listen backlog.
+@var PPPSCRIPTSERVER_REQUEST_TIMEOUT:
+    Timeout (in seconds) for a PPP script waiting for its hook to be run
+    by the PPP script server.
+
+@var RRD_FETCH_CACHE_SIZE:
+    Number of recent RRD fetch windows cached per process.
+
+@var RETIRED_PPP_DEVICES_MAX_AGE:
+    Retired PPP devices (connection history) older than this are pruned.
+@var RETIRED_PPP_DEVICES_MAX_COUNT:
+    Maximum number of retired PPP devices (with a stop time) kept after
+    pruning.
+@var RETIRED_PPP_DEVICES_PRUNE_SLACK:
+    Retired PPP devices are pruned when a device is retired and the count
+    exceeds RETIRED_PPP_DEVICES_MAX_COUNT by this much, so that pruning
+    cost is amortized over many retirements.
+@var WEBUI_STATUS_PAGE_SIZE:
+    Number of connections per page in web UI connection status lists.
+@var WEBUI_DNS_CACHE_SIZE:
+    Maximum number of names in the web UI DNS lookup cache; least recently
+    used names are evicted first.
+@var WEBUI_DNS_CACHE_MIN_TTL:
+    Minimum time (seconds) a successful DNS lookup is cached, regardless of
+    record TTL.
+@var WEBUI_DNS_CACHE_MAX_TTL:
+    Maximum time (seconds) a successful DNS lookup is cached.
+@var WEBUI_DNS_CACHE_NEGATIVE_TTL:
+    Time (seconds) a nonexistent name is cached if the response carries no
+    SOA record to take the negative TTL from; also the upper limit for the
+    SOA based negative TTL.
+@var WEBUI_DNS_CACHE_ERROR_TTL:
+    Time (seconds) a failed lookup (e.g. timeout) is cached, so that a slow
+    resolver is not queried again on every page load.
+
 @var GNOME_BACKGROUND_IMAGE:
     Location of Gnome background image.
 @var GNOME_SPLASH_IMAGE:
@@ -716,6 +778,10 @@
 
 @var PROC_UPTIME:
     Location of proc uptime file.
+@var PROC_NET_DEV:
+    Location of proc network device statistics file.
+@var SYS_CLASS_NET:
+    Location of sysfs network device directory.
 
 @var WEBUI_DEBUG_NAV_MARKERFILE:
     If marker file exists, render admin debug nav.
@@ -755,10 +821,9 @@
     replace the default database.  Note that also the corresponding journal
     file (same name with '-journal') may exist on the disk.
 
-@var WEBUI_TEMPORARY_SQLITE_DATABASE:
-    Temporary Sqlite database for web UI export process.  Note that also the
-    corresponding journal file (same name with '-journal') may exist on the
-    disk.
+@var WEBUI_TEMPORARY_EXPORT_DIRECTORY:
+    Directory for the unnamed temporary snapshot file of the web UI export
+    process.  On disk rather than in /var/run, which may be memory backed.
 
 @var UPDATE_PROCESS_RDFXML_EXPORT_FILE:
     RDF/XML export of entire configuration created by update code BEFORE
@@ -810,6 +875,8 @@ DHCP_TRY_COUNT = 5
 POLL_INTERVAL_MAINLOOP_SIGUSR1_SANITY = 2
 TIMEOUT_MAINLOOP_SIGUSR1_SANITY = 10
 POLL_INTERVAL_MAINLOOP = 60
+MONITOR_PROBE_MAX_PARALLEL = 32
+MONITOR_PROBE_DEADLINE = 15
 
 # license control
 LICENSE_PPP_IGNORE_IDLE_INTERVAL = 30*60
@@ -1048,6 +1115,8 @@ CMD_L2TPGW_CRON = '/usr/lib/l2tpgw/l2tpgw-cron'
 CMD_L2TPGW_GNOME_AUTOSTART = '/usr/lib/l2tpgw/l2tpgw-gnome-autostart'
 CMD_L2TPGW_UPDATE = '/usr/lib/l2tpgw/l2tpgw-update'
 CMD_L2TPGW_UPDATE_PRODUCT = '/usr/lib/l2tpgw/l2tpgw-update-product'
+CMD_L2TPGW_FWMANAGER = '/usr/lib/l2tpgw/l2tpgw-fwmanager'
+CMD_L2TPGW_PPPSCRIPTSERVER = '/usr/lib/l2tpgw/l2tpgw-pppscriptserver'
 
 CMD_APT_GET = '/usr/bin/apt-get'
 CMD_APT_KEY = '/usr/bin/apt-key'
@@ -1324,11 +1393,35 @@ OPENL2TP_CONFIG_LOCK_FILE = '/var/run/l2tpgw/openl2tp-config.lock'
 
 IPTABLES_LOCK_FILE = '/var/run/l2tpgw/iptables.lock'
 
+FWMANAGER_PIDFILE = '/var/run/l2tpgw/l2tpgw-fwmanager.pid'
+FWMANAGER_SOCKET = '/var/run/l2tpgw/fwmanager.socket'
+FWMANAGER_BATCH_DELAY = 0.05
+FWMANAGER_REQUEST_TIMEOUT = 60.0
+
+PPPSCRIPTSERVER_PIDFILE = '/var/run/l2tpgw/l2tpgw-pppscriptserver.pid'
+PPPSCRIPTSERVER_SOCKET = '/var/run/l2tpgw/pppscriptserver.socket'
+PPPSCRIPTSERVER_MAX_WORKERS = 128
+PPPSCRIPTSERVER_REQUEST_TIMEOUT = 300.0
+
+RRD_FETCH_CACHE_SIZE = 8
+
+RETIRED_PPP_DEVICES_MAX_AGE = datetime.timedelta(30, 0, 0)  # 30 days
+RETIRED_PPP_DEVICES_MAX_COUNT = 1000
+RETIRED_PPP_DEVICES_PRUNE_SLACK = 100
+WEBUI_STATUS_PAGE_SIZE = 50
+WEBUI_DNS_CACHE_SIZE = 1000
+WEBUI_DNS_CACHE_MIN_TTL = 60
+WEBUI_DNS_CACHE_MAX_TTL = 3600
+WEBUI_DNS_CACHE_NEGATIVE_TTL = 300
+WEBUI_DNS_CACHE_ERROR_TTL = 30
+
 GNOME_BACKGROUND_IMAGE = '/usr/lib/l2tpgw/gnome-background.png'
 GNOME_SPLASH_IMAGE = '/usr/lib/l2tpgw/gnome-splash.png'
 GNOME_DESKTOP_ICON_IMAGE = '/usr/lib/l2tpgw/gnome-desktop-icon.png'
 
 PROC_UPTIME = '/proc/uptime'
+PROC_NET_DEV = '/proc/net/dev'
+SYS_CLASS_NET = '/sys/class/net'
 
 CONFIGURED_MARKER = '/var/lib/l2tpgw/l2tp-configured'
 
@@ -1357,7 +1450,7 @@ PRODUCT_VERSION_CACHE_FILE = '/var/run/l2tpgw/product-version-cache.txt'
 DEFAULT_TIMEZONE = 'GMT'
 
 RUNNER_TEMPORARY_SQLITE_DATABASE = '/var/run/l2tpgw/runner-temporary-database.sqlite'
-WEBUI_TEMPORARY_SQLITE_DATABASE = '/var/run/l2tpgw/webui-temporary-database.sqlite'
+WEBUI_TEMPORARY_EXPORT_DIRECTORY = '/var/lib/l2tpgw'
 UPDATE_PROCESS_RDFXML_EXPORT_FILE = '/var/lib/l2tpgw/update-configuration-export.xml'
 
 AUTOCONFIG_EXE_WINXP_32BIT = '/usr/lib/l2tpgw/webui-pages/vpnease_autoconfigure_winxp32.exe'
@@ -0,0 +1,573 @@
+"""Firewall manager daemon for per-device PPP firewall rules.
+
+PPP scripts used to set up the firewall of every new PPP device with an
+iptables-restore run of their own, and to tear it down with several dozen
+iptables commands, all under the global iptables lock.  When hundreds of
+users reconnect at the same time (e.g. after a WAN outage) the scripts
+serialize on the lock and each pays for its own process spawns.
+
+The firewall manager is a long-lived daemon started by the runner.  It
+accepts device setup and teardown requests from a local Unix socket.
+Requests received within a short batching window are coalesced (the latest
+request for a device wins) and applied with a single iptables-restore
+--noflush run.  The manager remembers the chains and jump rules of every
+device, so that teardowns can be expressed in the same restore script.
+
+If a batch fails, e.g. because the main firewall was reloaded behind our
+back, the device state is resynchronized from iptables-save and the
+requests of the batch are applied one by one, so that one bad request
+does not fail the others.  The state is also resynchronized before a
+teardown of an unknown device, because its rules may have been installed
+directly by a client which could not use the manager.
+
+Clients (see L{setup_device} and L{tear_down_device}) block until their
+batch has been applied.  If the manager is not running, they return
+False and the caller is expected to configure the firewall directly.
+
+Protocol: a client connects, sends a request and shuts down its sending
+side.  The first line of a request is the operation ('setup', 'teardown'
+or 'stats') followed by the device name; for setup, the rest of the
+request is an iptables-restore script containing the device chains.  The
+manager replies with a single line beginning with 'ok' or 'error'.
+"""
+__docformat__ = 'epytext en'
+
+import os, re, socket, select, errno, signal, time
+
+from codebay.common import logger
+from codebay.l2tpserver import constants
+from codebay.l2tpserver import runcommand
+from codebay.l2tpserver import helpers
+
+run_command = runcommand.run_command
+_log = logger.get('l2tpserver.fwmanager')
+
+_tables = ['raw', 'nat', 'mangle', 'filter']
+_re_device_name = re.compile(r'^[A-Za-z0-9_.-]+$')
+_re_device_chain = re.compile(r'^ppp_(prert|postrt|input|forward|output)_(.+)$')
+
+class FirewallManagerError(Exception):
+    """Firewall manager request failed."""
+
+class _TerminateError(Exception):
+    """Firewall manager got SIGTERM."""
+
+# --------------------------------------------------------------------------
+#
+#  Rule bookkeeping
+#
+
+class _DeviceRules:
+    """Chains and jump rules of one device in one table.
+
+    Jumps are rule specifications without the leading '-A', e.g.
+    'raw_output_ppp -o l2tp1-1 -j ppp_output_l2tp1-1', and are used to
+    delete the rules later.  Rules are the full '-A' lines of a setup
+    request, including the jumps.
+    """
+
+    def __init__(self):
+        self.chains = []
+        self.jumps = []
+        self.rules = []
+
+def _get_jump_target(tokens):
+    for i in xrange(len(tokens) - 1):
+        if tokens[i] == '-j':
+            return tokens[i+1]
+    return None
+
+def _is_device_chain(chain, dev):
+    m = _re_device_chain.match(chain)
+    return (m is not None) and (m.group(2) == dev)
+
+def _parse_device_script(dev, script):
+    """Parse a device setup script into a table -> _DeviceRules dict.
+
+    Only chains of the device itself may be declared, and rules outside
+    them must jump into them.
+    """
+
+    res = {}
+    table = None
+    for line in script.split('\n'):
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+
+        if line.startswith('*'):
+            table = line[1:]
+            if table not in _tables:
+                raise FirewallManagerError('unknown table: %s' % table)
+            res[table] = _DeviceRules()
+        elif line == 'COMMIT':
+            table = None
+        elif table is None:
+            raise FirewallManagerError('line outside table: %s' % line)
+        elif line.startswith(':'):
+            chain = line[1:].split()[0]
+            if not _is_device_chain(chain, dev):
+                raise FirewallManagerError('chain %s does not belong to device %s' % (chain, dev))
+            res[table].chains.append(chain)
+        elif line.startswith('-A '):
+            t = line.split()
+            if not _is_device_chain(t[1], dev):
+                target = _get_jump_target(t)
+                if target is None or not _is_device_chain(target, dev):
+                    raise FirewallManagerError('rule does not belong to device %s: %s' % (dev, line))
+                res[table].jumps.append(' '.join(t[1:]))
+            res[table].rules.append(line)
+        else:
+            raise FirewallManagerError('unexpected line: %s' % line)
+
+    return res
+
+def _parse_saved_rules(output):
+    """Parse iptables-save output into a device -> table -> _DeviceRules dict."""
+
+    def _get(devices, dev, table):
+        if not devices.has_key(dev):
+            devices[dev] = {}
+        if not devices[dev].has_key(table):
+            devices[dev][table] = _DeviceRules()
+        return devices[dev][table]
+
+    devices = {}
+    table = None
+    for line in output.split('\n'):
+        line = line.strip()
+        if line.startswith('*'):
+            table = line[1:]
+        elif line.startswith(':'):
+            chain = line[1:].split()[0]
+            m = _re_device_chain.match(chain)
+            if m is not None:
+                _get(devices, m.group(2), table).chains.append(chain)
+        elif line.startswith('-A '):
+            t = line.split()
+            if _re_device_chain.match(t[1]) is not None:
+                continue
+            target = _get_jump_target(t)
+            if target is None:
+                continue
+            m = _re_device_chain.match(target)
+            if m is not None:
+                _get(devices, m.group(2), table).jumps.append(' '.join(t[1:]))
+
+    return devices
+
+# --------------------------------------------------------------------------
+#
+#  Daemon
+#
+
+class _Request:
+    def __init__(self, conn):
+        self.conn = conn
+        self.data = ''
+        self.received = time.time()
+        self.op = None
+        self.dev = None
+        self.rules = None
+
+    def parse(self):
+        t = self.data.split('\n', 1)
+        header = t[0].split()
+        if len(header) == 0:
+            raise FirewallManagerError('empty request')
+
+        self.op = header[0]
+        if self.op == 'stats':
+            return
+        if self.op not in ['setup', 'teardown']:
+            raise FirewallManagerError('unknown operation: %s' % self.op)
+        if len(header) != 2 or _re_device_name.match(header[1]) is None:
+            raise FirewallManagerError('invalid device name')
+        self.dev = header[1]
+
+        if self.op == 'setup':
+            if len(t) < 2:
+                raise FirewallManagerError('missing setup script')
+            self.rules = _parse_device_script(self.dev, t[1])
+        else:
+            self.rules = {}
+
+class FirewallManager:
+    """Long-lived firewall manager, see module documentation."""
+
+    socket_path = constants.FWMANAGER_SOCKET
+    batch_delay = constants.FWMANAGER_BATCH_DELAY
+    max_request_size = 64*1024
+
+    def __init__(self):
+        self.socket = None
+        self.poll = None
+        self.clients = {}   # fd -> _Request still being received
+        self.pending = []   # complete requests waiting for the next batch
+        self.devices = {}   # dev -> table -> _DeviceRules
+
+        self.batch_count = 0
+        self.request_count = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    # socket handling
+
+    def _open_socket(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(self.socket_path)
+        os.chmod(self.socket_path, 0600)
+        self.socket.listen(128)
+        self.socket.setblocking(0)
+
+        self.poll = select.poll()
+        self.poll.register(self.socket.fileno(), select.POLLIN)
+
+    def _close_socket(self):
+        for req in self.clients.values():
+            self._close_client(req)
+        for req in self.pending:
+            self._close_client(req)
+        self.pending = []
+
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            except:
+                pass
+            self.socket = None
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def _close_client(self, req):
+        fd = req.conn.fileno()
+        if self.clients.has_key(fd):
+            del self.clients[fd]
+            self.poll.unregister(fd)
+        try:
+            req.conn.close()
+        except:
+            pass
+
+    def _reply(self, req, msg):
+        try:
+            req.conn.setblocking(1)
+            req.conn.settimeout(1.0)
+            req.conn.sendall(msg + '\n')
+        except:
+            _log.warning('cannot send reply for %s %s' % (req.op, req.dev))
+        self._close_client(req)
+
+    def _accept_clients(self):
+        while True:
+            try:
+                conn, _ = self.socket.accept()
+            except socket.error, e:
+                if e.args[0] in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    return
+                raise
+            conn.setblocking(0)
+            req = _Request(conn)
+            self.clients[conn.fileno()] = req
+            self.poll.register(conn.fileno(), select.POLLIN)
+
+    def _read_client(self, req):
+        try:
+            data = req.conn.recv(4096)
+        except socket.error, e:
+            if e.args[0] in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                return
+            self._close_client(req)
+            return
+
+        if data != '':
+            req.data += data
+            if len(req.data) > self.max_request_size:
+                self._reply(req, 'error request too large')
+            return
+
+        # end of request
+        fd = req.conn.fileno()
+        del self.clients[fd]
+        self.poll.unregister(fd)
+        try:
+            req.parse()
+        except FirewallManagerError, e:
+            self._reply(req, 'error %s' % e)
+            return
+
+        if req.op == 'stats':
+            self._reply(req, 'ok %s' % self.get_statistics_string())
+        else:
+            self.pending.append(req)
+
+    def _poll_once(self, timeout):
+        try:
+            events = self.poll.poll(timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        for fd, ev in events:
+            if fd == self.socket.fileno():
+                self._accept_clients()
+            elif self.clients.has_key(fd):
+                self._read_client(self.clients[fd])
+
+    # firewall handling
+
+    def resync(self):
+        """Reread device chains and jump rules from iptables-save."""
+
+        (retval, retout, reterr) = run_command([constants.CMD_IPTABLES_SAVE], retval=runcommand.FAIL)
+        self.devices = _parse_saved_rules(retout)
+        _log.info('resynchronized firewall state: %d devices' % len(self.devices))
+
+    def _build_script(self, requests):
+        """Build an iptables-restore --noflush script for a list of requests.
+
+        Each table section declares (and thus flushes) the new chains,
+        deletes old jump rules, removes old chains which are not redeclared
+        and finally adds the new rules.  Returns None if there is nothing
+        to do.
+        """
+
+        sections = {}
+        for t in _tables:
+            sections[t] = ([], [], [], [])
+
+        for req in requests:
+            old = self.devices.get(req.dev, {})
+            for t in _tables:
+                declare, delete, remove, add = sections[t]
+
+                new_chains = []
+                if req.rules.has_key(t):
+                    new_chains = req.rules[t].chains
+                    for c in new_chains:
+                        declare.append(':%s -' % c)
+                    add.extend(req.rules[t].rules)
+
+                if old.has_key(t):
+                    for j in old[t].jumps:
+                        delete.append('-D %s' % j)
+                    for c in old[t].chains:
+                        if c not in new_chains:
+                            remove.append('-F %s' % c)
+                            remove.append('-X %s' % c)
+
+        lines = []
+        for t in _tables:
+            declare, delete, remove, add = sections[t]
+            if len(declare) + len(delete) + len(remove) + len(add) == 0:
+                continue
+            lines.append('*%s' % t)
+            lines.extend(declare)
+            lines.extend(delete)
+            lines.extend(remove)
+            lines.extend(add)
+            lines.append('COMMIT')
+
+        if len(lines) == 0:
+            return None
+        return '\n'.join(lines) + '\n'
+
+    def _apply(self, requests):
+        script = self._build_script(requests)
+        if script is not None:
+            iptables_lock = helpers.acquire_iptables_lock()
+            try:
+                run_command([constants.CMD_IPTABLES_RESTORE, '-n'], stdin=script, retval=runcommand.FAIL)
+            finally:
+                helpers.release_iptables_lock(iptables_lock)
+
+        for req in requests:
+            if req.op == 'setup':
+                self.devices[req.dev] = req.rules
+            elif self.devices.has_key(req.dev):
+                del self.devices[req.dev]
+
+    def _process_batch(self):
+        received, self.pending = self.pending, []
+
+        # coalesce: latest request for each device wins, but all get a reply
+        groups = {}
+        order = []
+        for req in received:
+            if not groups.has_key(req.dev):
+                groups[req.dev] = []
+                order.append(req.dev)
+            groups[req.dev].append(req)
+        requests = [groups[dev][-1] for dev in order]
+
+        start = time.time()
+        results = {}
+
+        # a device we do not know may still have rules which a client
+        # installed directly (manager busy or failing), so reread the
+        # state to tear them down, too
+        unknown = [req for req in requests if req.op == 'teardown' and not self.devices.has_key(req.dev)]
+        if len(unknown) > 0:
+            try:
+                self.resync()
+            except:
+                # clients remove the rules directly instead
+                _log.exception('firewall resync failed')
+                for req in unknown:
+                    results[req.dev] = 'error resync failed'
+                requests = [req for req in requests if req not in unknown]
+
+        try:
+            self._apply(requests)
+            for req in requests:
+                results[req.dev] = 'ok'
+        except:
+            _log.exception('firewall batch failed, resyncing and retrying requests one by one')
+            try:
+                self.resync()
+            except:
+                # state unknown, let clients apply their rules directly
+                _log.exception('firewall resync failed')
+                for req in requests:
+                    results[req.dev] = 'error resync failed'
+                requests = []
+            for req in requests:
+                try:
+                    self._apply([req])
+                    results[req.dev] = 'ok'
+                except:
+                    _log.exception('firewall %s failed for device %s' % (req.op, req.dev))
+                    results[req.dev] = 'error %s failed for device %s' % (req.op, req.dev)
+        end = time.time()
+
+        for dev in order:
+            for req in groups[dev]:
+                self._reply(req, results[dev])
+
+        latency = end - received[0].received
+        self.batch_count += 1
+        self.request_count += len(received)
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+        _log.info('firewall batch %d: %d requests for %d devices, apply %.3fs, latency %.3fs' % \
+                  (self.batch_count, len(received), len(requests), end - start, latency))
+
+    def get_statistics_string(self):
+        avg = 0.0
+        if self.batch_count > 0:
+            avg = self.total_latency / self.batch_count
+        return 'batches=%d requests=%d devices=%d avg_latency=%.3f max_latency=%.3f' % \
+               (self.batch_count, self.request_count, len(self.devices), avg, self.max_latency)
+
+    def run(self):
+        """Serve requests until SIGTERM."""
+
+        def _sigterm_handler(signum, stackframe):
+            raise _TerminateError()
+
+        signal.signal(signal.SIGTERM, _sigterm_handler)
+
+        _log.info('firewall manager starting')
+        try:
+            try:
+                # clients connecting during resync wait in the listen backlog
+                self._open_socket()
+                self.resync()
+
+                while True:
+                    timeout = -1
+                    if len(self.pending) > 0:
+                        wait = self.pending[0].received + self.batch_delay - time.time()
+                        timeout = max(int(wait * 1000), 0)
+
+                    self._poll_once(timeout)
+
+                    if len(self.pending) > 0 and time.time() >= self.pending[0].received + self.batch_delay:
+                        self._process_batch()
+            except _TerminateError:
+                _log.info('firewall manager got SIGTERM, exiting')
+        finally:
+            self._close_socket()
+
+# --------------------------------------------------------------------------
+#
+#  Client side
+#
+
+def _request(message):
+    """Send a request to the firewall manager and return its reply.
+
+    Returns None if the firewall manager is not running.
+    """
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(constants.FWMANAGER_REQUEST_TIMEOUT)
+        try:
+            s.connect(constants.FWMANAGER_SOCKET)
+        except socket.error, e:
+            if e.args[0] in [errno.ENOENT, errno.ECONNREFUSED]:
+                return None
+            raise
+
+        s.sendall(message)
+        s.shutdown(socket.SHUT_WR)
+
+        reply = ''
+        while True:
+            t = s.recv(4096)
+            if t == '':
+                break
+            reply += t
+    finally:
+        s.close()
+
+    return reply.strip()
+
+def _check_reply(reply):
+    if reply is None:
+        return False
+    if reply.startswith('ok'):
+        return True
+    raise FirewallManagerError('firewall manager: %s' % reply)
+
+def setup_device(dev, script):
+    """Install per-device firewall rules using the firewall manager.
+
+    Existing rules of the device are replaced.  The script is an
+    iptables-restore script which declares the device chains and adds the
+    device rules, including jumps from the common PPP chains.
+
+    @return: True if the rules were installed, False if the firewall
+        manager is not running.
+    @raise FirewallManagerError: the firewall manager failed to install
+        the rules.
+    """
+
+    return _check_reply(_request('setup %s\n%s' % (dev, script)))
+
+def tear_down_device(dev):
+    """Remove per-device firewall rules using the firewall manager.
+
+    @return: True if the rules were removed (or did not exist), False if
+        the firewall manager is not running.
+    @raise FirewallManagerError: the firewall manager failed to remove
+        the rules.
+    """
+
+    return _check_reply(_request('teardown %s\n' % dev))
+
+def get_statistics():
+    """Return firewall manager batch statistics as a string, or None."""
+
+    reply = _request('stats\n')
+    if reply is None:
+        return None
+    _check_reply(reply)
+    return reply[2:].strip()
@@ -20,6 +20,9 @@ some loss of API usability.
 See:
   * http://matplotlib.sourceforge.net/backends.html
 
+Rrdtool is accessed through L{codebay.l2tpserver.rrd}, which keeps a persistent
+rrdtool process and caches recent fetch windows.
+
 Other resources:
   * http://matplotlib.sourceforge.net/
   * http://www.scipy.org/Cookbook/Matplotlib/Using_MatPlotLib_in_a_CGI_script
@@ -33,6 +36,7 @@ from codebay.common import logger
 from codebay.common import rdf
 from codebay.l2tpserver import constants
 from codebay.l2tpserver import runcommand
+from codebay.l2tpserver import rrd
 from codebay.l2tpserver import helpers
 from codebay.l2tpserver import db
 from codebay.l2tpserver.rdfconfig import ns, ns_ui
@@ -116,20 +120,18 @@ class Graphs:
         rra3_steps, rra3_rows = 60, (365*24*60)/60             # 365 days, 1 hour resolution
         rra4_steps, rra4_rows = 24*60, (20*365*24*60)/(24*60)  # 20 years, 1 day resolution
         
-        run_command([ constants.CMD_RRDTOOL,
-                      'create', self.filename,
-                      '--start', str(start_epoch),
-                      '--step', str(step) ] +
-                    map(lambda x: x.dsStatement(), self.rrd_sources) +
-                    [ 'RRA:AVERAGE:0.5:%s:%s' % (rra1_steps, rra1_rows),
-                      'RRA:AVERAGE:0.5:%s:%s' % (rra2_steps, rra2_rows),
-                      'RRA:AVERAGE:0.5:%s:%s' % (rra3_steps, rra3_rows),
-                      'RRA:AVERAGE:0.5:%s:%s' % (rra4_steps, rra4_rows) ] +
-                    [ 'RRA:MAX:0.5:%s:%s' % (rra1_steps, rra1_rows),
-                      'RRA:MAX:0.5:%s:%s' % (rra2_steps, rra2_rows),
-                      'RRA:MAX:0.5:%s:%s' % (rra3_steps, rra3_rows),
-                      'RRA:MAX:0.5:%s:%s' % (rra4_steps, rra4_rows) ],
-                    retval=runcommand.FAIL)
+        rrd.create(self.filename,
+                   [ '--start', str(start_epoch),
+                     '--step', str(step) ] +
+                   map(lambda x: x.dsStatement(), self.rrd_sources) +
+                   [ 'RRA:AVERAGE:0.5:%s:%s' % (rra1_steps, rra1_rows),
+                     'RRA:AVERAGE:0.5:%s:%s' % (rra2_steps, rra2_rows),
+                     'RRA:AVERAGE:0.5:%s:%s' % (rra3_steps, rra3_rows),
+                     'RRA:AVERAGE:0.5:%s:%s' % (rra4_steps, rra4_rows) ] +
+                   [ 'RRA:MAX:0.5:%s:%s' % (rra1_steps, rra1_rows),
+                     'RRA:MAX:0.5:%s:%s' % (rra2_steps, rra2_rows),
+                     'RRA:MAX:0.5:%s:%s' % (rra3_steps, rra3_rows),
+                     'RRA:MAX:0.5:%s:%s' % (rra4_steps, rra4_rows) ])
 
     def fetch_rrd_data(self, start=None, end=None, resolution=5*60, cf='MAX'):
         """Fetch rrd data using rrdtool fetch for selected period.
@@ -144,62 +146,57 @@ class Graphs:
             print d.time
             print d.nusrcount
 
-        Used by matplotlib drawing code to get graph input.
+        Prefer fetch_rrd_columns() for large periods; it avoids creating an object
+        per sample.
         """
 
         #
         #  XXX: resolution is useless unless start and end are rounded to its multiple.
-        #  See man rrdfetch for discussion and examples.  Currently we just ignore
+        #  See man rrdfetch for discussion and examples.  Here we just ignore
         #  resolution and get the finest detail available, wasting a bit of memory in
-        #  the process.
+        #  the process.  fetch_rrd_columns() does the rounding.
         #
 
         if start is None:
             raise Exception('start is None')
         if end is None:
             raise Exception('end is None')
-        start_str = str(int(time.mktime(start.timetuple())))  # must be int, not float
-        end_str = str(int(time.mktime(end.timetuple())))      # must be int, not float
-            
-        [rv, stdout, stderr] = run_command([
-            constants.CMD_RRDTOOL,
-            'fetch', self.filename, cf,
-            '--end', end_str,
-            '--start', start_str
-            ], retval=runcommand.FAIL)
+
+        data = rrd.fetch(self.filename, cf,
+                         int(time.mktime(start.timetuple())),  # must be int, not float
+                         int(time.mktime(end.timetuple())))
 
         res = []
-        for line in stdout.split('\n'):
-            try:
-                [timestamp, rest] = line.split(':')
-                timestamp = timestamp.strip()
-                rest = rest.strip()
-                vals = rest.split(' ')
-            except:
-                # ignore; probably empty line
-                continue
-            
+        for i, t in enumerate(data.times):
             d = DataPoint()
-            try:
-                setattr(d, 'time', datetime.datetime.fromtimestamp(float(timestamp)))
-            except:
-                setattr(d, 'time', None)
-
-            for i, ds in enumerate(self.rrd_sources):
-                val = None
-                if vals[i] == 'nan':
-                    val = None
-                else:
-                    try:
-                        val = float(vals[i])
-                    except ValueError, e:
-                        _log.exception('failed to parse data source value: ds=%s, val=%s' % (ds.dsname, vals[i]))
-                        val = None
-                        
-                setattr(d, ds.dsname, val)
+            setattr(d, 'time', t)
+            for ds in self.rrd_sources:
+                setattr(d, ds.dsname, data.get_column(ds.dsname)[i])
             res.append(d)
 
         return res
+
+    def fetch_rrd_columns(self, start=None, end=None, resolution=5*60, cf='MAX'):
+        """Fetch rrd data for selected period in column form.
+
+        Start and end are rounded down to a multiple of resolution, and recently
+        fetched periods are served from a cache; see rrd.fetch_cached().  The result
+        is an rrd.FetchResult: sample times are in the list 'times', and values of a
+        data source are available with get_column() (floats or None if nan) or as a
+        NumPy array with get_array().  The result is shared, do not modify it.
+
+        Used by matplotlib drawing code to get graph input.
+        """
+
+        if start is None:
+            raise Exception('start is None')
+        if end is None:
+            raise Exception('end is None')
+
+        return rrd.fetch_cached(self.filename, cf,
+                                int(time.mktime(start.timetuple())),
+                                int(time.mktime(end.timetuple())),
+                                resolution)
     
     # --------------------------------------------------------------------------
 
@@ -320,11 +317,7 @@ class Graphs:
         @db.untransact()
         def _run_rrd():
             # update rrd
-            run_command([
-                constants.CMD_RRDTOOL,
-                'update', self.filename,
-                ':'.join(valstr)
-                ], retval=runcommand.FAIL)
+            rrd.update(self.filename, valstr)
 
         if update_rrd:
             _run_rrd()
@@ -680,20 +673,20 @@ class Graphs:
                 
                     outname = '/tmp/debug-graph-%s-%s-%s.png' % (ds.dsname, period_name, resolution_name)
                 
-                    [rv, stdout, stderr ] = run_command([
-                        constants.CMD_RRDTOOL,
-                        'graph',
-                        outname,
-                        '--end', 'now',
-                        '--start', 'end-%ss' % period,
-                        '--title', '%s' % outname,
-                        '--width', str(width),
-                        '--height', str(height),
-                        '--lower-limit', str(0),
-                        ##'--upper-limit', ...,
-                        'DEF:%s=%s:%s:MAX' % (ds.dsname, self.filename, ds.dsname),
-                        'LINE1:%s#000000' % ds.dsname
-                        ])
+                    try:
+                        rrd.graph(outname, [
+                            '--end', 'now',
+                            '--start', 'end-%ss' % period,
+                            '--title', '%s' % outname,
+                            '--width', str(width),
+                            '--height', str(height),
+                            '--lower-limit', str(0),
+                            ##'--upper-limit', ...,
+                            'DEF:%s=%s:%s:MAX' % (ds.dsname, self.filename, ds.dsname),
+                            'LINE1:%s#000000' % ds.dsname
+                            ])
+                    except rrd.RrdError:
+                        _log.exception('failed to draw debug graph %s' % outname)
 
     # --------------------------------------------------------------------------
 
@@ -738,14 +731,14 @@ class Graphs:
 
         # fetch rrd data before setting TZ
         now = datetime.datetime.utcnow()
-        rrd_data = self.fetch_rrd_data(start=now-datetime.timedelta(7, 0, 0), end=now)
+        rrd_data = self.fetch_rrd_columns(start=now-datetime.timedelta(7, 0, 0), end=now)
 
         def _draw(fig):
             data = rrd_data
             
-            # raw data
-            xdata = [i.time for i in data]
-            ydata = [getattr(i, dsname) for i in data]
+            # raw data; copy, the fetch result is shared
+            xdata = list(data.times)
+            ydata = list(data.get_column(dsname))
 
             # fix zero length issue
             if len(ydata) == 0:
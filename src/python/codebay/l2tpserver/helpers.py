@@ -238,6 +238,40 @@ def get_ppp_devices():
 def get_retired_ppp_devices():
     return get_global_status().getS(ns.retiredPppDevices, rdf.Type(ns.RetiredPppDevices)).getSet(ns.pppDevice, rdf.Type(ns.PppDevice))
 
+def prune_retired_ppp_devices(devs, now=None, max_age=constants.RETIRED_PPP_DEVICES_MAX_AGE, max_count=constants.RETIRED_PPP_DEVICES_MAX_COUNT):
+    """Prune a retired PPP device set by age and by count, oldest first.
+
+    Devices without a stopTime are never pruned and do not count towards
+    max_count, so the set may end up with more than max_count devices.
+    Returns a tuple: number of devices pruned because of age, number of
+    devices pruned because of count.
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    to_nuke = []
+    keyed = []
+    for d in devs:
+        if d.hasS(ns.stopTime):
+            stop_time = d.getS(ns.stopTime, rdf.Datetime)
+            if now - stop_time > max_age:
+                to_nuke.append(d)
+            else:
+                keyed.append((stop_time, len(keyed), d))
+        else:
+            _log.warning('retired device %s does not have stopTime' % d)
+    for d in to_nuke:
+        devs.discard(d)
+    pruned_age = len(to_nuke)
+
+    keyed.sort()  # oldest first; index breaks ties so nodes are never compared
+    pruned_count = 0
+    for stop_time, idx, d in keyed[:max(0, len(keyed) - max_count)]:
+        devs.discard(d)
+        pruned_count += 1
+
+    return pruned_age, pruned_count
+
 def dump_to_file_using_rdfdumper(rdf_node, filename):
     f = None
     try:
@@ -572,14 +606,45 @@ def get_standard_zipfile_name(name):
 def timedelta_to_seconds(td):
     return td.days*24.0*60.0*60.0 + float(td.seconds) + td.microseconds/1000000.0
 
-def find_ppp_user(username=None):
-    cfg_users = get_config().getS(ns.usersConfig, rdf.Type(ns.UsersConfig))
+def find_nodes_by_value(parent, predicate, dataclass, value, member_predicate=None):
+    """Find child nodes of parent whose predicate has a certain value.
+
+    The lookup runs from the value node towards its subjects, so it is
+    answered from the object indexes of the RDF store (see
+    tinyrdf.ApswStore.statement_indexes) instead of reading every child
+    of parent.  The indexes are kept up to date by the database itself,
+    so there is nothing to maintain when configuration is activated or
+    devices are added and retired.
+
+    Children are linked to parent with member_predicate; None matches any
+    predicate, which is needed for RDF containers (rdf:_1, rdf:_2, ...).
+    The order of the result list is unspecified.
+    """
+
+    value_node = rdf.Node.make(parent.model, dataclass, value)
 
     res = []
-    for i, u in enumerate(cfg_users.getS(ns.users, rdf.Bag(rdf.Type(ns.User)))):
-        if (username is not None) and (u.getS(ns.username, rdf.String) == username):
-            res.append(u)
-        
+    for n in value_node.getNodes(predicate, direction=rdf.toSubject):
+        for p in n.getNodes(member_predicate, direction=rdf.toSubject):
+            if p.node == parent.node:
+                res.append(n)
+                break
+    return res
+
+def find_ppp_users(username):
+    """Find user configuration nodes of the active config by username."""
+
+    cfg_users = get_config().getS(ns.usersConfig, rdf.Type(ns.UsersConfig))
+    res = []
+    for u in find_nodes_by_value(cfg_users.getS(ns.users), ns.username, rdf.String, username):
+        res.append(u.getSelf(rdf.Type(ns.User)))
+    return res
+
+def find_ppp_user(username=None):
+    if username is None:
+        return None
+
+    res = find_ppp_users(username)
     if len(res) == 0:
         return None
     elif len(res) == 1:
@@ -588,8 +653,23 @@ def find_ppp_user(username=None):
         # XXX: allow list return?
         raise Exception('multiple users match criteria')
 
-def filter_ppp_device_statuses(filterlist):
-    rdfdevs = get_ppp_devices()
+def _find_ppp_device_statuses(address=None, username=None):
+    """Find current PPP device status nodes by address and/or username."""
+
+    devs = get_status().getS(ns.pppDevices, rdf.Type(ns.PppDevices))
+    if address is not None:
+        res = find_nodes_by_value(devs, ns.pppAddress, rdf.IPv4Address, address, member_predicate=ns.pppDevice)
+        if username is not None:
+            res = [d for d in res if d.hasS(ns.username) and d.getS(ns.username, rdf.String) == username]
+    elif username is not None:
+        res = find_nodes_by_value(devs, ns.username, rdf.String, username, member_predicate=ns.pppDevice)
+    else:
+        return []
+    return [d.getSelf(rdf.Type(ns.PppDevice)) for d in res]
+
+def filter_ppp_device_statuses(filterlist, rdfdevs=None):
+    if rdfdevs is None:
+        rdfdevs = get_ppp_devices()
 
     res = []
     for i, d in enumerate(rdfdevs):
@@ -607,8 +687,8 @@ def filter_ppp_device_statuses(filterlist):
             res.append(d)
     return res
 
-def filter_ppp_device_statuses_single(filterlist):
-    res = filter_ppp_device_statuses(filterlist)
+def filter_ppp_device_statuses_single(filterlist, rdfdevs=None):
+    res = filter_ppp_device_statuses(filterlist, rdfdevs)
     if len(res) == 0:
         return None
     if len(res) == 1:
@@ -637,20 +717,29 @@ def filter_ppp_device_statuses_single(filterlist):
 
 def find_ppp_device_status_sitetosite_client(username):
     def _f1(d):
-        return d.getS(ns.username, rdf.String) == username
-    def _f2(d):
         return d.getS(ns.connectionType).hasType(ns.SiteToSiteClient)
         
-    return filter_ppp_device_statuses_single([_f1, _f2])
+    return filter_ppp_device_statuses_single([_f1], _find_ppp_device_statuses(username=username))
     
 def find_ppp_device_status_sitetosite_server(username):
     def _f1(d):
-        return d.getS(ns.username, rdf.String) == username
-    def _f2(d):
         return d.getS(ns.connectionType).hasType(ns.SiteToSiteServer)
         
-    return filter_ppp_device_statuses_single([_f1, _f2])
+    return filter_ppp_device_statuses_single([_f1], _find_ppp_device_statuses(username=username))
     
+def find_ppp_device_status_sitetosite(username, is_client):
+    """Find the current device status of a site-to-site tunnel, or None.
+
+    Devices are looked up by username from the object indexes of the store
+    (see L{find_nodes_by_value}), which the database keeps up to date as
+    PPP scripts add and retire devices and license reconciliation removes
+    stale ones; there is no separate tunnel to device map to maintain.
+    """
+    if is_client:
+        return find_ppp_device_status_sitetosite_client(username)
+    else:
+        return find_ppp_device_status_sitetosite_server(username)
+
 def find_ppp_device_status(address=None, username=None):
     """Find device status node based on address and/or username.
 
@@ -659,11 +748,6 @@ def find_ppp_device_status(address=None, username=None):
     allows the web UI to default username for user login, for instance.
     """
 
-    def _f1(d):
-        return (address is not None) and (d.getS(ns.pppAddress, rdf.IPv4Address) == address)
-    def _f2(d):
-        return (username is not None) and (d.getS(ns.username, rdf.String) == username)
-
     # There may be multiple matching devices in corner cases, e.g. two devices
     # in RDF with the same IP address.  License monitor reconcile process should
     # eliminate these discrepancies eventually but here we may still encounter
@@ -679,7 +763,7 @@ def find_ppp_device_status(address=None, username=None):
     # So: return device with latest startTime (newest connection), or first in
     # list if no startTime is found.  [filter_ppp_device_statuses_single does this.]
 
-    return filter_ppp_device_statuses_single([_f1, _f2])
+    return filter_ppp_device_statuses_single([], _find_ppp_device_statuses(address=address, username=username))
     
 def parse_product_version(vers):
     t = re.split('\D+', vers)   # '1.0.0-whatever' => ['1', '0', '0', 'whatever']
@@ -573,45 +573,13 @@ def _rdf_database_prune_retired_devices(_log, root):
     from codebay.l2tpserver.rdfconfig import ns, ns_ui
     from codebay.l2tpserver import db
 
-    now = datetime.datetime.utcnow()
-    retired_age_limit = datetime.timedelta(30, 0, 0)  # XXX: 30 days
-    retired_max_devices = 1000                        # XXX: max 1000 devices after prune
     global_status = root.getS(ns.globalStatus, rdf.Type(ns.GlobalStatus))
 
     try:
-        # pass 1: old devices
-        to_nuke = []
         devs = global_status.getS(ns.retiredPppDevices, rdf.Type(ns.RetiredPppDevices)).getSet(ns.pppDevice, rdf.Type(ns.PppDevice))
-        for d in devs:
-            if d.hasS(ns.stopTime):
-                age = now - d.getS(ns.stopTime, rdf.Datetime)
-                if age > retired_age_limit:
-                    to_nuke.append(d)
-            else:
-                _log.warning('retired device %s does not have stopTime' % d)
-        for d in to_nuke:
-            devs.discard(d)
-        _log.info('pruning retired ppp devices, pass 1: old devices (pruned %d devices)' % len(to_nuke))
-
-        # pass 2: limit max count
-        count_to_nuke = 0
-        devs = global_status.getS(ns.retiredPppDevices, rdf.Type(ns.RetiredPppDevices)).getSet(ns.pppDevice, rdf.Type(ns.PppDevice))
-
-        devlist = []
-        for d in devs:
-            devlist.append(d)
-        def _cmp_stoptime(a, b):  # note order: oldest first
-            return cmp([a.getS(ns.stopTime, rdf.Datetime)],
-                       [b.getS(ns.stopTime, rdf.Datetime)])
-        devlist.sort(cmp=_cmp_stoptime)
-
-        count_to_nuke = len(devlist) - retired_max_devices
-        if count_to_nuke > 0:
-            for i in xrange(count_to_nuke):
-                devs.discard(devlist[i])
-        else:
-            count_to_nuke = 0
-        _log.info('pruning retired ppp devices, pass 2: max devices (pruned %d devices)' % count_to_nuke)
+        pruned_age, pruned_count = helpers.prune_retired_ppp_devices(devs)
+        _log.info('pruning retired ppp devices, pass 1: old devices (pruned %d devices)' % pruned_age)
+        _log.info('pruning retired ppp devices, pass 2: max devices (pruned %d devices)' % pruned_count)
     except:
         _log.info('nuking retired devices failed, recreating retired devices list to empty')
         global_status.setS(ns.retiredPppDevices, rdf.Type(ns.RetiredPppDevices))
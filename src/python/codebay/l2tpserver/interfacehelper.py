@@ -2,10 +2,26 @@
 
 This functionality is shared by many modules: installer, boot scripts,
 web UI, license management, etc.
+
+Interface information can be read using one of several backends:
+
+  * 'ip': parse the output of 'ip -s -o link list' (and 'ip addr list'),
+    which costs a fork and a handful of regexps per device
+
+  * 'sysfs': read /proc/net/dev and /sys/class/net/<dev>/* directly, and
+    get addresses with ioctl()
+
+  * 'netlink': dump links and addresses using rtnetlink; only available if
+    the Python socket module supports AF_NETLINK
+
+The backend is chosen with L{set_backend}, or per call with the backend
+argument of L{InterfaceInfos.from_system}.  By default 'sysfs' is used
+when /proc and /sys are available, and 'ip' otherwise.  Running this
+module as a script benchmarks the backends, see L{benchmark}.
 """
 __docformat__ = 'epytext en'
 
-import re, datetime, math
+import os, re, datetime, math, socket, struct, fcntl, time, tempfile
 
 from codebay.common import datatypes
 from codebay.l2tpserver import runcommand
@@ -32,9 +48,20 @@ _re_ipaddr_inet = re.compile(r'^.*?\s+inet\s+(.*?)\s+.*?$')
 # regex for ppp device names ('l2tpN-N')
 _re_ppp_devname = re.compile(r'^l2tp\d+-\d+$')
 
+# link types as named by 'ip' for ARPHRD_* values (linux/if_arp.h)
+_arphrd_names = { 1: 'ether',
+                  512: 'ppp',
+                  768: 'ipip',
+                  772: 'loopback',
+                  776: 'sit',
+                  778: 'gre',
+                  65534: 'none' }
+
+IFF_UP = 0x1
+
 class InterfaceInfo:
     """Represent the relevant information from 'ip -s link list' for a single device."""
-    def __init__(self, devname, rxbytes, rxpackets, txbytes, txpackets, mtu, mac, linktype):
+    def __init__(self, devname, rxbytes, rxpackets, txbytes, txpackets, mtu, mac, linktype, backend=None):
         """Constructor."""
 
         self.devname = devname
@@ -45,6 +72,7 @@ class InterfaceInfo:
         self.mtu = int(mtu)
         self.mac = mac
         self.linktype = linktype
+        self.backend = backend
 
     def get_device_name(self):
         return self.devname
@@ -57,7 +85,7 @@ class InterfaceInfo:
 
     def get_link_type(self):
         return self.linktype
-    
+
     def is_ethernet_device(self):
         return self.linktype == 'ether'
 
@@ -68,14 +96,10 @@ class InterfaceInfo:
         return False
 
     def get_current_ipv4_address_info(self):
-        (retval, retout, reterr) = run_command([constants.CMD_IP, '-s', '-o', 'addr', 'list', self.devname], retval=runcommand.FAIL)
-        for i in retout.split('\n'):
-            for j in i.split('\\'):
-                m = _re_ipaddr_inet.match(j)
-                if m is not None:
-                    return datatypes.IPv4AddressSubnet.fromString(m.group(1))
-
-        return None
+        backend = self.backend
+        if backend is None:
+            backend = get_backend()
+        return backend.get_ipv4_address_info(self.devname)
 
     def identify_device(self):
         return netidentify.identify_device(self.devname)
@@ -85,57 +109,36 @@ class InterfaceInfo:
 
         return '%s: mac=%s, linktype=%s, mtu=%s, rx=%s/%s, tx=%s/%s' % (self.devname, self.mac, self.linktype, self.mtu, self.rxbytes, self.rxpackets, self.txbytes, self.txpackets)
 
-class InterfaceInfos:
-    """Represent the state of all devices (interfaces) at a certain time."""
+# --------------------------------------------------------------------------
+#
+#  Backends
+#
 
-    def __init__(self):
-        """Constructor."""
+class IpCommandBackend:
+    """Interface information from the 'ip' command."""
 
-        self.all_devs = None
+    name = 'ip'
 
-    def from_system(klass, devname=None, filterfunc=None, require_up=True):
-         """Get device information from system (i.e., the 'ip' command)."""
-
-         di = klass()
-         di.all_devs = di._get_interface_infos(devname, filterfunc, require_up)
-         return di
-    from_system = classmethod(from_system)
-
-    def get_interface_list(self):
-        """Get all devices in a (shallow copy) list."""
-
-        return self.all_devs[:]  # clone
-
-    def get_interface_names(self):
-        """Get list of all interface names."""
-
-        t = []
-        for i in self.all_devs:
-            t.append(i.devname)
-
-        return t
-    
-    def get_interface_by_name(self, devname):
-        """Get a specific device."""
-
-        for i in self.all_devs:
-            if i.devname == devname:
-                return i
-
-        return None
-    
-    def _get_interface_infos(self, devname, filterfunc, require_up):
-        """Get a list of InterfaceInfos for all devices in 'ip -s link list'."""
+    def is_available(self):
+        return os.path.exists(constants.CMD_IP)
 
+    def get_link_output(self, devname):
         d = []
         if devname is not None:
             d.append(str(devname))
 
         (retval, retout, reterr) = run_command([constants.CMD_IP, '-s', '-o', 'link', 'list'] + d, retval=runcommand.FAIL)
+        return retout
+
+    def get_interface_infos(self, devname, filterfunc, require_up):
+        """Get a list of InterfaceInfos for all devices in 'ip -s link list'."""
 
+        return self.parse_link_output(self.get_link_output(devname), filterfunc, require_up)
+
+    def parse_link_output(self, output, filterfunc, require_up):
         # gather info about all devices
         alldevs = []
-        for i in retout.split('\n'):
+        for i in output.split('\n'):
             try:
                 (l_hdr, l_info, l_rxhdr, l_rxcnt, l_txhdr, l_txcnt) = i.split('\\')
             except:
@@ -147,7 +150,7 @@ class InterfaceInfos:
             # will nuke them.
 
             dev, mtu, mac, linktype = None, None, None, None
-            
+
             m = _re_iplink_up.match(l_hdr)
             if m is None and require_up:
                 continue
@@ -167,7 +170,7 @@ class InterfaceInfos:
             m = _re_iplink_type.match(l_info)
             if m is not None:
                 linktype = m.group(1)
-                
+
             m = _re_iplink_info_mac.match(l_info)
             if m is not None:  # MAC is not mandatory
                 mac = m.group(1)
@@ -188,15 +191,328 @@ class InterfaceInfos:
             if m is None: continue
             txbytes, txpackets = m.group(1), m.group(2)
 
-            d = InterfaceInfo(dev, rxbytes, rxpackets, txbytes, txpackets, mtu, mac, linktype)
+            d = InterfaceInfo(dev, rxbytes, rxpackets, txbytes, txpackets, mtu, mac, linktype, backend=self)
+
+            if filterfunc and not filterfunc(d):
+                pass
+            else:
+                alldevs.append(d)
+
+        return alldevs
+
+    def get_ipv4_address_info(self, devname):
+        (retval, retout, reterr) = run_command([constants.CMD_IP, '-s', '-o', 'addr', 'list', devname], retval=runcommand.FAIL)
+        for i in retout.split('\n'):
+            for j in i.split('\\'):
+                m = _re_ipaddr_inet.match(j)
+                if m is not None:
+                    return datatypes.IPv4AddressSubnet.fromString(m.group(1))
+
+        return None
+
+class SysfsBackend:
+    """Interface information from /proc/net/dev and /sys/class/net.
+
+    Link type and MAC address of a device are cached for as long as the
+    device is seen in /proc/net/dev, so a steady state call reads only the
+    flags and MTU of each device.  Addresses are read with SIOCGIFADDR and
+    SIOCGIFNETMASK ioctls, which return the primary address of the device.
+    """
+
+    name = 'sysfs'
+    proc_net_dev = constants.PROC_NET_DEV
+    sys_class_net = constants.SYS_CLASS_NET
+
+    SIOCGIFADDR = 0x8915
+    SIOCGIFNETMASK = 0x891b
+
+    def __init__(self):
+        self.static_cache = {}  # devname -> (mac, linktype)
+
+    def is_available(self):
+        return os.path.exists(self.proc_net_dev) and os.path.isdir(self.sys_class_net)
+
+    def _read_attribute(self, devname, attr):
+        fd = os.open(os.path.join(self.sys_class_net, devname, attr), os.O_RDONLY)
+        try:
+            return os.read(fd, 4096).strip()
+        finally:
+            os.close(fd)
+
+    def _get_static_attributes(self, devname):
+        if not self.static_cache.has_key(devname):
+            mac = self._read_attribute(devname, 'address')
+            if mac == '':
+                mac = None
+            arphrd = int(self._read_attribute(devname, 'type'))
+            self.static_cache[devname] = (mac, _arphrd_names.get(arphrd, '[%d]' % arphrd))
+        return self.static_cache[devname]
+
+    def get_interface_infos(self, devname, filterfunc, require_up):
+        f = open(self.proc_net_dev, 'rb')
+        try:
+            lines = f.readlines()[2:]  # skip headers
+        finally:
+            f.close()
+
+        alldevs = []
+        seen = {}
+        for line in lines:
+            try:
+                dev, counters = line.split(':', 1)
+            except ValueError:
+                continue
+            dev = dev.strip()
+            seen[dev] = True
+            if devname is not None and dev != devname:
+                continue
+
+            # the device may disappear while we read its attributes; also
+            # see 'ip' backend for why down devices are ignored
+            try:
+                if require_up and (int(self._read_attribute(dev, 'flags'), 16) & IFF_UP) == 0:
+                    continue
+                mtu = int(self._read_attribute(dev, 'mtu'))
+                mac, linktype = self._get_static_attributes(dev)
+            except (IOError, OSError, ValueError):
+                continue
+
+            c = counters.split()
+            if len(c) < 10:
+                continue
+            d = InterfaceInfo(dev, c[0], c[1], c[8], c[9], mtu, mac, linktype, backend=self)
 
             if filterfunc and not filterfunc(d):
                 pass
             else:
                 alldevs.append(d)
 
+        # forget devices which have been removed, their names may be reused
+        for dev in self.static_cache.keys():
+            if not seen.has_key(dev):
+                del self.static_cache[dev]
+
         return alldevs
 
+    def get_ipv4_address_info(self, devname):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            ifreq = struct.pack('256s', str(devname)[:15])
+            try:
+                addr = socket.inet_ntoa(fcntl.ioctl(s.fileno(), self.SIOCGIFADDR, ifreq)[20:24])
+                mask = socket.inet_ntoa(fcntl.ioctl(s.fileno(), self.SIOCGIFNETMASK, ifreq)[20:24])
+            except IOError:
+                return None  # no device or no address
+        finally:
+            s.close()
+
+        return datatypes.IPv4AddressSubnet.fromStrings(addr, mask)
+
+class NetlinkBackend:
+    """Interface information from rtnetlink link and address dumps."""
+
+    name = 'netlink'
+
+    RTM_NEWLINK = 16
+    RTM_GETLINK = 18
+    RTM_NEWADDR = 20
+    RTM_GETADDR = 22
+    NLMSG_ERROR = 2
+    NLMSG_DONE = 3
+    NLM_F_REQUEST = 0x1
+    NLM_F_DUMP = 0x300
+    IFLA_ADDRESS = 1
+    IFLA_IFNAME = 3
+    IFLA_MTU = 4
+    IFLA_STATS = 7
+    IFLA_STATS64 = 23
+    IFA_ADDRESS = 1
+    IFA_LOCAL = 2
+    IFA_LABEL = 3
+
+    def is_available(self):
+        return hasattr(socket, 'AF_NETLINK')
+
+    def _dump(self, msgtype, payload):
+        """Send a dump request, return a list of (type, data) replies."""
+
+        s = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, 0)  # 0 = NETLINK_ROUTE
+        try:
+            s.bind((0, 0))
+            seq = int(time.time()) & 0x7fffffff
+            s.send(struct.pack('=IHHII', 16 + len(payload), msgtype, self.NLM_F_REQUEST | self.NLM_F_DUMP, seq, 0) + payload)
+
+            res = []
+            while True:
+                data = s.recv(65536)
+                off = 0
+                while off + 16 <= len(data):
+                    (mlen, mtype, mflags, mseq, mpid) = struct.unpack('=IHHII', data[off:off+16])
+                    if mlen < 16:
+                        raise Exception('invalid netlink message length %d' % mlen)
+                    if mseq == seq:
+                        if mtype == self.NLMSG_DONE:
+                            return res
+                        if mtype == self.NLMSG_ERROR:
+                            raise Exception('netlink error: %d' % struct.unpack('=i', data[off+16:off+20])[0])
+                        res.append((mtype, data[off+16:off+mlen]))
+                    off += (mlen + 3) & ~3
+        finally:
+            s.close()
+
+    def _parse_attributes(self, data):
+        attrs = {}
+        off = 0
+        while off + 4 <= len(data):
+            (alen, atype) = struct.unpack('=HH', data[off:off+4])
+            if alen < 4:
+                break
+            attrs[atype] = data[off+4:off+alen]
+            off += (alen + 3) & ~3
+        return attrs
+
+    def get_interface_infos(self, devname, filterfunc, require_up):
+        alldevs = []
+        for mtype, data in self._dump(self.RTM_GETLINK, struct.pack('=BxHiII', socket.AF_UNSPEC, 0, 0, 0, 0)):
+            if mtype != self.RTM_NEWLINK:
+                continue
+            (family, arphrd, index, flags, change) = struct.unpack('=BxHiII', data[:16])
+            attrs = self._parse_attributes(data[16:])
+
+            if not attrs.has_key(self.IFLA_IFNAME) or not attrs.has_key(self.IFLA_MTU):
+                continue
+            dev = attrs[self.IFLA_IFNAME].rstrip('\x00')
+            if devname is not None and dev != devname:
+                continue
+            if require_up and (flags & IFF_UP) == 0:
+                continue
+
+            mtu = struct.unpack('=I', attrs[self.IFLA_MTU][:4])[0]
+
+            # rx_packets, tx_packets, rx_bytes, tx_bytes
+            if attrs.has_key(self.IFLA_STATS64):
+                (rxpackets, txpackets, rxbytes, txbytes) = struct.unpack('=QQQQ', attrs[self.IFLA_STATS64][:32])
+            elif attrs.has_key(self.IFLA_STATS):
+                (rxpackets, txpackets, rxbytes, txbytes) = struct.unpack('=IIII', attrs[self.IFLA_STATS][:16])
+            else:
+                continue
+
+            mac = None
+            if attrs.has_key(self.IFLA_ADDRESS) and len(attrs[self.IFLA_ADDRESS]) > 0:
+                mac = ':'.join(['%02x' % ord(x) for x in attrs[self.IFLA_ADDRESS]])
+            linktype = _arphrd_names.get(arphrd, '[%d]' % arphrd)
+
+            d = InterfaceInfo(dev, rxbytes, rxpackets, txbytes, txpackets, mtu, mac, linktype, backend=self)
+
+            if filterfunc and not filterfunc(d):
+                pass
+            else:
+                alldevs.append(d)
+
+        return alldevs
+
+    def get_ipv4_address_info(self, devname):
+        for mtype, data in self._dump(self.RTM_GETADDR, struct.pack('=BBBBI', socket.AF_INET, 0, 0, 0, 0)):
+            if mtype != self.RTM_NEWADDR:
+                continue
+            (family, prefixlen, flags, scope, index) = struct.unpack('=BBBBI', data[:8])
+            attrs = self._parse_attributes(data[8:])
+
+            # label is devname, or devname:N for aliases
+            if not attrs.has_key(self.IFA_LABEL):
+                continue
+            label = attrs[self.IFA_LABEL].rstrip('\x00')
+            if label != devname and not label.startswith(devname + ':'):
+                continue
+
+            # for point-to-point links IFA_ADDRESS is the peer address
+            addr = attrs.get(self.IFA_LOCAL, attrs.get(self.IFA_ADDRESS))
+            if addr is None:
+                continue
+            return datatypes.IPv4AddressSubnet.fromString('%s/%d' % (socket.inet_ntoa(addr), prefixlen))
+
+        return None
+
+_backends = {}
+for _b in [IpCommandBackend(), SysfsBackend(), NetlinkBackend()]:
+    _backends[_b.name] = _b
+
+_current_backend = None
+
+def set_backend(name):
+    """Select the backend used by default, see module documentation.
+
+    None selects the default backend.
+    """
+
+    global _current_backend
+
+    if name is None:
+        _current_backend = None
+        return
+    if not _backends.has_key(name):
+        raise Exception('unknown interface backend: %s' % name)
+    if not _backends[name].is_available():
+        raise Exception('interface backend not available: %s' % name)
+    _current_backend = _backends[name]
+
+def get_backend(name=None):
+    """Get a backend by name, or the selected backend if name is None."""
+
+    if name is not None:
+        return _backends[name]
+    if _current_backend is not None:
+        return _current_backend
+    if _backends['sysfs'].is_available():
+        return _backends['sysfs']
+    return _backends['ip']
+
+# --------------------------------------------------------------------------
+
+class InterfaceInfos:
+    """Represent the state of all devices (interfaces) at a certain time."""
+
+    def __init__(self):
+        """Constructor."""
+
+        self.all_devs = None
+
+    def from_system(klass, devname=None, filterfunc=None, require_up=True, backend=None):
+         """Get device information from system (by default using the selected backend)."""
+
+         di = klass()
+         di.all_devs = di._get_interface_infos(devname, filterfunc, require_up, backend)
+         return di
+    from_system = classmethod(from_system)
+
+    def get_interface_list(self):
+        """Get all devices in a (shallow copy) list."""
+
+        return self.all_devs[:]  # clone
+
+    def get_interface_names(self):
+        """Get list of all interface names."""
+
+        t = []
+        for i in self.all_devs:
+            t.append(i.devname)
+
+        return t
+
+    def get_interface_by_name(self, devname):
+        """Get a specific device."""
+
+        for i in self.all_devs:
+            if i.devname == devname:
+                return i
+
+        return None
+
+    def _get_interface_infos(self, devname, filterfunc, require_up, backend):
+        """Get a list of InterfaceInfos for all devices."""
+
+        return get_backend(backend).get_interface_infos(devname, filterfunc, require_up)
+
 def get_interfaces():
     """Get all interfaces that are currently up."""
     return InterfaceInfos.from_system()
@@ -205,3 +521,78 @@ def get_all_interfaces():
     """Get all interfaces, up or down.."""
     return InterfaceInfos.from_system(require_up=False)
 
+# --------------------------------------------------------------------------
+
+def benchmark(device_count=1000, rounds=10):
+    """Compare the 'ip' backend against the direct sysfs reader.
+
+    Synthetic 'ip -s -o link list' output, /proc/net/dev and /sys/class/net
+    contents with device_count l2tpN-N devices are written to a temporary
+    directory.  The 'ip' backend is measured with a fork of cat(1) on the
+    synthetic output, standing in for the 'ip' command, followed by the
+    usual regexp parsing.  The netlink backend is measured against the
+    real system, if available.
+    """
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        iplink = os.path.join(tmpdir, 'iplink')
+        procnetdev = os.path.join(tmpdir, 'dev')
+        sysclassnet = os.path.join(tmpdir, 'net')
+        os.mkdir(sysclassnet)
+
+        ipout = []
+        procout = ['Inter-|   Receive                                                |  Transmit\n',
+                   ' face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed\n']
+        for i in xrange(device_count):
+            dev = 'l2tp%d-%d' % (i, i)
+            rx, tx = i * 1000, i * 2000
+            ipout.append('%d: %s: <POINTOPOINT,MULTICAST,NOARP,UP,10000> mtu 1400 qdisc pfifo_fast qlen 3\\    link/ppp \\    RX: bytes  packets  errors  dropped overrun mcast   \\    %d %d 0 0 0 0 \\    TX: bytes  packets  errors  dropped carrier collsns \\    %d %d 0 0 0 0\n' % (i + 3, dev, rx, i, tx, i))
+            procout.append('%s: %d %d 0 0 0 0 0 0 %d %d 0 0 0 0 0 0\n' % (dev, rx, i, tx, i))
+
+            d = os.path.join(sysclassnet, dev)
+            os.mkdir(d)
+            for attr, value in [('flags', '0x1091'), ('mtu', '1400'), ('address', ''), ('type', '512')]:
+                f = open(os.path.join(d, attr), 'wb')
+                f.write(value + '\n')
+                f.close()
+
+        f = open(iplink, 'wb')
+        f.write(''.join(ipout))
+        f.close()
+        f = open(procnetdev, 'wb')
+        f.write(''.join(procout))
+        f.close()
+
+        ipb = IpCommandBackend()
+        sysb = SysfsBackend()
+        sysb.proc_net_dev = procnetdev
+        sysb.sys_class_net = sysclassnet
+
+        def _ip_func():
+            (retval, retout, reterr) = run_command([constants.CMD_CAT, iplink], retval=runcommand.FAIL)
+            return ipb.parse_link_output(retout, None, True)
+
+        def _sys_func():
+            return sysb.get_interface_infos(None, None, True)
+
+        tests = [('ip', _ip_func), ('sysfs', _sys_func)]
+        nlb = NetlinkBackend()
+        if nlb.is_available():
+            tests.append(('netlink (system)', lambda: nlb.get_interface_infos(None, None, False)))
+
+        for name, func in tests:
+            start = time.time()
+            count = len(func())
+            first = time.time() - start
+
+            start = time.time()
+            for i in xrange(rounds):
+                func()
+            elapsed = (time.time() - start) / rounds
+            print '%-18s %5d devices: first call %8.2f ms, then %8.2f ms per call' % (name, count, first * 1000.0, elapsed * 1000.0)
+    finally:
+        run_command([constants.CMD_RM, '-rf', tmpdir])
+
+if __name__ == '__main__':
+    benchmark()
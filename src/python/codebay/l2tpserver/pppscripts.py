@@ -8,7 +8,7 @@ the constructor.
 """
 __docformat__ = 'epytext en'
 
-import os, sys, datetime, textwrap, re, time
+import os, sys, datetime, textwrap, re, time, socket
 
 from codebay.common import logger
 from codebay.common import rdf
@@ -18,6 +18,7 @@ from codebay.l2tpserver import runcommand
 from codebay.l2tpserver import rdfconfig
 from codebay.l2tpserver import licensemanager
 from codebay.l2tpserver import helpers
+from codebay.l2tpserver import fwmanager
 from codebay.l2tpserver.config import interface, openl2tp, pluto
 from codebay.l2tpserver import db
 
@@ -57,10 +58,21 @@ def tear_down_fw(dev, silent=False):
 
     This has been exposed because it may be called from other places besides
     PppScripts() instances.
+
+    The firewall manager daemon is used when it is running; otherwise the
+    rules are removed with individual iptables commands.
     """
 
     _log.info('starting teardown firewall for device %s' % dev)
 
+    try:
+        if fwmanager.tear_down_device(dev):
+            _log.info('tearing down firewall done using firewall manager')
+            return
+    except:
+        if not silent:
+            _log.exception('firewall manager teardown failed, removing rules directly')
+
     commands = [ ['/sbin/iptables', '-t', 'raw', '-D', 'raw_prerouting_ppp', '-i', dev, '-j', 'ppp_prert_%s' % dev],
                  ['/sbin/iptables', '-t', 'raw', '-D', 'raw_output_ppp', '-o', dev, '-j', 'ppp_output_%s' % dev],
                  ['/sbin/iptables', '-t', 'raw', '-F', 'ppp_prert_%s' % dev],
@@ -314,6 +326,16 @@ def nuke_ppp_devices(devnames,
         else:
             _log.warning('retiring device %s, but no retired devices list, ignoring' % t)
 
+    # keep connection history bounded between reboots; pruning is amortized
+    # by letting the history grow a bit over the limit first
+    if (retired is not None) and (len(to_retire) > 0):
+        try:
+            if len(retired) > constants.RETIRED_PPP_DEVICES_MAX_COUNT + constants.RETIRED_PPP_DEVICES_PRUNE_SLACK:
+                pruned_age, pruned_count = helpers.prune_retired_ppp_devices(retired, now=now)
+                _log.info('nuke_ppp_devices(): pruned retired devices, %d old, %d over limit' % (pruned_age, pruned_count))
+        except:
+            _log.exception('nuke_ppp_devices(): pruning retired devices failed, ignoring')
+
     # find pidlist
     original_kill_pidlist = []
     for t in to_retire:
@@ -630,12 +652,9 @@ class PppScripts:
                 self.ppp_ipparam, self.ppp_interface)
 
     @db.transact()
-    # XXX: candidate for refactoring
     def _find_user(self, username, clientmode=False):
-        users_cfg = helpers.get_config().getS(ns.usersConfig, rdf.Type(ns.UsersConfig))
-
-        for u in users_cfg.getS(ns.users, rdf.Bag(rdf.Type(ns.User))):
-            name = u.getS(ns.username, rdf.String)
+        # indexed lookup, this is done for every ip-pre-up, ip-up and ip-down
+        for u in helpers.find_ppp_users(username):
             if clientmode:
                 if not u.hasS(ns.siteToSiteUser):
                     continue
@@ -648,8 +667,7 @@ class PppScripts:
                 if not role.hasType(ns.Client):
                     continue
 
-            if name == username:
-                return u
+            return u
 
         return None
 
@@ -657,9 +675,13 @@ class PppScripts:
     def _setup_device_fw(self, restricted, web_forward, http_fwd_addr, http_fwd_port, https_fwd_addr, https_fwd_port, spoof_prevention, is_site_to_site):
         """Setup device firewall rules for this specific PPP device.
 
-        Assumes that tear_down_fw() has been called first.  The calling chains are configured
+        Existing rules of the device are replaced.  The calling chains are configured
         in a way that if the device-specific chain matches no targets, the traffic is accepted.
 
+        The rules are installed by the firewall manager daemon, which batches requests
+        of concurrent PPP scripts into one iptables-restore run.  If the manager is not
+        running, the device is torn down and the rules installed directly.
+
         Firewall rule structure:
           * Forced forwarding comes first (but only applies to HTTP/HTTPS)
           * DNS and WINS are always allowed, unless (1) restriction is required, and (2) http/https forwarding is *not* required
@@ -822,6 +844,15 @@ class PppScripts:
                 t = line.strip()
                 self._log.debug('%d: %s' % (linenum+1, t))
 
+        try:
+            if fwmanager.setup_device(params['dev'], tables):
+                self._log.debug('firewall rules installed using firewall manager')
+                return
+        except (fwmanager.FirewallManagerError, socket.error):
+            self._log.exception('firewall manager setup failed, installing rules directly')
+
+        tear_down_fw(params['dev'], silent=True)
+
         iptables_lock = helpers.acquire_iptables_lock()
         # execution
         try:
@@ -1701,7 +1732,6 @@ class PppScripts:
         # setup firewall rules
         self._log.debug('firewall config')
         try:
-            tear_down_fw(self.ppp_interface, silent=True)
             self._setup_device_fw(do_restricted,
                                   do_web_forward,
                                   self.ppp_iplocal,
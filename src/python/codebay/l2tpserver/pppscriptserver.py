@@ -0,0 +1,418 @@
+"""PPP script server for running ip-pre-up, ip-up and ip-down hooks.
+
+Every PPP script used to be a fresh Python process which imported the
+RDF, database and configuration modules before doing any actual work.
+The imports dominate the cost of a hook, and when hundreds of users
+reconnect at the same time (e.g. after a WAN outage) the gateway spends
+most of its time loading the same modules over and over again.
+
+The PPP script server is a long-lived daemon started by the runner.  It
+imports L{codebay.l2tpserver.pppscripts} once and accepts hook requests
+from a local Unix socket.  The actual /etc/ppp scripts are tiny shims
+(see L{run_hook}) which send their name, command line arguments and
+environment to the server and exit with the exit code of the hook.
+
+Each request is served by a forked worker, so hooks run concurrently
+just like separate script processes did, but start with all modules
+already loaded.  The worker replaces its command line arguments and
+environment with those of the request before running the hook, so the
+hook code and the commands it runs see exactly what pppd gave to the
+script.  The server itself never opens the database: SQLite connections
+must not be carried over a fork, so each worker opens its own (which is
+cheap compared to the imports).
+
+If the server is not running, L{run_hook} returns None and the shim
+runs the hook in-process as before.
+
+Protocol: a client connects, sends a marshalled request dictionary and
+shuts down its sending side.  The server replies with a single line,
+either 'ok <exit code>' after the hook has been run, or 'error
+<message>' if the hook was not run at all.
+"""
+__docformat__ = 'epytext en'
+
+import os, sys, socket, select, errno, signal, time, marshal
+
+from codebay.common import logger
+from codebay.l2tpserver import constants
+
+_log = logger.get('l2tpserver.pppscriptserver')
+
+_hook_functions = ['ppp_ip_pre_up', 'ppp_ip_up', 'ppp_ip_down']
+
+class PppScriptServerError(Exception):
+    """PPP script server request failed."""
+
+class _TerminateError(Exception):
+    """PPP script server got SIGTERM."""
+
+# --------------------------------------------------------------------------
+#
+#  Hook execution
+#
+
+def _check_request(req):
+    if not isinstance(req, dict):
+        raise PppScriptServerError('invalid request')
+    for k in ['name', 'funcname', 'argv', 'environ']:
+        if not req.has_key(k):
+            raise PppScriptServerError('missing request field: %s' % k)
+    if req['funcname'] not in _hook_functions:
+        raise PppScriptServerError('unknown hook function: %s' % req['funcname'])
+
+def run_hook_in_process(name, funcname, public_interface, private_interface, proxyarp_interface):
+    """Run a PPP hook in the current process and return its exit code.
+
+    Command line arguments and environment are taken from sys.argv and
+    os.environ.
+    """
+
+    from codebay.l2tpserver import pppscripts
+
+    try:
+        s = pppscripts.PppScripts(name=name,
+                                  public_interface=public_interface,
+                                  private_interface=private_interface,
+                                  proxyarp_interface=proxyarp_interface)
+        getattr(s, funcname)()
+    except:
+        logger.get('l2tpserver.pppscripts.%s' % name).exception('failed')
+        return 1
+    return 0
+
+def _run_request(req):
+    """Run a hook request in a forked worker."""
+
+    sys.argv = list(req['argv'])
+    os.environ.clear()
+    os.environ.update(req['environ'])
+
+    return run_hook_in_process(req['name'],
+                               req['funcname'],
+                               req.get('public_interface'),
+                               req.get('private_interface'),
+                               req.get('proxyarp_interface'))
+
+# --------------------------------------------------------------------------
+#
+#  Daemon
+#
+
+class PppScriptServer:
+    """Long-lived PPP script server, see module documentation."""
+
+    max_request_size = 256*1024
+
+    def __init__(self, socket_path=None, max_workers=None, handler=None):
+        if socket_path is None:
+            socket_path = constants.PPPSCRIPTSERVER_SOCKET
+        if max_workers is None:
+            max_workers = constants.PPPSCRIPTSERVER_MAX_WORKERS
+        if handler is None:
+            handler = _run_request
+        self.socket_path = socket_path
+        self.max_workers = max_workers
+        self.handler = handler
+
+        self.socket = None
+        self.workers = {}   # pid -> start time
+
+        self.request_count = 0
+        self.failed_count = 0
+
+    def _open_socket(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(self.socket_path)
+        os.chmod(self.socket_path, 0600)
+        self.socket.listen(128)
+
+    def _close_socket(self):
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            except:
+                pass
+            self.socket = None
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def _reap_workers(self, block=False):
+        while len(self.workers) > 0:
+            flags = os.WNOHANG
+            if block:
+                flags = 0
+            try:
+                pid, status = os.waitpid(-1, flags)
+            except OSError, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if e.args[0] == errno.ECHILD:
+                    self.workers = {}
+                    return
+                raise
+            if pid == 0:
+                return
+
+            if self.workers.has_key(pid):
+                del self.workers[pid]
+            if not (os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0):
+                self.failed_count += 1
+            block = False
+
+    def _wait_for_client(self, timeout):
+        try:
+            r, w, x = select.select([self.socket], [], [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return None
+            raise
+        if len(r) == 0:
+            return None
+
+        try:
+            conn, _ = self.socket.accept()
+        except socket.error, e:
+            if e.args[0] in [errno.EINTR, errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED]:
+                return None
+            raise
+        return conn
+
+    def _serve_worker(self, conn):
+        """Serve one request in a forked worker; never returns."""
+
+        rc = 1
+        try:
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                self.socket.close()
+
+                conn.settimeout(constants.PPPSCRIPTSERVER_REQUEST_TIMEOUT)
+                data = ''
+                while True:
+                    t = conn.recv(4096)
+                    if t == '':
+                        break
+                    data += t
+                    if len(data) > self.max_request_size:
+                        raise PppScriptServerError('request too large')
+
+                try:
+                    req = marshal.loads(data)
+                except (EOFError, ValueError, TypeError):
+                    raise PppScriptServerError('cannot parse request')
+                _check_request(req)
+            except PppScriptServerError, e:
+                _log.warning('invalid request: %s' % e)
+                conn.sendall('error %s\n' % e)
+            else:
+                rc = self.handler(req)
+                conn.sendall('ok %d\n' % rc)
+        finally:
+            try:
+                conn.close()
+            except:
+                pass
+            os._exit(rc)
+
+    def _start_worker(self, conn):
+        try:
+            pid = os.fork()
+        except OSError, e:
+            # client runs the hook in-process instead
+            _log.error('cannot fork worker: %s' % e)
+            try:
+                conn.sendall('error cannot fork worker\n')
+            except:
+                pass
+            conn.close()
+            return
+
+        if pid == 0:
+            try:
+                self._serve_worker(conn)
+            finally:
+                os._exit(1)
+
+        conn.close()
+        self.workers[pid] = time.time()
+        self.request_count += 1
+
+    def run(self):
+        """Serve requests until SIGTERM."""
+
+        def _sigterm_handler(signum, stackframe):
+            raise _TerminateError()
+
+        # the whole point of the server: workers start with modules loaded
+        from codebay.l2tpserver import pppscripts
+
+        signal.signal(signal.SIGTERM, _sigterm_handler)
+
+        _log.info('ppp script server starting')
+        try:
+            try:
+                self._open_socket()
+
+                while True:
+                    self._reap_workers()
+                    if len(self.workers) >= self.max_workers:
+                        # clients wait in the listen backlog meanwhile
+                        self._reap_workers(block=True)
+                        continue
+
+                    conn = self._wait_for_client(1.0)
+                    if conn is not None:
+                        self._start_worker(conn)
+            except _TerminateError:
+                _log.info('ppp script server got SIGTERM, exiting (%d requests, %d failed, %d workers running)' % \
+                          (self.request_count, self.failed_count, len(self.workers)))
+        finally:
+            self._close_socket()
+
+# --------------------------------------------------------------------------
+#
+#  Client side
+#
+
+def run_hook(name, funcname, public_interface, private_interface, proxyarp_interface, socket_path=None):
+    """Run a PPP hook using the PPP script server.
+
+    The command line arguments and environment of the current process are
+    passed to the hook.
+
+    @return: Exit code of the hook, or None if the PPP script server is not
+        running or refused the request; the hook has not been run then and
+        the caller is expected to run it in-process.
+    @raise PppScriptServerError: the hook was (possibly) run but the server
+        did not report its result.
+    """
+
+    if socket_path is None:
+        socket_path = constants.PPPSCRIPTSERVER_SOCKET
+
+    req = {'name': name,
+           'funcname': funcname,
+           'public_interface': public_interface,
+           'private_interface': private_interface,
+           'proxyarp_interface': proxyarp_interface,
+           'argv': list(sys.argv),
+           'environ': dict(os.environ)}
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(constants.PPPSCRIPTSERVER_REQUEST_TIMEOUT)
+        try:
+            s.connect(socket_path)
+        except socket.error, e:
+            if e.args[0] in [errno.ENOENT, errno.ECONNREFUSED]:
+                return None
+            raise
+
+        s.sendall(marshal.dumps(req))
+        s.shutdown(socket.SHUT_WR)
+
+        reply = ''
+        while True:
+            t = s.recv(4096)
+            if t == '':
+                break
+            reply += t
+    finally:
+        s.close()
+
+    reply = reply.strip()
+    if reply.startswith('ok '):
+        try:
+            return int(reply[3:])
+        except ValueError:
+            pass
+    elif reply.startswith('error'):
+        _log.warning('ppp script server refused request: %s' % reply)
+        return None
+    raise PppScriptServerError('no result from ppp script server: %r' % reply)
+
+# --------------------------------------------------------------------------
+#
+#  Benchmark
+#
+
+def _benchmark_handler(req):
+    return 0
+
+def _benchmark_spawn(count, code):
+    """Start count concurrent Python processes running code; return latencies."""
+
+    procs = []
+    for i in xrange(count):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.execv(sys.executable, [sys.executable, '-c', code])
+            finally:
+                os._exit(127)
+        procs.append((pid, time.time()))
+
+    latencies = []
+    failed = 0
+    for pid, start in procs:
+        _, status = os.waitpid(pid, 0)
+        latencies.append(time.time() - start)
+        if not (os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0):
+            failed += 1
+    return latencies, failed
+
+def _benchmark_report(label, latencies, failed):
+    latencies = list(latencies)
+    latencies.sort()
+    print '%-12s n=%d failed=%d avg=%.3fs median=%.3fs p90=%.3fs max=%.3fs' % \
+          (label, len(latencies), failed, sum(latencies) / len(latencies),
+           latencies[len(latencies) / 2], latencies[int(len(latencies) * 0.9)], latencies[-1])
+
+def run_benchmark(count=100):
+    """Measure hook latency for count concurrent connection setups.
+
+    Compares the shim talking to a PPP script server against the in-process
+    fallback.  The hook itself is a no-op in both cases (the actual hook
+    needs pppd and a configured database), so the numbers show the start-up
+    cost each connection setup pays before any hook work is done.
+    """
+
+    import tempfile, shutil
+
+    tempdir = tempfile.mkdtemp()
+    socket_path = os.path.join(tempdir, 'pppscriptserver.socket')
+    server_pid = os.fork()
+    if server_pid == 0:
+        try:
+            PppScriptServer(socket_path=socket_path, handler=_benchmark_handler).run()
+        finally:
+            os._exit(0)
+
+    try:
+        for i in xrange(50):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.1)
+
+        shim = 'import sys; from codebay.l2tpserver import pppscriptserver; ' \
+               'sys.exit(pppscriptserver.run_hook("ppp-ip-pre-up", "ppp_ip_pre_up", "eth0", None, None, socket_path=%r))' % socket_path
+        fallback = 'from codebay.l2tpserver import pppscripts'
+
+        latencies, failed = _benchmark_spawn(count, shim)
+        _benchmark_report('server', latencies, failed)
+        latencies, failed = _benchmark_spawn(count, fallback)
+        _benchmark_report('in-process', latencies, failed)
+    finally:
+        os.kill(server_pid, signal.SIGTERM)
+        os.waitpid(server_pid, 0)
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    count = 100
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    run_benchmark(count)
@@ -531,5 +531,16 @@ ns_zipfiles = rdf.NS(ns_codebay['l2tp/1.0/'],
                      diagnosticsExport = None,
 )
 
+# runner monitor status, see startstop.Monitor; same namespace as ns_l2tp,
+# separate because ns_l2tp is close to the limit of 255 function arguments
+ns_monitor = rdf.NS(ns_codebay['l2tp/1.0/'],
+                    monitorStatuses = None,
+                    MonitorStatus = None,
+                    monitorName = None,
+                    monitorHealthCheck = None,
+                    monitorLastCheckTime = None,
+                    monitorLatency = None,
+)
+
 # for convenience
 ns = ns_l2tp
@@ -0,0 +1,345 @@
+"""RRD access layer.
+
+Graph code used to run a separate rrdtool process for every create, update,
+fetch and graph operation, and parsed fetch output into one Python object
+per sample.  This module keeps one persistent 'rrdtool -' process per Python
+process and feeds commands to it through a pipe.  If the python-rrdtool
+bindings are installed, they are used instead of the pipe.  If the pipe
+breaks, commands are retried by running rrdtool directly.
+
+Fetch results are column oriented (L{FetchResult}); NumPy arrays are
+available when NumPy is installed.  Recent fetch windows are cached (see
+L{fetch_cached}) so that drawing several graphs from the same RRD file
+costs only one fetch.  A cached window is dropped when the RRD file is
+updated.
+
+In pipe mode, rrdtool answers each command with its normal output followed
+by an 'OK u:... s:... r:...' line, or with a single 'ERROR: ...' line.
+"""
+__docformat__ = 'epytext en'
+
+import os, fcntl, datetime
+
+from codebay.common import logger
+from codebay.common import subprocess
+from codebay.l2tpserver import constants
+from codebay.l2tpserver import runcommand
+
+run_command = runcommand.run_command
+_log = logger.get('l2tpserver.rrd')
+
+try:
+    import rrdtool as _rrdtool
+except ImportError:
+    _rrdtool = None
+
+try:
+    import numpy as _numpy
+except ImportError:
+    _numpy = None
+
+class RrdError(Exception):
+    """RRD operation failed."""
+
+class _PipeError(RrdError):
+    """Persistent rrdtool process failed or cannot handle the command."""
+
+# --------------------------------------------------------------------------
+
+class FetchResult:
+    """Result of an RRD fetch in column form.
+
+    @ivar start: Start of the fetched window (seconds since epoch).
+    @ivar step: Step (resolution) of the fetched data in seconds.
+    @ivar names: Data source names, in RRD order.
+    @ivar times: Sample times as naive datetime.datetime objects.
+    @ivar columns: Dict of data source name to a list of values; values
+        are floats, or None for unknown (nan) values.
+    """
+
+    def __init__(self, start, step, names, columns):
+        self.start = start
+        self.step = step
+        self.names = names
+        self.columns = columns
+
+        count = 0
+        if len(names) > 0:
+            count = len(columns[names[0]])
+        self.times = [datetime.datetime.fromtimestamp(start + step*(i + 1)) for i in xrange(count)]
+        self._arrays = {}
+
+    def __len__(self):
+        return len(self.times)
+
+    def get_column(self, dsname):
+        """Get values of a data source as a list, unknown values as None.
+
+        The list is shared with the fetch cache, do not modify it.
+        """
+        return self.columns[dsname]
+
+    def get_array(self, dsname):
+        """Get values of a data source as a NumPy float array, unknown values as nan.
+
+        Returns None if NumPy is not available.
+        """
+        if _numpy is None:
+            return None
+        if not self._arrays.has_key(dsname):
+            nan = float('nan')
+            vals = []
+            for v in self.columns[dsname]:
+                if v is None:
+                    vals.append(nan)
+                else:
+                    vals.append(v)
+            self._arrays[dsname] = _numpy.array(vals, dtype=float)
+        return self._arrays[dsname]
+
+def _parse_value(v):
+    if v is None:
+        return None
+    try:
+        f = float(v)
+    except ValueError:
+        _log.warning('failed to parse rrd value: %s' % v)
+        return None
+    if f != f:  # nan
+        return None
+    return f
+
+def _parse_fetch_output(output):
+    """Parse text output of 'rrdtool fetch' into a FetchResult."""
+
+    names = None
+    times = []
+    rows = []
+    for line in output.split('\n'):
+        if line.strip() == '':
+            continue
+        if names is None:
+            names = line.split()
+            continue
+        try:
+            [timestamp, rest] = line.split(':', 1)
+            times.append(int(timestamp.strip()))
+            rows.append(rest.split())
+        except ValueError:
+            _log.warning('ignoring unexpected rrdtool fetch line: %s' % line)
+
+    if names is None:
+        names = []
+
+    columns = {}
+    for i, name in enumerate(names):
+        columns[name] = [_parse_value(r[i]) for r in rows]
+
+    start, step = 0, 1
+    if len(times) >= 2:
+        step = times[1] - times[0]
+    if len(times) >= 1:
+        start = times[0] - step
+    return FetchResult(start, step, names, columns)
+
+# --------------------------------------------------------------------------
+
+class RrdPipe:
+    """Persistent 'rrdtool -' process.
+
+    The process is started on first use and restarted if it dies.
+    """
+
+    def __init__(self, command=constants.CMD_RRDTOOL):
+        self.command = command
+        self.proc = None
+
+    def start(self):
+        _log.debug('starting persistent rrdtool process')
+        self.proc = subprocess.Popen([self.command, '-'],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     close_fds=True)
+
+        # don't leak our ends of the pipe to other children, or rrdtool will
+        # not see EOF when we exit
+        for f in [self.proc.stdin, self.proc.stdout]:
+            flags = fcntl.fcntl(f.fileno(), fcntl.F_GETFD)
+            fcntl.fcntl(f.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+    def stop(self):
+        if self.proc is None:
+            return
+        proc, self.proc = self.proc, None
+        try:
+            proc.stdin.close()
+            proc.wait()
+        except:
+            _log.exception('failed to stop persistent rrdtool process')
+
+    def execute(self, args):
+        """Execute an rrdtool command and return its output.
+
+        Raises L{RrdError} if rrdtool reports an error, and L{_PipeError}
+        if the command cannot be run through the pipe.
+        """
+
+        # pipe mode splits commands at whitespace; let the caller run
+        # rrdtool directly for arguments that would need quoting
+        for a in args:
+            if a == '' or len(a.split()) != 1 or '"' in a or "'" in a:
+                raise _PipeError('argument not suitable for rrdtool pipe: %r' % a)
+
+        if self.proc is None:
+            self.start()
+
+        lines = []
+        try:
+            self.proc.stdin.write(' '.join(args) + '\n')
+            self.proc.stdin.flush()
+            while True:
+                line = self.proc.stdout.readline()
+                if line == '':
+                    raise _PipeError('rrdtool process exited unexpectedly')
+                if line.startswith('OK '):
+                    break
+                if line.startswith('ERROR:'):
+                    raise RrdError(line[len('ERROR:'):].strip())
+                lines.append(line)
+        except (IOError, OSError), e:
+            self.stop()
+            raise _PipeError('rrdtool pipe failed: %s' % e)
+        except _PipeError:
+            self.stop()
+            raise
+
+        return ''.join(lines)
+
+_pipe = RrdPipe()
+
+def _execute(args):
+    """Run an rrdtool command through the persistent pipe, or directly if that fails."""
+
+    try:
+        return _pipe.execute(args)
+    except _PipeError, e:
+        _log.debug('running rrdtool directly: %s' % e)
+
+    try:
+        [rv, stdout, stderr] = run_command([constants.CMD_RRDTOOL] + args, retval=runcommand.FAIL)
+    except runcommand.RunException, e:
+        raise RrdError('rrdtool %s failed: %s' % (args[0], e.stderr))
+    return stdout
+
+def close():
+    """Stop the persistent rrdtool process, if any."""
+    _pipe.stop()
+
+# --------------------------------------------------------------------------
+
+_fetch_cache = {}
+_fetch_cache_order = []
+
+def _invalidate_cache(filename):
+    for key in _fetch_cache.keys():
+        if key[0] == filename:
+            del _fetch_cache[key]
+            _fetch_cache_order.remove(key)
+
+def create(filename, args):
+    """Create an RRD file; args are the arguments after the filename."""
+
+    _invalidate_cache(filename)
+    if _rrdtool is not None:
+        try:
+            _rrdtool.create(filename, *args)
+        except _rrdtool.error, e:
+            raise RrdError('rrdtool create failed: %s' % e)
+        return
+    _execute(['create', filename] + args)
+
+def update(filename, values):
+    """Update an RRD file with one sample.
+
+    @param values: List of strings; the timestamp followed by data source values.
+    """
+
+    _invalidate_cache(filename)
+    valstr = ':'.join(values)
+    if _rrdtool is not None:
+        try:
+            _rrdtool.update(filename, valstr)
+        except _rrdtool.error, e:
+            raise RrdError('rrdtool update failed: %s' % e)
+        return
+    _execute(['update', filename, valstr])
+
+def fetch(filename, cf, start, end, resolution=None):
+    """Fetch data from an RRD file.
+
+    @param start: Window start, seconds since epoch.
+    @param end: Window end, seconds since epoch.
+    @return: L{FetchResult}
+    """
+
+    args = [cf, '--start', str(int(start)), '--end', str(int(end))]
+    if resolution is not None:
+        args += ['--resolution', str(int(resolution))]
+
+    if _rrdtool is not None:
+        try:
+            [[r_start, r_end, r_step], names, rows] = _rrdtool.fetch(filename, *args)
+        except _rrdtool.error, e:
+            raise RrdError('rrdtool fetch failed: %s' % e)
+        columns = {}
+        for i, name in enumerate(names):
+            columns[name] = [_parse_value(r[i]) for r in rows]
+        return FetchResult(r_start, r_step, list(names), columns)
+
+    return _parse_fetch_output(_execute(['fetch', filename] + args))
+
+def fetch_cached(filename, cf, start, end, resolution):
+    """Fetch data from an RRD file, reusing a recent fetch of the same window.
+
+    The window is rounded down to a multiple of resolution, so that repeated
+    fetches of e.g. "last week" within one step hit the cache.  Cached
+    results are shared; callers must not modify them.
+
+    @return: L{FetchResult}
+    """
+
+    resolution = int(resolution)
+    start = int(start) / resolution * resolution
+    end = int(end) / resolution * resolution
+    key = (filename, cf, start, end, resolution)
+
+    try:
+        mtime = os.stat(filename).st_mtime
+    except OSError:
+        mtime = None
+
+    if _fetch_cache.has_key(key):
+        cached_mtime, res = _fetch_cache[key]
+        _fetch_cache_order.remove(key)
+        if cached_mtime == mtime:
+            _fetch_cache_order.append(key)
+            return res
+        del _fetch_cache[key]
+
+    res = fetch(filename, cf, start, end, resolution=resolution)
+    _fetch_cache[key] = (mtime, res)
+    _fetch_cache_order.append(key)
+    while len(_fetch_cache_order) > constants.RRD_FETCH_CACHE_SIZE:
+        del _fetch_cache[_fetch_cache_order.pop(0)]
+    return res
+
+def graph(filename, args):
+    """Draw a graph into filename using 'rrdtool graph'; args are the arguments after the filename."""
+
+    if _rrdtool is not None:
+        try:
+            _rrdtool.graph(filename, *args)
+        except _rrdtool.error, e:
+            raise RrdError('rrdtool graph failed: %s' % e)
+        return
+    _execute(['graph', filename] + args)
@@ -38,9 +38,10 @@ import textwrap
 from codebay.common import rdf
 from codebay.common import datatypes
 from codebay.common import logger
+from codebay.common import subprocess
 from codebay.l2tpserver import helpers
 from codebay.l2tpserver import constants
-from codebay.l2tpserver.rdfconfig import ns
+from codebay.l2tpserver.rdfconfig import ns, ns_monitor
 from codebay.l2tpserver import runcommand
 from codebay.l2tpserver import configresolve
 from codebay.l2tpserver import licensemanager
@@ -59,7 +60,9 @@ from codebay.l2tpserver.config import \
      pppd, \
      freeradius, \
      snmpd, \
-     dhcp
+     dhcp, \
+     fwmanager, \
+     pppscriptserver
 
 run_command = runcommand.run_command
 _log = logger.get('l2tpserver.startstop')
@@ -662,6 +665,10 @@ class L2tpRunnerBase:
         p = freeradius.FreeradiusConfig()
         p.create_config(helpers.get_config(), self._resolved_info)
 
+        # user changes only: reload instead of restart
+        if p.reload_users():
+            return
+
         p.pre_stop()
         try:
             p.soft_stop(silent=False)
@@ -1163,52 +1170,131 @@ class L2tpRunnerBase:
 
 # --------------------------------------------------------------------------
 
-# XXX: generalize to helpers? we may need this elsewhere too
-# XXX: send larger packets - we had earleir problem with small packets working but large ones not
-# XXX: random padding to ping? otherwise compresses "too well"
-
-@db.untransact()
-def _ping_check(addr, interval=1.0, max_wait=5, dev=None):
-    # From ping man page
-    #
-    #    If ping does not receive any reply packets at all it will exit with code 1.
-    #    If a packet count and deadline are both specified, and fewer than count
-    #    packets are received by the time the deadline has arrived, it will also exit
-    #    with code 1.  On other error it exits with  code 2. Otherwise it exits with
-    #    code 0. This makes it possible to use the exit code to see if a host is alive
-    #    or not.
-    #
-    # We want to send multiple pings, and check whether any of the pings gets a
-    # response.  Thus, we don't want to detect "partially working" configs.
-    #
-    # -i 1.0, -c 1, -w 5 will send 5 ping packets and be satisfied if at least
-    # one response is received.  It will exit immediately after first response has
-    # been received.
-
-    dev_opt = []
-    if dev is not None:
-        dev_opt += ['-I', dev]
-        
-    [rv, ign1, ign2] = run_command([constants.CMD_PING, '-i', str(interval), '-c', '1', '-w', str(max_wait)] +
-                                   dev_opt + [addr])
-    return (rv == 0)
-
-# XXX: generalize to helpers? we may need this elsewhere too
-# we might use this to probe arp our dhcp address
-@db.untransact()
-def _arping_check(addr, interface=None, src_addr=None, max_wait=3):
-    # Arpings are sent once per second, so max_wait is both timeout
-    # and count. We also quit on first reply.
-    [rv, ign1, ign2] = run_command([constants.CMD_ARPING, '-f', '-c', str(max_wait), '-s', str(src_addr), '-I', str(interface), addr])
-    return (rv == 0)
-
 @db.untransact()
 def _wrapped_dns_resolve_host(dest):
     return helpers.dns_resolve_host(dest)
 
+class ProbeBatch:
+    """Health check probes (ping, arping) of one main loop round.
+
+    Monitors add probes under keys of their choosing, the runner runs all
+    probes of the round concurrently, and monitors then read the results by
+    key in update().  At most max_parallel probe processes run at a time,
+    and probes still running (or not yet started) at the deadline count as
+    failed.
+    """
+
+    def __init__(self, max_parallel=None, deadline=None):
+        if max_parallel is None:
+            max_parallel = constants.MONITOR_PROBE_MAX_PARALLEL
+        if deadline is None:
+            deadline = constants.MONITOR_PROBE_DEADLINE
+        self.max_parallel = max_parallel
+        self.deadline = deadline
+        self._keys = []      # probe keys in order of addition
+        self._args = {}      # key -> command line
+        self._results = {}   # key -> (success, elapsed seconds)
+
+    # XXX: send larger packets - we had earleir problem with small packets working but large ones not
+    # XXX: random padding to ping? otherwise compresses "too well"
+    def add_ping(self, key, addr, interval=1.0, max_wait=5, dev=None):
+        # See ping(8): with -c 1 and -w max_wait, ping sends a packet every
+        # interval and exits with 0 on the first response, or with 1 if
+        # there is no response within max_wait seconds.
+        dev_opt = []
+        if dev is not None:
+            dev_opt += ['-I', dev]
+        self._add(key, [constants.CMD_PING, '-i', str(interval), '-c', '1', '-w', str(max_wait)] + dev_opt + [addr])
+
+    def add_arping(self, key, addr, interface=None, src_addr=None, max_wait=3):
+        # Arpings are sent once per second, so max_wait is both timeout
+        # and count. We also quit on first reply.
+        self._add(key, [constants.CMD_ARPING, '-f', '-c', str(max_wait), '-s', str(src_addr), '-I', str(interface), addr])
+
+    def _add(self, key, args):
+        if not self._args.has_key(key):
+            self._keys.append(key)
+        self._args[key] = args
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get_result(self, key):
+        """Return True if the probe succeeded, False if it failed or did not run."""
+        if not self._results.has_key(key):
+            return False
+        return self._results[key][0]
+
+    def get_elapsed(self, key):
+        """Return probe run time in seconds, or None if the probe did not run."""
+        if not self._results.has_key(key):
+            return None
+        return self._results[key][1]
+
+    @db.untransact()
+    def run(self):
+        """Run all probes; blocks until all are complete or the deadline passes."""
+
+        if len(self._keys) == 0:
+            return
+
+        start = time.time()
+        deadline = start + self.deadline
+        queue = list(self._keys)
+        running = {}   # key -> (Popen, start time)
+        devnull = open(os.devnull, 'r+b')
+        try:
+            while (len(queue) > 0) or (len(running) > 0):
+                now = time.time()
+                if now >= deadline:
+                    break
+
+                while (len(queue) > 0) and (len(running) < self.max_parallel):
+                    key = queue.pop(0)
+                    try:
+                        p = subprocess.Popen(self._args[key], stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True)
+                        running[key] = (p, time.time())
+                    except:
+                        _log.exception('failed to start probe %s' % self._args[key])
+                        self._results[key] = (False, 0.0)
+
+                time.sleep(0.1)
+
+                now = time.time()
+                for key, (p, t) in running.items():
+                    rv = p.poll()
+                    if rv is not None:
+                        del running[key]
+                        self._results[key] = (rv == 0, now - t)
+        finally:
+            now = time.time()
+            for key, (p, t) in running.items():
+                _log.warning('probe %s did not complete before deadline, killing' % self._args[key])
+                try:
+                    os.kill(p.pid, signal.SIGKILL)
+                    p.wait()
+                except:
+                    _log.exception('failed to kill probe process %s' % p.pid)
+                self._results[key] = (False, now - t)
+            for key in queue:
+                _log.warning('probe %s not started before deadline' % self._args[key])
+            devnull.close()
+
+        _log.debug('ran %d probes in %f seconds' % (len(self._keys), time.time() - start))
+
 # --------------------------------------------------------------------------
 
 class Monitor:
+    """Base class for main loop monitors.
+
+    A monitor check has two phases so that the probes of all monitors can run
+    concurrently: start_check() decides whether an update is due and adds
+    the monitor's probes to the round's L{ProbeBatch}, and finish_check()
+    runs update() after the probes have run.  Subclasses add probes in
+    add_probes() using probe_ping() and probe_arping(), and read results
+    in update() using probe_result().
+    """
+
     def __init__(self, runner, interval=None):
         self.name = self.__class__.__name__
         self.runner = runner
@@ -1217,10 +1303,14 @@ class Monitor:
         self.resolved_info = runner._resolved_info
         self.interval = interval
         self.last_update = None
+        self.last_latency = None
+        self.rdf_status_node = None
+        self.probes = None
+        self._probe_keys = []
 
         self.init()
 
-    def check_monitor(self):
+    def start_check(self, probes):
         now = time.time()
 
         do_update = False
@@ -1234,15 +1324,71 @@ class Monitor:
 
         if not do_update:
             _log.debug('skipping update for %s, diff %s' % (self.name, diff))
-            return None
+            return False
 
         _log.debug('running update for %s, diff %s' % (self.name, diff))
 
         self.last_update = now
-        return self.update()
+        self.probes = probes
+        self._probe_keys = []
+        self.add_probes()
+        return True
+
+    def finish_check(self):
+        start = time.time()
+        try:
+            return self.update()
+        finally:
+            latency = time.time() - start
+            probe_times = [self.probes.get_elapsed((self.name, k)) for k in self._probe_keys]
+            probe_times = [t for t in probe_times if t is not None]
+            if len(probe_times) > 0:
+                latency += max(probe_times)
+            self.last_latency = latency
+            self.probes = None
+            self._probe_keys = []
+
+    def check_monitor(self):
+        """Check this monitor alone, with a probe round of its own."""
+
+        probes = ProbeBatch()
+        if not self.start_check(probes):
+            return None
+        probes.run()
+        return self.finish_check()
+
+    def has_probes(self):
+        return len(self._probe_keys) > 0
+
+    def probe_ping(self, key, addr, **kw):
+        self._probe_keys.append(key)
+        self.probes.add_ping((self.name, key), addr, **kw)
+
+    def probe_arping(self, key, addr, **kw):
+        self._probe_keys.append(key)
+        self.probes.add_arping((self.name, key), addr, **kw)
+
+    def probe_result(self, key):
+        return self.probes.get_result((self.name, key))
+
+    def publish_status(self, result):
+        """Publish last check result and latency to RDF status."""
+        st = self.rdf_status_node
+        if st is None:
+            return
+        st.setS(ns_monitor.monitorLastCheckTime, rdf.Datetime, datetime.datetime.utcnow())
+        if result is None:
+            st.removeNodes(ns_monitor.monitorHealthCheck)
+        else:
+            st.setS(ns_monitor.monitorHealthCheck, rdf.Boolean, result)
+        if self.last_latency is not None:
+            st.setS(ns_monitor.monitorLatency, rdf.Float, self.last_latency)
 
     def init(self):
         pass
+
+    def add_probes(self):
+        pass
     
     def update(self):
         raise Exception('%s: unimplemented' % (self.name))
@@ -1344,17 +1490,38 @@ class RouterMonitor(Monitor):
         self.last_success_public = now
         self.last_success_private = now
         
-    def update(self):
-        """Check that all (unique) routers respond to arping."""
-
-        now = datetime.datetime.utcnow()
-
+    def _get_interfaces(self):
         pubif = None
         if self.resolved_info.public_interface is not None:
             pubif = self.resolved_info.public_interface.device
         privif = None
         if self.resolved_info.private_interface is not None:
             privif = self.resolved_info.private_interface.device
+        return pubif, privif
+
+    def add_probes(self):
+        pubif, privif = self._get_interfaces()
+        for rtr in self._routerlist:
+            router = rtr.router_address
+            iface = rtr.devname
+
+            srcaddr = None
+            if iface == pubif:
+                srcaddr = self.resolved_info.public_interface.address.getAddress().toString()
+            elif iface == privif:
+                srcaddr = self.resolved_info.private_interface.address.getAddress().toString()
+            else:
+                # XXX: this error handling is probably incorrect
+                _log.error('do not know how to check router: cannot figure out src addr (router=%s, iface=%s)' % (router.toString(), iface))
+
+            self.probe_arping(router.toString(), router.toString(), interface=iface, src_addr=srcaddr)
+
+    def update(self):
+        """Check that all (unique) routers respond to arping."""
+
+        now = datetime.datetime.utcnow()
+
+        pubif, privif = self._get_interfaces()
 
         pub_success = False
         priv_success = False
@@ -1366,21 +1533,15 @@ class RouterMonitor(Monitor):
             iface = rtr.devname
             st = rtr.rdf_status_node
             
-            srcaddr = None
             is_pub = False
             if iface == pubif:
                 is_pub = True
-                srcaddr = self.resolved_info.public_interface.address.getAddress().toString()
                 num_pub_routers += 1
             elif iface == privif:
                 is_pub = False
-                srcaddr = self.resolved_info.private_interface.address.getAddress().toString()
                 num_priv_routers += 1
-            else:
-                # XXX: this error handling is probably incorrect
-                _log.error('do not know how to check router: cannot figure out src addr (router=%s, iface=%s)' % (router.toString(), iface))
 
-            if not _arping_check(router.toString(), interface=iface, src_addr=srcaddr):
+            if not self.probe_result(router.toString()):
                 failed.append(router.toString())
                 st.setS(ns.routerHealthCheck, rdf.Boolean, False)
             else:
@@ -1424,6 +1585,7 @@ class SiteToSiteTunnel:
     def __init__(self, user, tunnel_index, status_node):
         self.user = user
         self.username = user.getS(ns.username, rdf.String)
+        self.is_client = user.getS(ns.siteToSiteUser, rdf.Type(ns.SiteToSiteUser)).getS(ns.role).hasType(ns.Client)
         self.tunnel_index = tunnel_index
         self.incarnation = 0 # how many restarts
         self.status_node = status_node
@@ -1508,33 +1670,50 @@ class SiteToSiteTunnelMonitor(Monitor):
                                                 self._sitetosite_resolved_endpoints[user_uri].toString()))
         return True
     
-    def _stop_tunnel(self, tunnel):
-        if tunnel.has_incarnation():
-            ol = openl2tp.Openl2tpConfig()
-            ol.stop_client_connection(tunnel.get_tunnel_id())
-            pc = pluto.PlutoConfig()
-            pc.stop_client_connection(tunnel.get_tunnel_id(), silent=True)  # may fail
-        else:
-            _log.debug('tunnel %s does not have a previous incarnation, skipping' % (tunnel.username))
-            
-    def _start_tunnel(self, tunnel):
-        user = tunnel.user
-        s2s = user.getS(ns.siteToSiteUser, rdf.Type(ns.SiteToSiteUser))
-        user_uri = str(user.getUri())
+    def _stop_tunnels(self, tunnels):
+        """Stop tunnels, using one openl2tpconfig run for all of them."""
 
-        ownaddr = self.resolved_info.public_interface.address.getAddress()
+        identifiers = []
+        for tunnel in tunnels:
+            if tunnel.has_incarnation():
+                identifiers.append(tunnel.get_tunnel_id())
+            else:
+                _log.debug('tunnel %s does not have a previous incarnation, skipping' % (tunnel.username))
 
-        addr = self._sitetosite_resolved_endpoints[user_uri]
-        if addr is None:
-            _log.warning('cannot reinit to unknown endpoint, site-to-site client %s (should not happen)' % tunnel.username)
+        if len(identifiers) == 0:
             return
 
-        # XXX: if untransact required here, the parameters to pluto
-        # and openswan connection starts cannot be rdf nodes
+        ol = openl2tp.Openl2tpConfig()
+        ol.stop_client_connections(identifiers)
         pc = pluto.PlutoConfig()
-        pc.start_client_connection(tunnel.get_tunnel_id(), ownaddr, addr)
+        for identifier in identifiers:
+            pc.stop_client_connection(identifier, silent=True)  # may fail
+            
+    def _start_tunnels(self, tunnels):
+        """Start tunnels, using one openl2tpconfig run for all of them."""
+
+        ownaddr = self.resolved_info.public_interface.address.getAddress()
+
+        connections = []
+        for tunnel in tunnels:
+            user = tunnel.user
+            user_uri = str(user.getUri())
+
+            addr = self._sitetosite_resolved_endpoints[user_uri]
+            if addr is None:
+                _log.warning('cannot reinit to unknown endpoint, site-to-site client %s (should not happen)' % tunnel.username)
+                continue
+
+            # XXX: if untransact required here, the parameters to pluto
+            # and openswan connection starts cannot be rdf nodes
+            pc = pluto.PlutoConfig()
+            pc.start_client_connection(tunnel.get_tunnel_id(), ownaddr, addr)
+            connections.append((tunnel.get_tunnel_id(), ownaddr, addr, user.getS(ns.username, rdf.String), user.getS(ns.password, rdf.String)))
+
         ol = openl2tp.Openl2tpConfig()
-        ol.start_client_connection(tunnel.get_tunnel_id(), ownaddr, addr, user.getS(ns.username, rdf.String), user.getS(ns.password, rdf.String))
+        failed = ol.start_client_connections(connections)
+        if len(failed) > 0:
+            _log.warning('failed to start site-to-site tunnels: %s' % ', '.join(failed))
 
     def _rewrite_pluto_psks(self):
         extra_psks = []
@@ -1583,6 +1762,24 @@ class SiteToSiteTunnelMonitor(Monitor):
         _log.info('list of site-to-site usernames to monitor: %s' % ', '.join(t))
 
         self._sitetositetunnels = res
+        self._probed_devices = {}
+
+    def add_probes(self):
+        """Find the ppp device of each tunnel and add a ping to its remote endpoint.
+
+        Devices are looked up by username from the store indexes, so the cost
+        is linear in the number of tunnels, not in the number of devices.
+        """
+
+        self._probed_devices = {}
+        for t in self._sitetositetunnels:
+            devstatus = helpers.find_ppp_device_status_sitetosite(t.username, t.is_client)
+            if devstatus is None:
+                continue
+            self._probed_devices[t.tunnel_index] = devstatus
+            addr = devstatus.getS(ns.pppRemoteAddress, rdf.IPv4Address)
+            devname = devstatus.getS(ns.deviceName, rdf.String)
+            self.probe_ping(t.tunnel_index, addr.toString(), dev=devname)
 
     def update(self):
         """Check site-to-site connections for liveness and take appropriate
@@ -1592,11 +1789,6 @@ class SiteToSiteTunnelMonitor(Monitor):
         endpoint of the PPP connection.  If there is no response, we reinitialize
         the site-to-site connection.
 
-        XXX: We're doing a slow O(n^2) lookup here by first iterating through
-        site-to-site connections; and then, per site to site connection, iterating
-        through all ppp device statuses.  The latter could be optimized by proper
-        cross-referencing.
-
         XXX: We should report status of client and server connections separately,
         as the recovery action is different; for client connections, we reinit.
         For server connections, we cannot do anything unless the cause is within
@@ -1611,26 +1803,17 @@ class SiteToSiteTunnelMonitor(Monitor):
         reinit = []
         
         for t in self._sitetositetunnels:
-            user = t.user
             username = t.username
-            user_uri = str(user.getUri())
-            s2s = user.getS(ns.siteToSiteUser, rdf.Type(ns.SiteToSiteUser))
-            role = s2s.getS(ns.role)
-            is_client = role.hasType(ns.Client)
             _log.debug('site-to-site aliveness check for %s' % username)
 
             # check role; only client connections are reinited
-            role = s2s.getS(ns.role)
-            is_client = role.hasType(ns.Client)
+            is_client = t.is_client
 
-            # first check whether a ppp device exists; if not, reinit
-            dev_ok = False
+            # first check whether a ppp device existed when probing; if not, reinit
             devstatus = None
-            for d in helpers.get_ppp_devices():
-                if d.hasS(ns.username) and d.getS(ns.username, rdf.String) == username:
-                    dev_ok = True
-                    devstatus = d
-                    break
+            if self._probed_devices.has_key(t.tunnel_index):
+                devstatus = self._probed_devices[t.tunnel_index]
+            dev_ok = (devstatus is not None)
             _log.debug('dev_ok=%s' % dev_ok)
 
             if not dev_ok: 
@@ -1642,10 +1825,8 @@ class SiteToSiteTunnelMonitor(Monitor):
                     reinit.append(t)
                 continue
 
-            # if ppp device exists, try pinging remote endpoint
-            addr = devstatus.getS(ns.pppRemoteAddress, rdf.IPv4Address)
-            devname = devstatus.getS(ns.deviceName, rdf.String)
-            if _ping_check(addr.toString(), dev=devname):
+            # if ppp device exists, check ping to remote endpoint
+            if self.probe_result(t.tunnel_index):
                 _log.debug('ping ok')
                 success.append(username)
                 t.status_node.setS(ns.tunnelHealthCheck, rdf.Boolean, True)
@@ -1660,8 +1841,7 @@ class SiteToSiteTunnelMonitor(Monitor):
                     reinit.append(t)
 
         # reinit: stop all failed connections
-        for t in reinit:
-            self._stop_tunnel(t)
+        self._stop_tunnels(reinit)
             
         # reinit: reresolve endpoints
         _log.debug('old dns mappings: %s' % str(self._sitetosite_resolved_endpoints))
@@ -1688,8 +1868,7 @@ class SiteToSiteTunnelMonitor(Monitor):
             t.bump_incarnation()
             
         # reinit: (re)start all failed connections
-        for t in reinit:
-            self._start_tunnel(t)
+        self._start_tunnels(reinit)
 
         # final logging, and return value
         if len(failure) > 0:
@@ -1760,6 +1939,10 @@ class PingableServerMonitor(Monitor):
 
         self._srvlist = srvlist
 
+    def add_probes(self):
+        for srv in self._srvlist:
+            self.probe_ping(srv.server_address.toString(), srv.server_address.toString())
+
     def update(self):
         """Check that all DNS/WINS/RADIUS servers respond to ping.
 
@@ -1772,7 +1955,7 @@ class PingableServerMonitor(Monitor):
         failed = []
         for srv in self._srvlist:
             addr = srv.server_address
-            if not _ping_check(addr.toString()):
+            if not self.probe_result(addr.toString()):
                 failed.append(addr.toString())
                 srv.rdf_status_node.setS(ns.serverHealthCheck, rdf.Boolean, False)
             else:
@@ -1921,7 +2104,10 @@ class L2tpRunner(L2tpRunnerBase):
             self.pluto_config = pluto.PlutoConfig()
             self.openl2tp_config = openl2tp.Openl2tpConfig()
 
-            return [portmap.PortmapConfig(),
+            # fwmanager and pppscriptserver first: ppp scripts use them until pppd is stopped
+            return [fwmanager.FwmanagerConfig(),
+                    pppscriptserver.PppscriptserverConfig(),
+                    portmap.PortmapConfig(),
                     freeradius.FreeradiusConfig(),
                     self.pluto_config,
                     pppd.PppdConfig(),
@@ -1952,7 +2138,9 @@ class L2tpRunner(L2tpRunnerBase):
                      pluto.PlutoConfig(),
                      freeradius.FreeradiusConfig(),
                      snmpd.SnmpdConfig(),
-                     portmap.PortmapConfig()] # MonitConfig not included
+                     portmap.PortmapConfig(),
+                     pppscriptserver.PppscriptserverConfig(),
+                     fwmanager.FwmanagerConfig()] # MonitConfig not included
             else:
                 # Note: intentionally using the same instances but in reverse order
                 d = list(self.started_daemons)
@@ -2013,6 +2201,13 @@ class L2tpRunner(L2tpRunnerBase):
             raise Exception('unknown mode: %s' % self._mode)
 
         self._monitored_things = t
+
+        status = helpers.get_status()
+        monitor_statuses = status.setS(ns_monitor.monitorStatuses, rdf.Bag(rdf.Type(ns_monitor.MonitorStatus)))
+        for m in t:
+            st = monitor_statuses.new()
+            st.setS(ns_monitor.monitorName, rdf.String, m.name)
+            m.rdf_status_node = st
         
     def _update_rdf_status_timestamp(self, now):
         status = helpers.get_status()
@@ -2032,12 +2227,18 @@ class L2tpRunner(L2tpRunnerBase):
         # may manifest itself as very long RPC timeouts, making the entire cycle
         # take several minutes (even tens of minutes).  We thus want to flag
         # process errors ASAP.
+        #
+        # Probes (pings, arpings) of all monitors due for an update are first
+        # gathered and run concurrently under one deadline, so that dead peers
+        # delay the round by at most the deadline.  Monitors without probes
+        # (e.g. process check) are updated right away, the rest after the
+        # probes have run.
 
-        for m in self._monitored_things:
+        def _finish(m):
             got_exception = False
             rv = None
             try:
-                rv = m.check_monitor()
+                rv = m.finish_check()
             except:
                 got_exception = True
                 _log.exception('checking excepted for %s' % m.name)
@@ -2045,9 +2246,7 @@ class L2tpRunner(L2tpRunnerBase):
             if got_exception:
                 failure.append(m.name)
                 _log.debug('check failed (exception) for %s' % m.name)
-            elif rv is None:
-                nocheck.append(m.name)
-                _log.debug('no check for %s' % m.name)
+                rv = False
             elif rv is True:
                 success.append(m.name)
                 _log.debug('check ok for %s' % m.name)
@@ -2055,8 +2254,45 @@ class L2tpRunner(L2tpRunnerBase):
                 failure.append(m.name)
                 _log.debug('check failed for %s' % m.name)
             else:
-                raise Exception('invalid rv: %s' % rv)
+                _log.error('invalid rv for %s: %s' % (m.name, rv))
+                failure.append(m.name)
+                rv = False
+
+            try:
+                m.publish_status(rv)
+            except:
+                _log.exception('failed to publish monitor status for %s' % m.name)
+
+        probes = ProbeBatch()
+        checked = []
+        waiting = []
+        for m in self._monitored_things:
+            try:
+                if not m.start_check(probes):
+                    nocheck.append(m.name)
+                    _log.debug('no check for %s' % m.name)
+                    continue
+            except:
                 failure.append(m.name)
+                _log.exception('checking excepted for %s' % m.name)
+                try:
+                    m.publish_status(False)
+                except:
+                    _log.exception('failed to publish monitor status for %s' % m.name)
+                continue
+
+            checked.append(m)
+            if m.has_probes():
+                waiting.append(m)
+            else:
+                _finish(m)
+
+        probes.run()
+
+        for m in waiting:
+            _finish(m)
+
+        _log.info('monitor latencies: %s' % ', '.join(['%s=%.1fs' % (m.name, m.last_latency) for m in checked if m.last_latency is not None]))
 
         #
         #  Router monitor watchdog check: if no successful arping
@@ -0,0 +1,130 @@
+from twisted.trial import unittest
+
+from codebay.l2tpserver import fwmanager
+
+_setup_script = """\
+*raw
+:ppp_prert_ppp0 -
+-A raw_prerouting_ppp -i ppp0 -j ppp_prert_ppp0
+-A ppp_prert_ppp0 -j ACCEPT
+COMMIT
+*filter
+:ppp_input_ppp0 -
+:ppp_forward_ppp0 -
+-A filter_input_ppp -i ppp0 -j ppp_input_ppp0
+-A filter_forward_ppp -i ppp0 -j ppp_forward_ppp0
+-A filter_forward_ppp -o ppp0 -j ppp_forward_ppp0
+-A ppp_input_ppp0 -j ACCEPT
+COMMIT
+"""
+
+# iptables-save output after _setup_script has been restored directly
+_saved_rules = """\
+*raw
+:PREROUTING ACCEPT [0:0]
+:raw_prerouting_ppp - [0:0]
+:ppp_prert_ppp0 - [0:0]
+-A PREROUTING -j raw_prerouting_ppp
+-A raw_prerouting_ppp -i ppp0 -j ppp_prert_ppp0
+-A ppp_prert_ppp0 -j ACCEPT
+COMMIT
+*filter
+:INPUT ACCEPT [0:0]
+:filter_input_ppp - [0:0]
+:filter_forward_ppp - [0:0]
+:ppp_input_ppp0 - [0:0]
+:ppp_forward_ppp0 - [0:0]
+-A INPUT -j filter_input_ppp
+-A filter_input_ppp -i ppp0 -j ppp_input_ppp0
+-A filter_forward_ppp -i ppp0 -j ppp_forward_ppp0
+-A filter_forward_ppp -o ppp0 -j ppp_forward_ppp0
+-A ppp_input_ppp0 -j ACCEPT
+COMMIT
+"""
+
+class _FakeConnection:
+    def __init__(self):
+        self.replies = []
+
+    def fileno(self):
+        return -1
+
+    def setblocking(self, flag):
+        pass
+
+    def settimeout(self, timeout):
+        pass
+
+    def sendall(self, data):
+        self.replies.append(data)
+
+    def close(self):
+        pass
+
+class TestFirewallManager(unittest.TestCase):
+    def setUp(self):
+        self.saved = ''
+        self.save_fails = False
+        self.restored = []
+        self._orig = (fwmanager.run_command,
+                      fwmanager.helpers.acquire_iptables_lock,
+                      fwmanager.helpers.release_iptables_lock)
+        fwmanager.run_command = self._run_command
+        fwmanager.helpers.acquire_iptables_lock = lambda: None
+        fwmanager.helpers.release_iptables_lock = lambda lock: None
+        self.manager = fwmanager.FirewallManager()
+
+    def tearDown(self):
+        (fwmanager.run_command,
+         fwmanager.helpers.acquire_iptables_lock,
+         fwmanager.helpers.release_iptables_lock) = self._orig
+
+    def _run_command(self, cmd, stdin=None, retval=None):
+        if cmd[0] == fwmanager.constants.CMD_IPTABLES_SAVE:
+            if self.save_fails:
+                raise Exception('iptables-save failed')
+            return 0, self.saved, ''
+        self.restored.append(stdin)
+        return 0, '', ''
+
+    def _request(self, message):
+        req = fwmanager._Request(_FakeConnection())
+        req.data = message
+        req.parse()
+        self.manager.pending.append(req)
+        self.manager._process_batch()
+        return req.conn.replies
+
+    def test_setup_and_teardown(self):
+        self.failUnlessEqual(self._request('setup ppp0\n' + _setup_script), ['ok\n'])
+        self.failUnlessEqual(self._request('teardown ppp0\n'), ['ok\n'])
+        self.failUnless('-D raw_prerouting_ppp -i ppp0 -j ppp_prert_ppp0' in self.restored[-1])
+        self.failUnless('-X ppp_forward_ppp0' in self.restored[-1])
+        self.failIf(self.manager.devices.has_key('ppp0'))
+
+    def test_teardown_after_direct_setup(self):
+        # setup fell back to a direct iptables-restore, the manager never
+        # heard of the device
+        self.saved = _saved_rules
+        self.failUnlessEqual(self._request('teardown ppp0\n'), ['ok\n'])
+        self.failUnlessEqual(len(self.restored), 1)
+        for line in ['-D raw_prerouting_ppp -i ppp0 -j ppp_prert_ppp0',
+                     '-D filter_input_ppp -i ppp0 -j ppp_input_ppp0',
+                     '-D filter_forward_ppp -i ppp0 -j ppp_forward_ppp0',
+                     '-D filter_forward_ppp -o ppp0 -j ppp_forward_ppp0',
+                     '-X ppp_prert_ppp0',
+                     '-X ppp_input_ppp0',
+                     '-X ppp_forward_ppp0']:
+            self.failUnless(line in self.restored[0].split('\n'), line)
+        self.failIf(self.manager.devices.has_key('ppp0'))
+
+    def test_teardown_resync_failure(self):
+        # the client must remove the rules directly if the manager cannot
+        # tell whether there are any
+        self.saved = _saved_rules
+        self.save_fails = True
+        replies = self._request('teardown ppp0\n')
+        self.failUnlessEqual(len(replies), 1)
+        self.failUnless(replies[0].startswith('error'))
+        self.failUnlessRaises(fwmanager.FirewallManagerError, fwmanager._check_reply, replies[0])
+        self.failUnlessEqual(self.restored, [])
@@ -10,6 +10,7 @@ from codebay.common import rdf
 from codebay.common import logger
 from codebay.common import datatypes
 from codebay.l2tpserver.webui import commonpage
+from codebay.l2tpserver.webui import dnscache
 from codebay.l2tpserver.rdfconfig import ns, ns_ui
 from codebay.l2tpserver import db
 from codebay.l2tpserver import helpers
@@ -37,6 +38,12 @@ class DumpStatusPage(commonpage.AdminPage):
         rd = rdfdumper.RdfDumper()
         return rd.dump_resource(db.get_db().getRoot().getS(ns.l2tpDeviceStatus))
 
+    def render_dnscache(self, ctx, data):
+        st = dnscache.get_dns_cache().get_statistics()
+        keys = st.keys()
+        keys.sort()
+        return '\n'.join(['%s: %s' % (k, st[k]) for k in keys])
+
 class DumpUiConfigPage(commonpage.AdminPage):
     template = 'admin/dumpuiconfig.xhtml'
     pagetitle = 'Web UI Configuration Dump'
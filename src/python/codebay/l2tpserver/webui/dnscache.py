@@ -0,0 +1,236 @@
+"""Caching DNS lookups for the web UI.
+
+Device detail pages reverse resolve connection addresses and the dynamic
+DNS status resolves the configured hostname.  Without a cache every page
+load sends fresh queries, and browsing connection history against a slow
+resolver causes a burst of identical queries.
+
+Results are cached for the TTL of the answer records, clamped to
+configured limits.  Nonexistent names are cached for the negative TTL of
+the SOA record in the response (RFC 2308), and other failures (e.g.
+timeouts) for a short fixed time.  Concurrent lookups of the same name
+share one query.  The cache is bounded; least recently used names are
+evicted first.
+"""
+__docformat__ = 'epytext en'
+
+import time
+
+from twisted.internet import defer
+from twisted.internet import error as ierror
+from twisted.python import failure
+from twisted.names import client, dns
+from twisted.names import error as nerror
+
+from codebay.common import logger
+from codebay.common import datatypes
+from codebay.l2tpserver import constants
+
+_log = logger.get('l2tpserver.webui.dnscache')
+
+class _CacheEntry:
+    def __init__(self, created, expires, value=None, failure=None):
+        self.created = created
+        self.expires = expires
+        self.value = value
+        self.failure = failure
+        self.last_used = 0
+
+    def is_valid(self, now):
+        # also catches clock going backwards
+        return (now >= self.created) and (now < self.expires)
+
+class DnsCache:
+    """TTL cache with in-flight coalescing for forward and reverse lookups."""
+
+    def __init__(self, size=None, min_ttl=None, max_ttl=None, negative_ttl=None, error_ttl=None):
+        if size is None:
+            size = constants.WEBUI_DNS_CACHE_SIZE
+        if min_ttl is None:
+            min_ttl = constants.WEBUI_DNS_CACHE_MIN_TTL
+        if max_ttl is None:
+            max_ttl = constants.WEBUI_DNS_CACHE_MAX_TTL
+        if negative_ttl is None:
+            negative_ttl = constants.WEBUI_DNS_CACHE_NEGATIVE_TTL
+        if error_ttl is None:
+            error_ttl = constants.WEBUI_DNS_CACHE_ERROR_TTL
+        self.size = size
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.error_ttl = error_ttl
+
+        self._resolver = None
+        self._entries = {}     # (query type, name) -> _CacheEntry
+        self._waiting = {}     # (query type, name) -> list of Deferreds waiting for the query
+        self._use_counter = 0
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    # XXX: do we need to reinstantiate the resolver when e.g. /etc/resolv.conf changes?
+    def _get_resolver(self):
+        if self._resolver is None:
+            self._resolver = client.createResolver()   # XXX: parameters here, e.g. timeout?
+        return self._resolver
+
+    # ----------------------------------------------------------------------
+
+    def lookup_address(self, hostname):
+        """Resolve hostname; returns a Deferred firing with a L{datatypes.IPv4Address}."""
+
+        def _parse((ans, auth, add)):
+            for a in ans + auth + add:
+                if a.type == dns.A:
+                    t = a.payload.address
+                    ipstr = '%d.%d.%d.%d' % (ord(t[0]), ord(t[1]), ord(t[2]), ord(t[3]))
+                    return datatypes.IPv4Address.fromString(ipstr), a.ttl
+            return None, None
+
+        return self._lookup(dns.A, hostname, self._get_resolver().lookupAddress, _parse)
+
+    def lookup_reverse(self, addr):
+        """Reverse resolve an IPv4 address; returns a Deferred firing with a hostname."""
+
+        # ensure we get an IPv4Address
+        if isinstance(addr, (str, unicode)):
+            addr = datatypes.IPv4Address.fromString(str(addr))
+        t = addr.toIntegerList()
+        name = '%d.%d.%d.%d.in-addr.arpa' % (t[3], t[2], t[1], t[0])
+
+        def _parse((ans, auth, add)):
+            for a in ans + auth + add:
+                if a.type == dns.PTR and a.name.name == name:
+                    return a.payload.name.name, a.ttl
+            return None, None
+
+        return self._lookup(dns.PTR, name, self._get_resolver().lookupPointer, _parse)
+
+    # ----------------------------------------------------------------------
+
+    def _lookup(self, qtype, name, query, parse):
+        key = (qtype, name)
+        now = time.time()
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.is_valid(now):
+                self._use_counter += 1
+                entry.last_used = self._use_counter
+                if entry.failure is not None:
+                    self.negative_hits += 1
+                    return defer.fail(entry.failure)
+                self.hits += 1
+                return defer.succeed(entry.value)
+            del self._entries[key]
+
+        d = defer.Deferred()
+        if self._waiting.has_key(key):
+            self.coalesced += 1
+            self._waiting[key].append(d)
+            return d
+
+        self.misses += 1
+        self._waiting[key] = [d]
+
+        def _success(res):
+            value, ttl = parse(res)
+            if value is None:
+                # no data for the name: negative answer
+                ans, auth, add = res
+                return self._store(key, None, self._get_negative_ttl(auth), ierror.DNSLookupError(name))
+            return self._store(key, value, self._clamp_ttl(ttl), None)
+
+        def _failed(reason):
+            _log.info('dns lookup failed for %s: %s' % (name, reason.getErrorMessage()))
+            if reason.check(nerror.DNSNameError):
+                auth = []
+                msg = None
+                if len(reason.value.args) > 0:
+                    msg = reason.value.args[0]
+                if isinstance(msg, dns.Message):
+                    auth = msg.authority
+                return self._store(key, None, self._get_negative_ttl(auth), nerror.DNSNameError(name))
+            return self._store(key, None, self.error_ttl, ierror.DNSLookupError(name))
+
+        def _done(entry):
+            waiting = self._waiting[key]
+            del self._waiting[key]
+            for w in waiting:
+                if entry.failure is not None:
+                    w.errback(entry.failure)
+                else:
+                    w.callback(entry.value)
+
+        q = defer.maybeDeferred(query, name)
+        q.addCallbacks(_success, _failed)
+        q.addErrback(lambda reason: self._store(key, None, self.error_ttl, ierror.DNSLookupError(name)))
+        q.addCallback(_done)
+        q.addErrback(lambda reason: _log.error('dns cache internal error: %s' % reason))
+        return d
+
+    def _clamp_ttl(self, ttl):
+        if ttl is None:
+            ttl = self.min_ttl
+        return max(self.min_ttl, min(self.max_ttl, ttl))
+
+    def _get_negative_ttl(self, auth):
+        for a in auth:
+            if a.type == dns.SOA:
+                return max(0, min(self.negative_ttl, a.ttl, a.payload.minimum))
+        return self.negative_ttl
+
+    def _store(self, key, value, ttl, exc):
+        now = time.time()
+        f = None
+        if exc is not None:
+            f = failure.Failure(exc)
+        entry = _CacheEntry(now, now + ttl, value=value, failure=f)
+        self._use_counter += 1
+        entry.last_used = self._use_counter
+        self._entries[key] = entry
+        if len(self._entries) > self.size:
+            self._evict()
+        return entry
+
+    def _evict(self):
+        # evict expired entries, then least recently used ones; evict a bit
+        # more than necessary so that eviction cost is amortized
+        now = time.time()
+        for key, entry in self._entries.items():
+            if not entry.is_valid(now):
+                del self._entries[key]
+                self.evictions += 1
+        excess = len(self._entries) - (self.size - self.size / 10)
+        if excess <= 0:
+            return
+        t = [(entry.last_used, key) for key, entry in self._entries.iteritems()]
+        t.sort()
+        for last_used, key in t[:excess]:
+            del self._entries[key]
+            self.evictions += 1
+
+    # ----------------------------------------------------------------------
+
+    def clear(self):
+        self._entries = {}
+
+    def get_statistics(self):
+        return { 'entries': len(self._entries),
+                 'in_flight': len(self._waiting),
+                 'hits': self.hits,
+                 'negative_hits': self.negative_hits,
+                 'misses': self.misses,
+                 'coalesced': self.coalesced,
+                 'evictions': self.evictions }
+
+_global_dns_cache = None
+
+def get_dns_cache():
+    global _global_dns_cache
+    if _global_dns_cache is None:
+        _global_dns_cache = DnsCache()
+    return _global_dns_cache
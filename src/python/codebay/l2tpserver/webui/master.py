@@ -46,8 +46,8 @@ _log = logger.get('l2tpserver.webui.master')
 
 #
 #  XXX: the current Ajax approach is two-fold: one part (AjaxUpdateHelper)
-#  tracks waiting Ajax requests and polls system status, waking the waiters
-#  if necessary.  The second part (Ajax request handlers) will render the
+#  tracks waiting Ajax requests and watches for system status changes, waking
+#  the waiters if necessary.  The second part (Ajax request handlers) will render the
 #  response when woken up.  There is no information sharing between the two;
 #  it would be simpler if the poll check information would be made available
 #  to the Ajax waiters, eliminating redundant re-reading of status data.
@@ -56,19 +56,39 @@ _log = logger.get('l2tpserver.webui.master')
 # --------------------------------------------------------------------------
 
 class AjaxUpdateHelper:
-    """Helper class for managing Ajax waiters and status polling."""
+    """Helper class for managing Ajax waiters and status change detection.
+
+    While there are waiters, the RDF database change generation is checked
+    frequently (see L{rdf.BaseModel.getChangesSince}); this is cheap and
+    needs no transaction.  Status values are re-evaluated only when a
+    relevant subject has changed, when L{status_may_have_changed} is called,
+    or every poll_interval seconds for values which do not live in RDF.
+    Bursts of changes are coalesced into one evaluation.  Waiters are woken
+    only if the status values actually differ.
+    """
 
-    poll_interval = 5
+    poll_interval = 60                  # full evaluation, minute clock in status values
+    untracked_poll_interval = 5         # full evaluation if database does not track changes
+    change_check_interval = 0.5
+    coalesce_delay = 0.2
 
     def __init__(self, master):
         self.master = master
         self._status_waiters = []
         self._status_poll_call = None
         self._status_last_poll_status_values = None
+        self._change_check_call = None
+        self._evaluate_call = None
+        self._generation = None
+        self._relevant_subjects = None  # None = all subjects relevant
+        self._change_tracking = True
 
     def add_status_change_waiter(self, d):
         self._status_waiters.append(d)
+        if self._status_last_poll_status_values is None:
+            self.status_may_have_changed()
         self._reschedule_status_poll()
+        self._reschedule_change_check()
 
     def have_status_change_waiters(self):
         return len(self._status_waiters) > 0
@@ -84,10 +104,23 @@ class AjaxUpdateHelper:
         The format here does not really matter, as long as it can be compared.
         """
         return []
-    
+
+    def get_relevant_subjects(self):
+        """Get the set of RDF subjects whose changes may affect status values.
+
+        Called in the same transaction as L{get_status_values}.  Returning
+        None means that any change is relevant.
+        """
+        return None
+
+    def status_may_have_changed(self):
+        """Schedule a (coalesced) status evaluation, e.g. after a non-RDF status change."""
+        if self._evaluate_call is None:
+            self._evaluate_call = reactor.callLater(self.coalesce_delay, self._status_evaluate)
+
     @db.transact()  # reactor callLater
-    def _status_poll_timer(self):
-        self._status_poll_call = None
+    def _status_evaluate(self):
+        self._evaluate_call = None
         wakeup = False
 
         # Wake up if some status element has changed
@@ -98,9 +131,18 @@ class AjaxUpdateHelper:
             wakeup = True
         self._status_last_poll_status_values = curr_values
 
+        try:
+            self._relevant_subjects = self.get_relevant_subjects()
+        except:
+            _log.exception('cannot determine relevant subjects, all changes considered relevant')
+            self._relevant_subjects = None
+
         if wakeup:
             self.wake_status_change_waiters()
 
+    def _status_poll_timer(self):
+        self._status_poll_call = None
+        self.status_may_have_changed()
         self._reschedule_status_poll()
         
     def _reschedule_status_poll(self):
@@ -113,7 +155,10 @@ class AjaxUpdateHelper:
         if len(self._status_waiters) > 0:
             # schedule to next N seconds
             now = datetime.datetime.utcnow()
-            interval = self.poll_interval
+            if self._change_tracking:
+                interval = self.poll_interval
+            else:
+                interval = self.untracked_poll_interval
             secs_now = int(now.second)
             secs_next = ((secs_now + interval) / interval * interval) + 1   # round up to next full interval, add leeway
             delay = float(secs_next - secs_now)
@@ -123,6 +168,44 @@ class AjaxUpdateHelper:
             self._status_poll_call = reactor.callLater(delay, self._status_poll_timer)
         else:
             _log.debug('no waiters, not scheduling status poll')
+
+    def _change_check_timer(self):
+        self._change_check_call = None
+
+        try:
+            generation, changed = db.get_db().getModel().getChangesSince(self._generation)
+        except:
+            # transient (e.g. database busy), try again later
+            _log.exception('database change check failed')
+            self._reschedule_change_check()
+            return
+
+        if generation is None:
+            # not tracked, fall back to polling
+            if self._change_tracking:
+                _log.info('database does not track changes, polling status every %d seconds' % self.untracked_poll_interval)
+                self._change_tracking = False
+                self._reschedule_status_poll()
+            return
+
+        if generation != self._generation:
+            if (changed is None) or (self._relevant_subjects is None):
+                self.status_may_have_changed()
+            else:
+                for sub in changed:
+                    if sub in self._relevant_subjects:
+                        _log.debug('relevant subject %s changed, evaluating status' % sub)
+                        self.status_may_have_changed()
+                        break
+            self._generation = generation
+
+        self._reschedule_change_check()
+
+    def _reschedule_change_check(self):
+        if (not self._change_tracking) or (self._change_check_call is not None):
+            return
+        if len(self._status_waiters) > 0:
+            self._change_check_call = reactor.callLater(self.change_check_interval, self._change_check_timer)
             
     def wake_status_change_waiters(self):
         _log.debug('wake_status_change_waiters()')
@@ -234,6 +317,17 @@ class AjaxUpdateHelperGlobalStatus(AjaxUpdateHelper):
         res = _get_license_info() + _get_health_info() + _get_hardware_info() + _get_datetime_info() + _get_dyndns_info()
         _log.debug('status poll result: %s' % res)
         return res
+
+    def get_relevant_subjects(self):
+        # Everything the status values are computed from lives below these
+        # roots (PPP devices and server statuses below status, license
+        # limits below license info); a change anywhere else cannot change
+        # them.  The database root is included to catch replaced subtrees.
+        model = db.get_db().getModel()
+        res = set([db.get_db().getRoot().node])
+        for root in [helpers.get_status(), helpers.get_global_status(), helpers.get_license_info()]:
+            res.update(model.getReachableNodes(root))
+        return res
                 
 # --------------------------------------------------------------------------
 
@@ -507,12 +601,14 @@ class WebUiMaster(CommonMaster):
                         _log.info('dyndns lookup successful, %s -> %s' % (hostname, res.toString()))
                         self._dyndns_address = res.toString()
                         self._dyndns_address_timestamp = datetime.datetime.utcnow()
+                        self._ajax_helper.status_may_have_changed()
 
                     # NB: not inside transact
                     def _failed(reason):
                         _log.info('dyndns lookup failed, reason: %s' % reason)
                         self._dyndns_address = 'ERROR'
                         self._dyndns_address_timestamp = datetime.datetime.utcnow()
+                        self._ajax_helper.status_may_have_changed()
 
                     # NB: not inside transact
                     def _clear_marker(res):
@@ -1071,6 +1167,9 @@ class WebUiMaster(CommonMaster):
         return self._ajax_helper.add_status_change_waiter(d)
 
     # XXX: change name to "public", used by watchdog
+    # untransact: callers are transactional, but the export takes its own
+    # short snapshot transaction and streams the output outside it
+    @db.untransact()
     def _export_rdf_database(self):
         _log.info('_export_rdf_database() called')
 
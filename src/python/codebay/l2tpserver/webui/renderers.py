@@ -11,7 +11,7 @@ later to make better use of the Nevow data/render split.
 """
 __docformat__ = 'epytext en'
 
-import os, time, datetime, textwrap, re
+import os, time, datetime, textwrap, re, urllib
 
 from nevow import inevow, url, tags as T
 
@@ -28,6 +28,7 @@ from codebay.l2tpserver import db
 from codebay.l2tpserver.webui import l2tpmanager
 from codebay.l2tpserver.webui import uihelpers
 from codebay.l2tpserver.webui import doclibrary
+from codebay.l2tpserver.webui import statusquery
 
 _log = logger.get('l2tpserver.webui.renderers')
 
@@ -386,10 +387,7 @@ class StatusRenderers:
 
                     ppp_dev = None
                     try:
-                        if is_client:
-                            ppp_dev = helpers.find_ppp_device_status_sitetosite_client(username)
-                        else:
-                            ppp_dev = helpers.find_ppp_device_status_sitetosite_server(username)
+                        ppp_dev = helpers.find_ppp_device_status_sitetosite(username, is_client)
                     except:
                         _log.exception('getting ppp_dev failed')
 
@@ -557,11 +555,57 @@ class StatusRenderers:
         #res['\n', T.raw(jscode), '\n']
         return res
     
+    def _get_ppp_devices_query_args(self, ctx):
+        """Parse status list paging and filter arguments from request.
+
+        Returns a dict with keys 'page', 'user', 'type', 'since' and 'until';
+        missing or invalid arguments are None ('page' defaults to 0).
+        """
+        res = {'page': 0, 'user': None, 'type': None, 'since': None, 'until': None}
+        request = inevow.IRequest(ctx)
+
+        def _arg(name):
+            if request.args.has_key(name) and (request.args[name][0].strip() != ''):
+                return request.args[name][0].strip()
+            return None
+
+        try:
+            if _arg('page') is not None:
+                res['page'] = max(0, int(_arg('page')))
+        except ValueError:
+            pass
+        res['user'] = _arg('user')
+        if _arg('type') in [statusquery.TYPE_NORMAL_USER, statusquery.TYPE_SITE_TO_SITE_CLIENT, statusquery.TYPE_SITE_TO_SITE_SERVER]:
+            res['type'] = _arg('type')
+        for name, extra in [('since', datetime.timedelta(0)), ('until', datetime.timedelta(1))]:
+            try:
+                if _arg(name) is not None:
+                    # day resolution, 'until' includes the whole day
+                    # XXX: dates are compared against UTC timestamps
+                    res[name] = datetime.datetime(*time.strptime(_arg(name), '%Y-%m-%d')[:3]) + extra
+            except ValueError:
+                pass
+        return res
+
+    def _ppp_devices_query_uri(self, args, **kw):
+        t = []
+        for name in ['user', 'type', 'since', 'until', 'page', 'deviceuuid']:
+            if kw.has_key(name):
+                v = kw[name]
+            else:
+                v = args.get(name)
+            if v is None:
+                continue
+            if name in ['since', 'until']:
+                if name == 'until':
+                    v = v - datetime.timedelta(1)
+                v = v.strftime('%Y-%m-%d')
+            t.append((name, str(v)))
+        return '?' + urllib.urlencode(t)
+
     # XXX: the sort parameterization here is not particularly good
     @saferender()
     def render_ppp_devices_helper(self, ctx, data, include_normal_users, include_sitetosites, include_active, include_retired, sort_by_starttime, sort_by_activity):
-        st_root = helpers.get_status()
-        global_st_root = helpers.get_global_status()
         now = datetime.datetime.utcnow()
 
         username_label = 'Username'
@@ -571,58 +615,44 @@ class StatusRenderers:
             no_connections_label = 'No site-to-site connections'
 
         # filter interesting users
-        users = []
-        devsets = []
-        
-        if st_root.hasS(ns.pppDevices) and include_active:
-            devsets.append(helpers.get_ppp_devices())
-        if global_st_root.hasS(ns.retiredPppDevices) and include_retired:
-            devsets.append(helpers.get_retired_ppp_devices())
-        for devset in devsets:
-            for d in devset:
-                # render restricted connections too
-
-                # XXX: we'd like to ignore inactive devices, but this wasn't reliable enough
-                #if not d.getS(ns.deviceActive, rdf.Boolean):
-                #    continue
-
-                t = d.getS(ns.connectionType)
-                if t.hasType(ns.NormalUser) and include_normal_users:
-                    users.append(d)
-                elif t.hasType(ns.SiteToSiteClient) and include_sitetosites:
-                    users.append(d)
-                elif t.hasType(ns.SiteToSiteServer) and include_sitetosites:
-                    users.append(d)
-
-        # sorting
-        def _cmp_activity_and_time(a, b):
-            # active first, sorted by start time; then closed connections, sorted by close time
-            a_closed = a.hasS(ns.stopTime)
-            b_closed = b.hasS(ns.stopTime)
-            if a_closed:
-                a_time = a.getS(ns.stopTime, rdf.Datetime)
-            else:
-                a_time = a.getS(ns.startTime, rdf.Datetime)
-            if b_closed:
-                b_time = b.getS(ns.stopTime, rdf.Datetime)
-            else:
-                b_time = b.getS(ns.startTime, rdf.Datetime)
-            # NB: order of times so that larger times (more recent timestamps) appear first
-            return cmp([a_closed, b_time],
-                       [b_closed, a_time])
-        def _cmp_username_starttime(a, b):
-            # NB: we want highest starttime (latest connection) at the top, hence order of a&b below
-            return cmp([a.getS(ns.username, rdf.String), b.getS(ns.startTime, rdf.Datetime)],
-                       [b.getS(ns.username, rdf.String), a.getS(ns.startTime, rdf.Datetime)])
-        def _cmp_starttime_username(a, b):
-            return cmp([b.getS(ns.startTime, rdf.Datetime), a.getS(ns.username, rdf.String)],
-                       [a.getS(ns.startTime, rdf.Datetime), b.getS(ns.username, rdf.String)])
+        types = []
+        if include_normal_users:
+            types.append(statusquery.TYPE_NORMAL_USER)
+        if include_sitetosites:
+            types += [statusquery.TYPE_SITE_TO_SITE_CLIENT, statusquery.TYPE_SITE_TO_SITE_SERVER]
+        args = self._get_ppp_devices_query_args(ctx)
+        if (args['type'] is not None) and (args['type'] in types):
+            types = [args['type']]
+
         if sort_by_activity:
-            users.sort(cmp=_cmp_activity_and_time)
+            sort = statusquery.SORT_ACTIVITY
         elif sort_by_starttime:
-            users.sort(cmp=_cmp_starttime_username)
+            sort = statusquery.SORT_STARTTIME
         else:
-            users.sort(cmp=_cmp_username_starttime)
+            sort = statusquery.SORT_USERNAME
+
+        page_size = constants.WEBUI_STATUS_PAGE_SIZE
+        res = statusquery.query_ppp_devices(types,
+                                            include_active=include_active,
+                                            include_retired=include_retired,
+                                            sort=sort,
+                                            username=args['user'],
+                                            since=args['since'],
+                                            until=args['until'],
+                                            offset=args['page'] * page_size,
+                                            limit=page_size)
+        if (len(res.rows) == 0) and (res.total > 0):
+            # page out of range, e.g. after history was pruned
+            args['page'] = res.get_page_count() - 1
+            res = statusquery.query_ppp_devices(types,
+                                                include_active=include_active,
+                                                include_retired=include_retired,
+                                                sort=sort,
+                                                username=args['user'],
+                                                since=args['since'],
+                                                until=args['until'],
+                                                offset=args['page'] * page_size,
+                                                limit=page_size)
 
         # render table
         table = T.table(border="0", cellpadding="0", cellspacing="0")
@@ -631,48 +661,70 @@ class StatusRenderers:
                    T.th["Notes"],
                    T.th["Details"]]]
 
-        # render active users
-        for d in users:
-            notes = []
-            if d.hasS(ns.ipsecPskIndex) and (d.getS(ns.ipsecPskIndex, rdf.Integer) != 0):
-                notes.append('secondary pre-shared key')
-            if d.getS(ns.ipsecEncapsulationMode).hasType(ns.EspPlain):
-                notes.append('no NAT-T support')
-            if d.getS(ns.restrictedConnection, rdf.Boolean):
-                notes.append('restricted by license')  # XXX: other reasons later too
-
+        # render users
+        for d in res.rows:
             age_str = ''
-            if d.hasS(ns.stopTime):
+            if d.is_closed():
                 stop_str = ''
                 try:
-                    stop_str = ' (%s)' % uihelpers.render_datetime(d.getS(ns.stopTime, rdf.Datetime), show_seconds=False, show_timezone=False)
+                    stop_str = ' (%s)' % uihelpers.render_datetime(d.stop_time, show_seconds=False, show_timezone=False)
                 except:
                     _log.exception('cannot render stopTime')
                 age_str = 'Closed' + stop_str
             else:
-                age = now - d.getS(ns.startTime, rdf.Datetime)
+                age = now - d.start_time
                 if age < datetime.timedelta(0, 0, 0):
                     # should not happen too much, but we don't want negative times
                     age = datetime.timedelta(0, 0, 0)
                 age_str = uihelpers.render_timedelta(age)
 
-            detaillink = '?deviceuuid=' + str(d.getUri())
+            detaillink = self._ppp_devices_query_uri(args, deviceuuid=d.uri)
 
             notes_stan = T.invisible()
-            for i, n in enumerate(notes):
+            for i, n in enumerate(d.notes):
                 if i > 0:
                     notes_stan[T.br()]
                 notes_stan[_capitalize_first(n)]
 
-            table[T.tr[T.td[d.getS(ns.username, rdf.String)],
+            table[T.tr[T.td[d.username],
                        T.td[age_str],
                        T.td[notes_stan],
                        T.td[T.a(href=detaillink)[u'Details\u00a0\u2192']]]]  # nbsp, rarr
 
-        if len(users) == 0:
+        if res.total == 0:
             table[T.tr[T.td(colspan=4)[no_connections_label]]]
-            
-        return table
+
+        if not include_retired:
+            if res.get_page_count() <= 1:
+                return table
+            filter_form = ''
+        else:
+            def _date(name):
+                if args[name] is None:
+                    return ''
+                if name == 'until':
+                    return (args[name] - datetime.timedelta(1)).strftime('%Y-%m-%d')
+                return args[name].strftime('%Y-%m-%d')
+
+            filter_form = T.form(method='get', action='')[username_label, ': ',
+                                                         T.input(type='text', name='user', value=args['user'] or ''),
+                                                         ' From (YYYY-MM-DD): ',
+                                                         T.input(type='text', name='since', value=_date('since')),
+                                                         ' To: ',
+                                                         T.input(type='text', name='until', value=_date('until')),
+                                                         ' ',
+                                                         T.input(type='submit', value='Filter')]
+
+        # pagination
+        pager = T.invisible()
+        page, page_count = res.get_page(), res.get_page_count()
+        if page > 0:
+            pager[T.a(href=self._ppp_devices_query_uri(args, page=page - 1, deviceuuid=None))[u'\u2190\u00a0Previous'], ' ']
+        pager['Page %d of %d (%d connections)' % (page + 1, page_count, res.total)]
+        if page + 1 < page_count:
+            pager[' ', T.a(href=self._ppp_devices_query_uri(args, page=page + 1, deviceuuid=None))[u'Next\u00a0\u2192']]
+
+        return T.invisible[filter_form, table, T.p[pager]]
     
     def render_userlist(self, ctx, data):
         return self.render_ppp_devices_helper(ctx, data,
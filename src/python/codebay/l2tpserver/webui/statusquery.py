@@ -0,0 +1,262 @@
+"""Query layer for PPP device (user and site-to-site connection) status lists.
+
+Status lists used to be built by sorting RDF nodes with comparison
+functions which read RDF properties on every comparison, and rendered as
+one table.  Here each device is read once into a L{DeviceRow} with plain
+Python values; sorting uses precomputed key tuples, and filtering and
+pagination are done before rendering.
+
+Retired devices (connection history) do not change after retirement, so
+their rows are kept in a L{RetiredDeviceIndex}, ordered by stop time.  The
+index is refreshed incrementally using the RDF change log: only devices
+added to (or changed in) the retired device set since the previous query
+are read from RDF.  Its size follows the retention of the retired device
+set, see L{helpers.prune_retired_ppp_devices}.
+"""
+__docformat__ = 'epytext en'
+
+import bisect, datetime
+
+from codebay.common import rdf
+from codebay.common import logger
+from codebay.l2tpserver import helpers
+from codebay.l2tpserver import db
+from codebay.l2tpserver.rdfconfig import ns
+
+_log = logger.get('l2tpserver.webui.statusquery')
+
+TYPE_NORMAL_USER = 'user'
+TYPE_SITE_TO_SITE_CLIENT = 's2s-client'
+TYPE_SITE_TO_SITE_SERVER = 's2s-server'
+
+SORT_USERNAME = 'username'    # username, then latest connection first
+SORT_STARTTIME = 'starttime'  # latest connection first, then username
+SORT_ACTIVITY = 'activity'    # active connections first (latest first), then closed ones (latest first)
+
+_epoch = datetime.datetime(1970, 1, 1)
+
+def _timestamp(dt):
+    if dt is None:
+        return None
+    td = dt - _epoch
+    return td.days * 86400.0 + td.seconds + td.microseconds / 1000000.0
+
+class DeviceRow:
+    """Plain values of one PPP device, read once from RDF."""
+
+    def __init__(self, dev):
+        self.uri = str(dev.getUri())
+        self.username = dev.getS(ns.username, rdf.String)
+
+        t = dev.getS(ns.connectionType)
+        if t.hasType(ns.NormalUser):
+            self.connection_type = TYPE_NORMAL_USER
+        elif t.hasType(ns.SiteToSiteClient):
+            self.connection_type = TYPE_SITE_TO_SITE_CLIENT
+        elif t.hasType(ns.SiteToSiteServer):
+            self.connection_type = TYPE_SITE_TO_SITE_SERVER
+        else:
+            self.connection_type = None
+
+        self.start_time = dev.getS(ns.startTime, rdf.Datetime)
+        self.stop_time = None
+        if dev.hasS(ns.stopTime):
+            self.stop_time = dev.getS(ns.stopTime, rdf.Datetime)
+        self.start_ts = _timestamp(self.start_time)
+        self.stop_ts = _timestamp(self.stop_time)
+
+        self.notes = []
+        if dev.hasS(ns.ipsecPskIndex) and (dev.getS(ns.ipsecPskIndex, rdf.Integer) != 0):
+            self.notes.append('secondary pre-shared key')
+        if dev.getS(ns.ipsecEncapsulationMode).hasType(ns.EspPlain):
+            self.notes.append('no NAT-T support')
+        if dev.getS(ns.restrictedConnection, rdf.Boolean):
+            self.notes.append('restricted by license')  # XXX: other reasons later too
+
+    def is_closed(self):
+        return self.stop_time is not None
+
+    def overlaps(self, since, until):
+        """Return True if the connection was up at some point in [since, until]; None means open."""
+        if (until is not None) and (self.start_ts > until):
+            return False
+        if (since is not None) and (self.stop_ts is not None) and (self.stop_ts < since):
+            return False
+        return True
+
+    def sort_key(self, sort):
+        if sort == SORT_ACTIVITY:
+            if self.is_closed():
+                return (1, -self.stop_ts, self.username, self.uri)
+            return (0, -self.start_ts, self.username, self.uri)
+        elif sort == SORT_STARTTIME:
+            return (-self.start_ts, self.username, self.uri)
+        else:
+            return (self.username, -self.start_ts, self.uri)
+
+class RetiredDeviceIndex:
+    """Rows of retired PPP devices, ordered by stop time."""
+
+    def __init__(self):
+        self._clear()
+
+    def _clear(self):
+        self._set_node = None      # tinyrdf node of the RetiredPppDevices set
+        self._generation = None
+        self._rows = {}            # tinyrdf node -> DeviceRow
+        self._order = []           # sorted (stop_ts, uri) tuples
+        self._order_rows = []      # DeviceRow, parallel to self._order
+        self.rows_read = 0         # statistics: rows read from RDF
+
+    def _rebuild_order(self):
+        t = []
+        for row in self._rows.values():
+            stop_ts = row.stop_ts
+            if stop_ts is None:
+                stop_ts = row.start_ts
+            t.append(((stop_ts, row.uri), row))
+        t.sort()
+        self._order = [k for k, row in t]
+        self._order_rows = [row for k, row in t]
+
+    def refresh(self):
+        """Bring the index up to date with RDF; call inside a transaction."""
+        global_st_root = helpers.get_global_status()
+        if not global_st_root.hasS(ns.retiredPppDevices):
+            self._clear()
+            return
+        devs_node = global_st_root.getS(ns.retiredPppDevices, rdf.Type(ns.RetiredPppDevices))
+
+        generation, changed = db.get_db().getModel().getChangesSince(self._generation)
+        if devs_node.node != self._set_node:
+            self._clear()
+            self._set_node = devs_node.node
+            changed = None
+        self._generation = generation
+
+        # without change information, resync membership; existing rows are
+        # kept because retired devices are not modified
+
+        if changed is not None:
+            changed = set(changed)
+            if devs_node.node not in changed:
+                # membership unchanged; re-read changed devices only
+                dirty = [n for n in changed if self._rows.has_key(n)]
+                if len(dirty) == 0:
+                    return
+                for n in dirty:
+                    self._read_row(rdf.Node(devs_node.model, n))
+                self._rebuild_order()
+                return
+
+        members = {}
+        for d in devs_node.getNodes(ns.pppDevice):
+            members[d.node] = d
+        for n in self._rows.keys():
+            if not members.has_key(n):
+                del self._rows[n]
+        for n, d in members.iteritems():
+            if (not self._rows.has_key(n)) or ((changed is not None) and (n in changed)):
+                self._read_row(d)
+        self._rebuild_order()
+
+    def _read_row(self, dev):
+        try:
+            self._rows[dev.node] = DeviceRow(dev)
+            self.rows_read += 1
+        except:
+            _log.exception('cannot read retired device %s, ignoring' % dev)
+            if self._rows.has_key(dev.node):
+                del self._rows[dev.node]
+
+    def get_rows(self, since=None):
+        """Get rows of devices closed at or after since (seconds since epoch), oldest first."""
+        if since is None:
+            return list(self._order_rows)
+        return self._order_rows[bisect.bisect_left(self._order, (since,)):]
+
+    def __len__(self):
+        return len(self._rows)
+
+_global_retired_index = None
+
+def get_retired_device_index():
+    global _global_retired_index
+    if _global_retired_index is None:
+        _global_retired_index = RetiredDeviceIndex()
+    return _global_retired_index
+
+class QueryResult:
+    """One page of a PPP device query.
+
+    @ivar rows: L{DeviceRow}s of this page, in sort order.
+    @ivar total: Number of matching devices over all pages.
+    """
+
+    def __init__(self, rows, total, offset, limit):
+        self.rows = rows
+        self.total = total
+        self.offset = offset
+        self.limit = limit
+
+    def get_page_count(self):
+        if (self.limit is None) or (self.limit <= 0):
+            return 1
+        return max(1, (self.total + self.limit - 1) / self.limit)
+
+    def get_page(self):
+        if (self.limit is None) or (self.limit <= 0):
+            return 0
+        return self.offset / self.limit
+
+def query_ppp_devices(connection_types, include_active=True, include_retired=False, sort=SORT_USERNAME,
+                      username=None, since=None, until=None, offset=0, limit=None):
+    """Query PPP devices for a status list.
+
+    @param connection_types: List of TYPE_* constants to include.
+    @param username: Case insensitive username substring to match, or None.
+    @param since: Only include connections up at or after this datetime, or None.
+    @param until: Only include connections up at or before this datetime, or None.
+    @param offset: Index of first row to return (after sorting).
+    @param limit: Maximum number of rows to return, None for all.
+    @return: L{QueryResult}
+    """
+
+    since_ts, until_ts = _timestamp(since), _timestamp(until)
+    if username is not None:
+        username = username.lower()
+
+    rows = []
+    if include_active:
+        st_root = helpers.get_status()
+        if st_root.hasS(ns.pppDevices):
+            for d in helpers.get_ppp_devices():
+                # XXX: we'd like to ignore inactive devices, but this wasn't reliable enough
+                try:
+                    rows.append(DeviceRow(d))
+                except:
+                    _log.exception('cannot read device %s, ignoring' % d)
+    if include_retired:
+        idx = get_retired_device_index()
+        idx.refresh()
+        rows.extend(idx.get_rows(since=since_ts))
+
+    matched = []
+    for row in rows:
+        if row.connection_type not in connection_types:
+            continue
+        if (username is not None) and (row.username.lower().find(username) < 0):
+            continue
+        if not row.overlaps(since_ts, until_ts):
+            continue
+        matched.append((row.sort_key(sort), row))
+    matched.sort()
+
+    total = len(matched)
+    if offset < 0:
+        offset = 0
+    if limit is None:
+        page = matched[offset:]
+    else:
+        page = matched[offset:offset + limit]
+    return QueryResult([row for key, row in page], total, offset, limit)
@@ -1496,7 +1496,9 @@ class CreateProtocolData:
     def restart_freeradius(self):
         """Regenerate freeradius configuration and restart the server.
 
-        Do it indirectly using runner marker file and signal.
+        Do it indirectly using runner marker file and signal.  If only the
+        users file changes, the runner reloads freeradius instead of
+        restarting it.
 
         This must be done every time the user config has changed: when
         users are added/removed/changed in admin interface and when the
@@ -4,13 +4,13 @@ import os
 import re
 import datetime
 import textwrap
+import StringIO
 
 import formal
 
 from twisted.internet import reactor, protocol, defer, error
 from twisted.python.util import mergeFunctionMetadata
 from nevow import inevow, url, appserver, tags as T, static
-from twisted.names import client, dns
 from twisted.mail import smtp
 from zope.interface import implements
 
@@ -25,6 +25,7 @@ from codebay.l2tpserver import constants
 from codebay.l2tpserver import versioninfo
 from codebay.l2tpserver import licensemanager
 from codebay.l2tpserver.rdfconfig import ns, ns_ui
+from codebay.l2tpserver.webui import dnscache
 
 run_command = runcommand.run_command
 _log = logger.get('l2tpserver.webui.uihelpers')
@@ -949,74 +950,50 @@ def ui_reboot(msg, skip_update=False, force_update=False, force_fsck=False, dela
     _run_shutdown(msg, '-r', delay)
 
 
-# Avoids the use of an in-memory store because it is currently way too slow, see #666.
-def _export_rdf_database_helper(filename=None, return_string=False, remove_status=True):
-    fname1 = constants.WEBUI_TEMPORARY_SQLITE_DATABASE
-    fname2 = '%s-journal' % fname1
+# Avoids building the whole export in memory (or in a temporary database,
+# see #666): reachable statements are snapshotted into a temporary file while
+# the database is locked, and serialized from there without the lock.
+def export_rdf_database_to_fileobj(fileobj, remove_status=True):
+    root = helpers.get_db_root()
+    model = root.model          # XXX: cleaner way?
 
-    def _delete_files():
-        for i in [ fname1, fname2 ]:
-            if os.path.exists(i):
-                os.unlink(i)
-
-    try:
-        _delete_files()
-    except:
-        _log.exception('failed to delete webui temporary sqlite database file(s)')
-    
-    temp_db = None
-    try:
-        root = helpers.get_db_root()
-        model = root.model          # XXX: cleaner way?
-
-        # First, create an in-memory string export (large, but no larger than a temp file)
-        @db.transact(database=model)
-        def _f1():
-            return model.toString(name='rdfxml')     # rdf database as a string (may be a tad large)
-        tmpstr = _f1()
-
-        # Second, load the string, prune, and write out to exported RDFXML file (or string)
-        temp_db = rdf.Database.create(fname1)
-        @db.transact(database=temp_db)
-        def _f2():
-            temp_db.loadString(tmpstr)
-    
-            root = temp_db.getNodeByUri(ns.l2tpGlobalRoot, rdf.Type(ns.L2tpGlobalRoot))
-            try:
-                if remove_status:
-                    l2tp_status = root.getS(ns.l2tpDeviceStatus, rdf.Type(ns.L2tpDeviceStatus))
-                    activepppdevs = l2tp_status.setS(ns.pppDevices, rdf.Type(ns.PppDevices))
-                    retiredpppdevs_compat = l2tp_status.setS(ns.retiredPppDevices, rdf.Type(ns.RetiredPppDevices)) # compatibility with 1.0
-                    global_status = root.getS(ns.globalStatus, rdf.Type(ns.GlobalStatus))
-                    retiredpppdevs = global_status.setS(ns.retiredPppDevices, rdf.Type(ns.RetiredPppDevices))
-            except:
-                _log.exception('failed when pruning ppp devices')
-            temp_db.prune(root)
-
-            if return_string:
-                return temp_db.toString(name='rdfxml')
-            else:
-                temp_db.toFile(filename, name='rdfxml')
-                return None
-            # db is closed in 'finally' clause
-        return _f2()
-    finally:
-        if temp_db is not None:
-            try:
-                temp_db.close()
-                temp_db = None
-            except:
-                _log.exception('failed to close temporary database')
+    @db.transact(database=model)
+    def _get_emptied():
+        if not remove_status:
+            return []
         try:
-            _delete_files()
+            l2tp_status = root.getS(ns.l2tpDeviceStatus, rdf.Type(ns.L2tpDeviceStatus))
+            global_status = root.getS(ns.globalStatus, rdf.Type(ns.GlobalStatus))
+            return [ (l2tp_status, ns.pppDevices, ns.PppDevices),
+                     (l2tp_status, ns.retiredPppDevices, ns.RetiredPppDevices),  # compatibility with 1.0
+                     (global_status, ns.retiredPppDevices, ns.RetiredPppDevices) ]
         except:
-            _log.exception('failed to close temporary files')
+            _log.exception('failed when pruning ppp devices')
+            return []
+
+    model.exportPruned(root, fileobj, name='rdfxml', emptied=_get_emptied(),
+                       tempdir=constants.WEBUI_TEMPORARY_EXPORT_DIRECTORY)
 
 def export_rdf_database_to_file(filename, remove_status=True):
-    return _export_rdf_database_helper(filename=filename, return_string=False, remove_status=remove_status)
+    # write to a temporary file first, so that an interrupted export never
+    # replaces a previous good one
+    tmpname = '%s.tmp' % filename
+    f = open(tmpname, 'wb')
+    try:
+        try:
+            export_rdf_database_to_fileobj(f, remove_status=remove_status)
+        finally:
+            f.close()
+        os.rename(tmpname, filename)
+    except:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+        raise
 
 def export_rdf_database(remove_status=True):
-    return _export_rdf_database_helper(filename=None, return_string=True, remove_status=remove_status)
+    f = StringIO.StringIO()
+    export_rdf_database_to_fileobj(f, remove_status=remove_status)
+    return f.getvalue()
 
 def get_user_password_dict():
     """Specific helper for user config pages.
@@ -1224,63 +1201,14 @@ def set_nocache_headers(request):
     request.setHeader('Pragma', 'no-cache')
     request.setHeader('Expires', '-1')
 
-# XXX: do we need to reinstantiate the resolved when e.g. /etc/resolv.conf changes?
-_resolver = None
-def _get_resolver():
-    global _resolver
-
-    if _resolver is None:
-        _resolver = client.createResolver()   # XXX: parameters here, e.g. timeout?
-
-    return _resolver
-    
 def reverse_dns_lookup(addr):
-    global _resolver
-    _get_resolver()
-    
-    @db.transact()
-    def _success((ans, auth, add), name):
-        _log.info('reverse dns lookup success for %s' % name)
-        
-        # XXX: this is not too intuitive, but works; read the twisted code
-        answers = ans + auth + add
-        for a in answers:
-            if a.type == dns.PTR and a.name.name == name:
-                return a.payload.name.name
-        raise error.DNSLookupError(name)
-
-    # ensure we get an IPv4Address
-    if isinstance(addr, (str, unicode)):
-        addr = datatypes.IPv4Address.fromString(str(addr))
-        
-    t = addr.toIntegerList()
-    name = '%d.%d.%d.%d.in-addr.arpa' % (t[3], t[2], t[1], t[0])
-    d = _resolver.lookupPointer(name).addCallback(_success, name)
-    return d  # deferred
+    """Reverse resolve addr through the shared DNS cache; returns a deferred."""
+    return dnscache.get_dns_cache().lookup_reverse(addr)
 
 def dns_lookup(hostname):
-    global _resolver
-    _get_resolver()
-
-    @db.transact()
-    def _success((ans, auth, add), hostname):
-        _log.info('dns lookup success for %s' % hostname)
-
-        # XXX: this is not too intuitive, but works; read the twisted code
-        answers = ans + auth + add
-        _log.info('answers: %s' % answers)
-        for a in answers:
-            _log.info('result type: %s (dns.A=%s)' % (a.type, dns.A))
-            if a.type == dns.A:
-                t = a.payload.address
-                ipstr = '%d.%d.%d.%d' % (ord(t[0]), ord(t[1]), ord(t[2]), ord(t[3]))
-                res = datatypes.IPv4Address.fromString(ipstr)
-                return res
-        raise error.DNSLookupError(hostname)
-
-    d = _resolver.lookupAddress(hostname).addCallback(_success, hostname)
-    return d  # deferred
-        
+    """Resolve hostname through the shared DNS cache; returns a deferred."""
+    return dnscache.get_dns_cache().lookup_address(hostname)
+
 def compute_periodic_reboot_time():
     """Figure time after which periodic reboot is desired.
 